@@ -0,0 +1,421 @@
+"""Offline benchmarks of map processing hot paths, on synthetic maps.
+
+For each size (number of cells), a synthetic map is generated on a restore_map-like
+lattice: smooth relief made of random waves, written as a binary grid, a text map,
+a water image (blue below WATER_LEVEL, yellow elsewhere, one pixel per cell) and
+a JSON dictionary of elevation API path responses. Each benchmark is timed, and its peak
+memory above memory in use before it starts is measured with tracemalloc, through
+pyccai.profiling spans. Results are saved as JSON, and can be compared with results of
+a previous run to spot regressions.
+"""
+import argparse
+import math
+import os
+import platform
+import tempfile
+import tracemalloc
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import ujson as json
+from PIL import Image
+
+from pyccai.elevation import MAX_SAMPLES_PER_REQUEST, get_url_along_path
+from pyccai.flood import (YELLOW, BLUE, Coordinates, MapImage, flooded_points, get_neighbors,
+                          group_rectangles, select_flooded)
+from pyccai.grid import (ROWS_PER_BLOCK, create_grid, load_map, write_grid_metadata,
+                         write_text_map)
+from pyccai.heightmap import SampleStatistics, save_heightmap
+from pyccai.profiling import TRACE, Profiler
+from pyccai.restore_map import rebuild_map
+
+ORIGIN_LAT = 45.6
+ORIGIN_LNG = -73.8
+LAT_STEP = -0.0009
+LNG_STEP = 0.0013
+RESOLUTION = 4.77
+NB_WAVES = 6
+FLOOD_THRESHOLD = 0.0
+WATER_LEVEL = -10.0
+NB_NEIGHBOR_QUERIES = 100
+DEFAULT_SIZES = (10 ** 4, 10 ** 5, 10 ** 6)
+# Benchmarks are skipped above these numbers of cells, unless limits are disabled.
+MAX_CELLS = {
+    'load_text': 10 ** 7,
+    'coordinates': 10 ** 7,
+    'get_neighbors': 10 ** 7,
+    'group': 10 ** 6,
+    'restore': 10 ** 7,
+    'restore_indented': 10 ** 6,
+}
+# Time or memory ratio above which a result is reported as a regression.
+REGRESSION_FACTOR = 1.2
+# Results below these values are too noisy to be compared.
+MIN_COMPARED = {'seconds': 0.01, 'peak_memory': 1 << 20}
+
+
+def synthetic_altitudes(height, width, start, stop, seed=0):
+    # type: (int, int, int, int, int) -> np.ndarray
+    # Rows [start, stop) of synthetic relief, as float32 altitudes in about [-30, 50] meters.
+    rng = np.random.default_rng(seed)
+    rows = np.arange(start, stop, dtype=np.float64)[:, None]
+    columns = np.arange(width, dtype=np.float64)[None, :]
+    altitudes = np.full((stop - start, width), 10.0)
+    for _ in range(NB_WAVES):
+        row_frequency, column_frequency = rng.uniform(0.002, 0.05, 2)
+        row_phase, column_phase = rng.uniform(0, 2 * math.pi, 2)
+        amplitude = rng.uniform(3, 10)
+        altitudes += amplitude * (np.sin(rows * row_frequency + row_phase)
+                                  * np.cos(columns * column_frequency + column_phase))
+    return altitudes.astype(np.float32)
+
+
+def generate_grid(path, width, height, seed=0):
+    # type: (str, int, int, int) -> Any
+    grid = create_grid(path, width, height, ORIGIN_LAT, ORIGIN_LNG, LAT_STEP, LNG_STEP)
+    for start in range(0, height, ROWS_PER_BLOCK):
+        stop = min(start + ROWS_PER_BLOCK, height)
+        grid.altitudes[start:stop] = synthetic_altitudes(height, width, start, stop, seed)
+        grid.resolutions[start:stop] = RESOLUTION
+    grid.flush()
+    write_grid_metadata(path, grid)
+    return grid
+
+
+def generate_water_image(path, grid):
+    # type: (str, Any) -> None
+    # Image top is north: grid rows are from north to south, as LAT_STEP < 0.
+    pixels = np.empty((grid.height, grid.width, 3), dtype=np.uint8)
+    for start in range(0, grid.height, ROWS_PER_BLOCK):
+        block = slice(start, start + ROWS_PER_BLOCK)
+        water = grid.altitudes[block] < WATER_LEVEL
+        pixels[block] = YELLOW
+        pixels[block][water] = BLUE
+    Image.fromarray(pixels).save(path)
+
+
+def generate_responses(path, grid, indent=0):
+    # type: (str, Any, int) -> None
+    # Write grid as a JSON dictionary of elevation API path query URLs to responses,
+    # each row being split into queries of at most MAX_SAMPLES_PER_REQUEST samples.
+    # With indent, JSON is pretty-printed, as by json.dump(..., indent=indent).
+    latitudes = grid.latitudes.tolist()
+    longitudes = grid.longitudes.tolist()
+    margin = '\n' + ' ' * indent if indent else ''
+    separator = margin
+    with open(path, 'w') as file:
+        file.write('{')
+        for row in range(grid.height):
+            altitudes = grid.altitudes[row].tolist()
+            resolutions = grid.resolutions[row].tolist()
+            for start in range(0, grid.width, MAX_SAMPLES_PER_REQUEST):
+                stop = min(start + MAX_SAMPLES_PER_REQUEST, grid.width)
+                if stop - start < 2:
+                    start = stop - 2
+                url = get_url_along_path((latitudes[row], longitudes[start]),
+                                         (latitudes[row], longitudes[stop - 1]), stop - start)
+                values = json.dumps(list(zip(altitudes[start:stop], resolutions[start:stop])),
+                                    indent=indent)
+                file.write('%s%s:%s%s' % (separator, json.dumps(url, escape_forward_slashes=False),
+                                          ' ' if indent else '', values.replace('\n', margin)))
+                separator = ',' + margin
+        file.write('\n}' if indent else '}')
+
+
+class SyntheticMap:
+    # Synthetic map files of a given size, generated when first needed.
+    __slots__ = ('directory', 'width', 'height', 'nb_processes', '_grid', '_files', '_flood')
+
+    def __init__(self, directory, cells, nb_processes=None):
+        # type: (str, int, Optional[int]) -> None
+        self.directory = directory
+        self.width = max(2, int(round(math.sqrt(cells))))
+        self.height = max(2, int(round(cells / self.width)))
+        self.nb_processes = nb_processes
+        self._grid = None  # type: Any
+        self._files = {}  # type: Dict[str, str]
+        self._flood = None
+
+    @property
+    def cells(self):
+        return self.width * self.height
+
+    def path(self, name):
+        # type: (str) -> str
+        return os.path.join(self.directory, '%dx%d.%s' % (self.width, self.height, name))
+
+    @property
+    def grid(self):
+        # type: () -> Any
+        if self._grid is None:
+            self._grid = generate_grid(self.path('grid'), self.width, self.height)
+        return self._grid
+
+    def file(self, name):
+        # type: (str) -> str
+        # Path of map file 'grid', 'txt', 'png', 'json' or 'indented.json' (pretty-printed
+        # JSON), generated if needed.
+        if name not in self._files:
+            grid = self.grid
+            path = self.path(name)
+            if name == 'txt':
+                write_text_map(path, grid)
+            elif name == 'png':
+                generate_water_image(path, grid)
+            elif name == 'json':
+                generate_responses(path, grid)
+            elif name == 'indented.json':
+                generate_responses(path, grid, indent=2)
+            self._files[name] = path
+        return self._files[name]
+
+    @property
+    def flood(self):
+        if self._flood is None:
+            self._flood = flood_points(self)
+        return self._flood
+
+
+def flood_points(synthetic_map):
+    # type: (SyntheticMap) -> list
+    grid = load_map(synthetic_map.file('grid'))
+    water = MapImage(synthetic_map.file('png')).water_mask(grid)
+    return flooded_points(grid, select_flooded(grid.altitudes, FLOOD_THRESHOLD, water))
+
+
+# Each benchmark has a prepare(synthetic_map) function returning its inputs, run outside
+# measures, and a run(inputs, profiler) function, measured in profiler span.
+
+
+def run_load_text(path, profiler):
+    grid = load_map(path)
+    profiler.count('samples', grid.size)
+
+
+def run_load_grid(path, profiler):
+    # Grid is memory-mapped: altitudes are summed so that they are read.
+    grid = load_map(path)
+    for start in range(0, grid.height, ROWS_PER_BLOCK):
+        np.sum(grid.altitudes[start:(start + ROWS_PER_BLOCK)], dtype=np.float64)
+    profiler.count('samples', grid.size)
+
+
+def prepare_select(synthetic_map):
+    return synthetic_map.file('grid'), synthetic_map.file('png')
+
+
+def run_select(paths, profiler):
+    grid_path, image_path = paths
+    grid = load_map(grid_path)
+    water = MapImage(image_path).water_mask(grid)
+    flood = flooded_points(grid, select_flooded(grid.altitudes, FLOOD_THRESHOLD, water))
+    profiler.count('flooded points', len(flood))
+
+
+def run_coordinates(flood, profiler):
+    Coordinates(flood)
+    profiler.count('points', len(flood))
+
+
+def prepare_get_neighbors(synthetic_map):
+    flood = synthetic_map.flood
+    points = flood[::max(1, len(flood) // NB_NEIGHBOR_QUERIES)][:NB_NEIGHBOR_QUERIES]
+    return points, Coordinates(flood)
+
+
+def run_get_neighbors(inputs, profiler):
+    points, coordinates = inputs
+    for point in points:
+        profiler.count('neighbors', len(get_neighbors(point, coordinates, True)))
+        profiler.count('queries')
+
+
+def run_group(flood, profiler):
+    # group_rectangles counts points and rectangles itself.
+    group_rectangles(flood, verbose=False)
+
+
+def prepare_restore(synthetic_map, name='json'):
+    return (synthetic_map.file(name), synthetic_map.path('restored.grid'),
+            synthetic_map.nb_processes, synthetic_map.grid)
+
+
+def run_restore(inputs, profiler):
+    # Rebuild map, and check it round-trips synthetic map.
+    json_path, output_path, nb_processes, expected = inputs
+    grid = rebuild_map(json_path, output_path, nb_processes=nb_processes)
+    # Rebuilt map rows go from south to north.
+    rows = slice(None, None, -1) if (grid.lat_step > 0) != (expected.lat_step > 0) else slice(None)
+    if not (np.array_equal(grid.altitudes, expected.altitudes[rows])
+            and np.array_equal(grid.resolutions, expected.resolutions[rows])):
+        raise RuntimeError('Map rebuilt from %s differs from synthetic map' % json_path)
+    profiler.count('samples', grid.size)
+    profiler.count('json bytes', os.path.getsize(json_path))
+
+
+def prepare_heightmap(synthetic_map):
+    grid = synthetic_map.grid
+    statistics = SampleStatistics()
+    for start in range(0, grid.height, ROWS_PER_BLOCK):
+        block = slice(start, start + ROWS_PER_BLOCK)
+        statistics.update(grid.altitudes[block].ravel(), grid.resolutions[block].ravel())
+    return grid, statistics, synthetic_map.path('png')
+
+
+def run_heightmap_png8(inputs, profiler):
+    _run_heightmap(inputs, profiler, 8)
+
+
+def run_heightmap_png16(inputs, profiler):
+    _run_heightmap(inputs, profiler, 16)
+
+
+def _run_heightmap(inputs, profiler, bits):
+    grid, statistics, water_image_path = inputs
+    path = '%s.%d.png' % (os.path.splitext(water_image_path)[0], bits)
+    save_heightmap(path, grid, statistics, bits)
+    profiler.count('output bytes', os.path.getsize(path))
+
+
+BENCHMARKS = {
+    'load_text': (lambda synthetic_map: synthetic_map.file('txt'), run_load_text),
+    'load_grid': (lambda synthetic_map: synthetic_map.file('grid'), run_load_grid),
+    'select': (prepare_select, run_select),
+    'coordinates': (lambda synthetic_map: synthetic_map.flood, run_coordinates),
+    'get_neighbors': (prepare_get_neighbors, run_get_neighbors),
+    'group': (lambda synthetic_map: synthetic_map.flood, run_group),
+    'restore': (prepare_restore, run_restore),
+    'restore_indented': (lambda synthetic_map: prepare_restore(synthetic_map, 'indented.json'),
+                         run_restore),
+    'heightmap_png8': (prepare_heightmap, run_heightmap_png8),
+    'heightmap_png16': (prepare_heightmap, run_heightmap_png16),
+}  # type: Dict[str, Tuple[Callable, Callable]]
+
+
+def run_benchmark(name, synthetic_map, repeat=1, memory=True):
+    # type: (str, SyntheticMap, int, bool) -> dict
+    # Run a benchmark and return its result: best time over repeats, in seconds,
+    # and highest peak memory above memory in use at start, in bytes (memory of
+    # restore_map worker processes is not traced).
+    prepare, run = BENCHMARKS[name]
+    inputs = prepare(synthetic_map)
+    TRACE.memory = memory
+    seconds = None
+    peak_memory = None
+    counters = {}
+    for _ in range(repeat):
+        start_memory = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+        with Profiler('%s %d' % (name, synthetic_map.cells), verbose=False) as profiler:
+            run(inputs, profiler)
+        span = profiler.span
+        seconds = span.duration if seconds is None else min(seconds, span.duration)
+        if span.peak_memory is not None:
+            peak_memory = max(peak_memory or 0, span.peak_memory - start_memory)
+        counters = span.counters
+    TRACE.memory = False
+    return {
+        'benchmark': name,
+        'cells': synthetic_map.cells,
+        'width': synthetic_map.width,
+        'height': synthetic_map.height,
+        'seconds': seconds,
+        'peak_memory': peak_memory,
+        'counters': counters,
+    }
+
+
+def compare_results(results, previous):
+    # type: (List[dict], List[dict]) -> List[str]
+    # Return lines comparing results with previous ones, flagging regressions.
+    previous_results = {(result['benchmark'], result['cells']): result for result in previous}
+    lines = []
+    for result in results:
+        old = previous_results.get((result['benchmark'], result['cells']))
+        if old is None:
+            continue
+        pieces = ['%s %d:' % (result['benchmark'], result['cells'])]
+        for key, minimum in MIN_COMPARED.items():
+            if result[key] is None or not old[key] or max(result[key], old[key]) < minimum:
+                continue
+            ratio = result[key] / old[key]
+            pieces.append('%s x%.2f%s' % (key, ratio,
+                                         ' REGRESSION' if ratio > REGRESSION_FACTOR else ''))
+        lines.append(' '.join(pieces))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Benchmark map processing hot paths on synthetic maps.')
+    parser.add_argument('--sizes', '-s', type=float, nargs='+', default=DEFAULT_SIZES,
+                        help='Map sizes, in cells (default: %s).' % ' '.join(
+                            '%g' % size for size in DEFAULT_SIZES))
+    parser.add_argument('--benchmarks', '-b', type=str, nargs='+', default=list(BENCHMARKS),
+                        choices=list(BENCHMARKS), help='Benchmarks to run (default: all).')
+    parser.add_argument('--no-limit', action='store_true',
+                        help='Run benchmarks on all sizes. By default, slow benchmarks are '
+                             'skipped above: %s.' % ', '.join(
+                                 '%s %g' % item for item in MAX_CELLS.items()))
+    parser.add_argument('--repeat', '-r', type=int, default=1,
+                        help='Number of runs of each benchmark, best time being kept.')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Do not measure peak memory (tracemalloc slows allocations down).')
+    parser.add_argument('--processes', '-p', type=int, default=None,
+                        help='Number of processes for restore benchmark '
+                             '(default: number of CPUs).')
+    parser.add_argument('--directory', '-d', type=str, default=None,
+                        help='Directory where synthetic maps are generated and kept '
+                             '(default: a temporary directory, removed at end).')
+    parser.add_argument('--label', type=str, default=None,
+                        help='Label saved with results, e.g. a version name.')
+    parser.add_argument('--output', '-o', type=str, default='benchmark.json',
+                        help='Output JSON file (default: benchmark.json).')
+    parser.add_argument('--compare', '-c', type=str, default=None,
+                        help='JSON results of a previous run to compare with.')
+    args = parser.parse_args()
+    temporary_directory = None
+    directory = args.directory
+    if directory is None:
+        temporary_directory = tempfile.TemporaryDirectory(prefix='pyccai-benchmark-')
+        directory = temporary_directory.name
+    os.makedirs(directory, exist_ok=True)
+    results = []
+    try:
+        for size in args.sizes:
+            synthetic_map = SyntheticMap(directory, int(size), args.processes)
+            for name in args.benchmarks:
+                if not args.no_limit and synthetic_map.cells > MAX_CELLS.get(name, math.inf):
+                    print('Skipping', name, 'on', synthetic_map.cells, 'cells.')
+                    continue
+                result = run_benchmark(name, synthetic_map, args.repeat, not args.no_memory)
+                print('[benchmark]', name, synthetic_map.cells, 'cells:',
+                      '%.6f sec' % result['seconds'],
+                      *(('peak memory %.1f MB' % (result['peak_memory'] / (1 << 20)),)
+                        if result['peak_memory'] is not None else ()),
+                      *('%s=%s' % item for item in result['counters'].items()))
+                results.append(result)
+    finally:
+        if temporary_directory is not None:
+            temporary_directory.cleanup()
+    output = {
+        'label': args.label,
+        'date': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'results': results,
+    }
+    with open(args.output, 'w') as file:
+        file.write(json.dumps(output, indent=2))
+    print('Results saved in', args.output)
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.loads(file.read())
+        print('Compared with', args.compare, '(%s)' % previous.get('label'))
+        for line in compare_results(results, previous['results']):
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""Persistent on-disk cache of elevation samples (SQLite).
+
+Samples are keyed by latitude and longitude snapped to a global grid of CACHE_QUANTUM
+degrees (about 11 cm), so the same location sampled by different runs maps to the same
+key. For runs to sample same locations, heightmap samples regions on sampling_lattice():
+a global lattice whose steps and positions are multiples of CACHE_QUANTUM, so that
+overlapping or shifted regions at same resolution share their samples. Each sample stores elevation and resolution, and the run in which it was last used.
+When cache holds more than max_samples samples, least recently used ones are evicted.
+"""
+import math
+import sqlite3
+import time
+from typing import Tuple
+
+import numpy as np
+
+CACHE_QUANTUM = 1e-6
+DEFAULT_MAX_SAMPLES = 100000000
+COMMIT_EVERY = 100000
+# Sampling lattice: latitude step is resolution converted with METERS_PER_DEGREE. Longitude
+# step is latitude step times 1 / cos(latitude), rounded down to a multiple of
+# 1 / LNG_STEP_BUCKETS, so that regions at close latitudes share it.
+METERS_PER_DEGREE = 111320.0
+LNG_STEP_BUCKETS = 8
+
+
+def quantize(values):
+    # type: (np.ndarray) -> np.ndarray
+    return np.rint(np.asarray(values, dtype=np.float64) / CACHE_QUANTUM).astype(np.int64)
+
+
+def sampling_lattice(north, south, west, east, resolution):
+    # type: (float, float, float, float, float) -> Tuple[np.ndarray, np.ndarray]
+    # Return cache keys of latitudes (north to south) and longitudes (west to east) of global
+    # sampling lattice for given resolution, in meters, covering bounds.
+    # Points are at (lat_key, lng_key) * CACHE_QUANTUM.
+    lat_units = max(1, int(round(resolution / METERS_PER_DEGREE / CACHE_QUANTUM)))
+    ratio = 1 / math.cos(math.radians((north + south) / 2))
+    lng_units = max(1, int(round(
+        lat_units * math.floor(ratio * LNG_STEP_BUCKETS) / LNG_STEP_BUCKETS)))
+    north_key, south_key, west_key, east_key = quantize([north, south, west, east]).tolist()
+    north_index = -(-north_key // lat_units)
+    south_index = south_key // lat_units
+    west_index = west_key // lng_units
+    east_index = -(-east_key // lng_units)
+    return (np.arange(north_index, south_index - 1, -1, dtype=np.int64) * lat_units,
+            np.arange(west_index, east_index + 1, dtype=np.int64) * lng_units)
+
+
+class ElevationCache:
+    __slots__ = ('path', 'max_samples', 'connection', 'stamp', 'nb_pending', 'nb_hits')
+
+    def __init__(self, path, max_samples=DEFAULT_MAX_SAMPLES):
+        # type: (str, int) -> None
+        self.path = path
+        self.max_samples = max_samples
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS samples ('
+            'lat_key INTEGER NOT NULL, '
+            'lng_key INTEGER NOT NULL, '
+            'elevation REAL NOT NULL, '
+            'resolution REAL NOT NULL, '
+            'last_used INTEGER NOT NULL, '
+            'PRIMARY KEY (lat_key, lng_key)) WITHOUT ROWID')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS samples_last_used ON samples (last_used)')
+        self.connection.commit()
+        # Samples used during this run are marked with this stamp.
+        self.stamp = time.time_ns()
+        self.nb_pending = 0
+        self.nb_hits = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM samples').fetchone()[0]
+
+    def get_row(self, lat, lngs):
+        # type: (float, np.ndarray) -> Tuple[np.ndarray, np.ndarray]
+        # Return (elevations, resolutions) for points (lat, lngs[i]), NaN where not cached.
+        lat_key = int(quantize(lat))
+        lng_keys = quantize(lngs)
+        elevations = np.full(len(lng_keys), np.nan)
+        resolutions = np.full(len(lng_keys), np.nan)
+        if not len(lng_keys):
+            return elevations, resolutions
+        rows = self.connection.execute(
+            'SELECT lng_key, elevation, resolution FROM samples '
+            'WHERE lat_key = ? AND lng_key BETWEEN ? AND ?',
+            (lat_key, int(lng_keys.min()), int(lng_keys.max()))).fetchall()
+        if rows:
+            found = np.array(rows, dtype=np.float64).reshape(-1, 3)
+            found_keys = found[:, 0].astype(np.int64)
+            order = np.argsort(found_keys)
+            found_keys = found_keys[order]
+            positions = np.clip(np.searchsorted(found_keys, lng_keys), 0, len(found_keys) - 1)
+            hits = found_keys[positions] == lng_keys
+            elevations[hits] = found[order[positions[hits]], 1]
+            resolutions[hits] = found[order[positions[hits]], 2]
+            hit_keys = lng_keys[hits].tolist()
+            self.connection.executemany(
+                'UPDATE samples SET last_used = ? WHERE lat_key = ? AND lng_key = ?',
+                ((self.stamp, lat_key, key) for key in hit_keys))
+            self.nb_hits += len(hit_keys)
+            self._pending(len(hit_keys))
+        return elevations, resolutions
+
+    def put(self, lats, lngs, elevations, resolutions):
+        # type: (np.ndarray, np.ndarray, np.ndarray, np.ndarray) -> None
+        lat_keys = quantize(lats).tolist()
+        lng_keys = quantize(lngs).tolist()
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?)',
+            zip(lat_keys, lng_keys, np.asarray(elevations, dtype=np.float64).tolist(),
+                np.asarray(resolutions, dtype=np.float64).tolist(),
+                [self.stamp] * len(lat_keys)))
+        self._pending(len(lat_keys))
+
+    def _pending(self, count):
+        self.nb_pending += count
+        if self.nb_pending >= COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.nb_pending = 0
+
+    def evict(self):
+        # type: () -> int
+        # Remove least recently used samples above size limit. Return number of evicted samples.
+        excess = len(self) - self.max_samples
+        if excess <= 0:
+            return 0
+        self.connection.execute(
+            'DELETE FROM samples WHERE (lat_key, lng_key) IN (SELECT lat_key, lng_key '
+            'FROM samples ORDER BY last_used LIMIT ?)', (excess,))
+        self.commit()
+        return excess
+
+    def close(self):
+        self.evict()
+        self.commit()
+        self.connection.close()
@@ -0,0 +1,294 @@
+"""Local digital elevation model (DEM) files as an offline elevation provider.
+
+Supported files, memory-mapped so that only sampled pixels are read from disk:
+- SRTM .hgt tiles (1201 x 1201 or 3601 x 3601 big-endian int16, named after their
+  south-west corner, e.g. N45W074.hgt);
+- uncompressed single-band GeoTIFF in geographic coordinates (lat/lng degrees), stored
+  in contiguous strips, with integer or float samples.
+
+Elevations are bilinearly interpolated between the 4 pixels around each sample, for a whole
+block of grid rows at once. Samples where one of these pixels is a void (nodata) are NaN,
+as are samples outside every file. Resolution of a sample is pixel height in meters.
+"""
+import math
+import os
+import re
+import struct
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from pyccai.elevation import ElevationProvider
+from pyccai.geodesy import meridional_radius
+
+HGT_NAME_PATTERN = re.compile(r'^([NS])(\d{1,2})([EW])(\d{1,3})\.hgt$', re.IGNORECASE)
+HGT_VOID = -32768
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+DEM_EXTENSIONS = ('.hgt',) + TIFF_EXTENSIONS
+SAMPLES_PER_BLOCK = 1 << 20
+
+# TIFF tags.
+TAG_IMAGE_WIDTH = 256
+TAG_IMAGE_LENGTH = 257
+TAG_BITS_PER_SAMPLE = 258
+TAG_COMPRESSION = 259
+TAG_STRIP_OFFSETS = 273
+TAG_SAMPLES_PER_PIXEL = 277
+TAG_ROWS_PER_STRIP = 278
+TAG_STRIP_BYTE_COUNTS = 279
+TAG_TILE_WIDTH = 322
+TAG_SAMPLE_FORMAT = 339
+TAG_MODEL_PIXEL_SCALE = 33550
+TAG_MODEL_TIEPOINT = 33922
+TAG_GEO_KEY_DIRECTORY = 34735
+TAG_GDAL_NODATA = 42113
+# GeoTIFF keys.
+KEY_MODEL_TYPE = 1024
+KEY_RASTER_TYPE = 1025
+MODEL_TYPE_GEOGRAPHIC = 2
+RASTER_PIXEL_IS_POINT = 2
+# TIFF field type: (struct format, size).
+TIFF_TYPES = {1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 6: ('b', 1), 8: ('h', 2),
+              9: ('i', 4), 11: ('f', 4), 12: ('d', 8), 16: ('Q', 8)}
+TIFF_SAMPLE_KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+
+class DemTile:
+    # Raster whose row r and column c are centered at (north - r * lat_step, west + c * lng_step).
+    __slots__ = ('path', 'data', 'north', 'west', 'lat_step', 'lng_step', 'margin', 'nodata',
+                 'resolution')
+
+    def __init__(self, path, data, north, west, lat_step, lng_step, nodata=None, margin=0.0):
+        # type: (str, np.ndarray, float, float, float, float, Optional[float], float) -> None
+        # margin: fraction of pixel covered by the tile beyond outer pixel centers
+        # (0.5 if pixels are areas, 0 if they are points).
+        self.path = path
+        self.data = data
+        self.north = north
+        self.west = west
+        self.lat_step = lat_step
+        self.lng_step = lng_step
+        self.margin = margin
+        self.nodata = nodata
+        # North-south size of pixels at tile center latitude, in meters.
+        center = north - lat_step * (self.height - 1) / 2
+        self.resolution = float(meridional_radius(center)) * math.radians(abs(lat_step))
+
+    @property
+    def height(self):
+        return self.data.shape[0]
+
+    @property
+    def width(self):
+        return self.data.shape[1]
+
+    @property
+    def bounds(self):
+        # type: () -> Tuple[float, float, float, float]
+        # Covered (north, south, west, east).
+        return (self.north + self.margin * self.lat_step,
+                self.north - (self.height - 1 + self.margin) * self.lat_step,
+                self.west - self.margin * self.lng_step,
+                self.west + (self.width - 1 + self.margin) * self.lng_step)
+
+    def interpolate(self, latitudes, longitudes):
+        # type: (np.ndarray, np.ndarray) -> np.ndarray
+        # Return bilinearly interpolated elevations for grid latitudes x longitudes.
+        rows = np.clip((self.north - latitudes) / self.lat_step, 0, self.height - 1)
+        columns = np.clip((longitudes - self.west) / self.lng_step, 0, self.width - 1)
+        top = np.minimum(rows.astype(np.intp), max(0, self.height - 2))
+        left = np.minimum(columns.astype(np.intp), max(0, self.width - 2))
+        bottom = np.minimum(top + 1, self.height - 1)
+        right = np.minimum(left + 1, self.width - 1)
+        row_weights = (rows - top)[:, None]
+        column_weights = (columns - left)[None, :]
+        corners = [self.data[np.ix_(r, c)].astype(np.float64)
+                   for r in (top, bottom) for c in (left, right)]
+        upper = corners[0] + (corners[1] - corners[0]) * column_weights
+        lower = corners[2] + (corners[3] - corners[2]) * column_weights
+        output = upper + (lower - upper) * row_weights
+        if self.nodata is not None:
+            voids = corners[0] == self.nodata
+            for corner in corners[1:]:
+                voids |= corner == self.nodata
+            output[voids] = np.nan
+        return output
+
+    def __str__(self):
+        return 'DemTile(%s, %d x %d, bounds=%s)' % (
+            self.path, self.width, self.height, self.bounds)
+
+
+def read_hgt(path):
+    # type: (str) -> DemTile
+    match = HGT_NAME_PATTERN.match(os.path.basename(path))
+    if match is None:
+        raise RuntimeError('Cannot get SRTM tile position from file name: %s' % path)
+    south = int(match.group(2)) * (1 if match.group(1).upper() == 'N' else -1)
+    west = int(match.group(4)) * (1 if match.group(3).upper() == 'E' else -1)
+    size = int(round(math.sqrt(os.path.getsize(path) / 2)))
+    if 2 * size * size != os.path.getsize(path):
+        raise RuntimeError('Invalid SRTM tile size: %s' % path)
+    data = np.memmap(path, dtype='>i2', mode='r', shape=(size, size))
+    step = 1 / (size - 1)
+    return DemTile(path, data, south + 1, west, step, step, nodata=HGT_VOID)
+
+
+def _read_tiff_tags(file):
+    # Return (byte order, {tag: tuple of values}) for first image of a classic TIFF file.
+    order = {b'II': '<', b'MM': '>'}.get(file.read(2))
+    if order is None or struct.unpack(order + 'H', file.read(2))[0] != 42:
+        raise RuntimeError('Not a classic TIFF file (BigTIFF is not supported)')
+    (ifd_offset,) = struct.unpack(order + 'I', file.read(4))
+    file.seek(ifd_offset)
+    (nb_entries,) = struct.unpack(order + 'H', file.read(2))
+    entries = [struct.unpack(order + 'HHI4s', file.read(12)) for _ in range(nb_entries)]
+    tags = {}  # type: Dict[int, tuple]
+    for tag, field_type, count, value in entries:
+        if field_type not in TIFF_TYPES:
+            continue
+        code, size = TIFF_TYPES[field_type]
+        if count * size > 4:
+            file.seek(struct.unpack(order + 'I', value)[0])
+            value = file.read(count * size)
+        if field_type == 2:
+            tags[tag] = (value[:count].rstrip(b'\0').decode('ascii'),)
+        else:
+            tags[tag] = struct.unpack(order + code * count, value[:count * size])
+    return order, tags
+
+
+def read_geotiff(path):
+    # type: (str) -> DemTile
+    with open(path, 'rb') as file:
+        order, tags = _read_tiff_tags(file)
+
+    def tag(code, default=None):
+        values = tags.get(code)
+        if values is None:
+            if default is None:
+                raise RuntimeError('Missing TIFF tag %d in %s' % (code, path))
+            return default
+        return values
+
+    width = tag(TAG_IMAGE_WIDTH)[0]
+    height = tag(TAG_IMAGE_LENGTH)[0]
+    if tag(TAG_COMPRESSION, (1,))[0] != 1:
+        raise RuntimeError('Compressed GeoTIFF is not supported: %s' % path)
+    if tag(TAG_SAMPLES_PER_PIXEL, (1,))[0] != 1:
+        raise RuntimeError('Only single-band GeoTIFF is supported: %s' % path)
+    if TAG_TILE_WIDTH in tags:
+        raise RuntimeError('Tiled GeoTIFF is not supported: %s' % path)
+    kind = TIFF_SAMPLE_KINDS.get(tag(TAG_SAMPLE_FORMAT, (1,))[0])
+    bits = tag(TAG_BITS_PER_SAMPLE)[0]
+    if kind is None or bits % 8:
+        raise RuntimeError('Unsupported GeoTIFF sample type: %s' % path)
+    dtype = np.dtype('%s%s%d' % (order, kind, bits // 8))
+    offsets = tag(TAG_STRIP_OFFSETS)
+    byte_counts = tag(TAG_STRIP_BYTE_COUNTS)
+    rows_per_strip = min(tag(TAG_ROWS_PER_STRIP, (height,))[0], height)
+    strip_size = rows_per_strip * width * dtype.itemsize
+    if any(offset != offsets[0] + i * strip_size for i, offset in enumerate(offsets)) \
+            or sum(byte_counts) != height * width * dtype.itemsize:
+        raise RuntimeError('GeoTIFF strips are not contiguous: %s' % path)
+    geo_keys = tags.get(TAG_GEO_KEY_DIRECTORY, ())
+    keys = {geo_keys[i]: geo_keys[i + 3]
+            for i in range(4, len(geo_keys), 4) if geo_keys[i + 1] == 0}
+    if keys.get(KEY_MODEL_TYPE, MODEL_TYPE_GEOGRAPHIC) != MODEL_TYPE_GEOGRAPHIC:
+        raise RuntimeError('GeoTIFF must use geographic coordinates: %s' % path)
+    scale_x, scale_y = tag(TAG_MODEL_PIXEL_SCALE)[:2]
+    column, row, _, lng, lat, _ = tag(TAG_MODEL_TIEPOINT)[:6]
+    # Tie point is the corner of a pixel if pixels are areas, its center otherwise.
+    margin = 0.0 if keys.get(KEY_RASTER_TYPE) == RASTER_PIXEL_IS_POINT else 0.5
+    north = lat + (row - margin) * scale_y
+    west = lng - (column - margin) * scale_x
+    nodata = None
+    if TAG_GDAL_NODATA in tags:
+        nodata = float(tags[TAG_GDAL_NODATA][0])
+    data = np.memmap(path, dtype=dtype, mode='r', offset=offsets[0], shape=(height, width))
+    return DemTile(path, data, north, west, scale_y, scale_x, nodata=nodata, margin=margin)
+
+
+def read_dem(path):
+    # type: (str) -> DemTile
+    if path.lower().endswith('.hgt'):
+        return read_hgt(path)
+    return read_geotiff(path)
+
+
+def find_dem_files(paths):
+    # type: (Sequence[str]) -> List[str]
+    # Expand directories into the DEM files they contain.
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if name.lower().endswith(DEM_EXTENSIONS)))
+        else:
+            files.append(path)
+    return files
+
+
+class DemProvider(ElevationProvider):
+    # Where tiles overlap, first tile wins.
+    __slots__ = ('tiles',)
+    remote = False
+    max_samples = SAMPLES_PER_BLOCK
+
+    def __init__(self, tiles):
+        # type: (List[DemTile]) -> None
+        self.tiles = tiles
+
+    @classmethod
+    def from_paths(cls, paths):
+        # type: (Sequence[str]) -> DemProvider
+        tiles = [read_dem(path) for path in find_dem_files(paths)]
+        if not tiles:
+            raise RuntimeError('No DEM file found in %s' % (list(paths),))
+        return cls(tiles)
+
+    def sample_grid(self, latitudes, longitudes):
+        # type: (np.ndarray, np.ndarray) -> Tuple[np.ndarray, np.ndarray]
+        # Return (elevations, resolutions) for grid latitudes x longitudes, NaN where unknown.
+        elevations = np.full((len(latitudes), len(longitudes)), np.nan)
+        resolutions = np.full((len(latitudes), len(longitudes)), np.nan)
+        for tile in self.tiles:
+            north, south, west, east = tile.bounds
+            rows = np.flatnonzero((latitudes >= south) & (latitudes <= north))
+            columns = np.flatnonzero((longitudes >= west) & (longitudes <= east))
+            if not len(rows) or not len(columns):
+                continue
+            window = np.ix_(rows, columns)
+            current = elevations[window]
+            missing = np.isnan(current)
+            if not missing.any():
+                continue
+            values = tile.interpolate(latitudes[rows], longitudes[columns])
+            current[missing] = values[missing]
+            elevations[window] = current
+            current_resolutions = resolutions[window]
+            current_resolutions[missing & ~np.isnan(values)] = tile.resolution
+            resolutions[window] = current_resolutions
+        return elevations, resolutions
+
+    def fetch(self, latitudes, longitudes, queries, on_result):
+        # Queries are expected by increasing row: grid is sampled once per block of rows.
+        rows_per_block = max(1, SAMPLES_PER_BLOCK // max(1, len(longitudes)))
+        block_start = block_end = 0
+        elevations = resolutions = None
+        for query in queries:
+            values = []
+            for row, column, length in query.spans:
+                if elevations is None or not block_start <= row < block_end:
+                    block_start = row
+                    block_end = min(len(latitudes), row + rows_per_block)
+                    elevations, resolutions = self.sample_grid(
+                        latitudes[block_start:block_end], longitudes)
+                values.append(np.stack(
+                    (elevations[row - block_start, column:(column + length)],
+                     resolutions[row - block_start, column:(column + length)]), axis=1))
+            on_result(query, values[0] if len(values) == 1 else np.concatenate(values))
+
+    def __str__(self):
+        return 'DemProvider(%d tile(s))' % len(self.tiles)
@@ -0,0 +1,338 @@
+"""Local stand-in for the Google elevation API, for repeatable throughput tests.
+
+Serves `path`/`samples` and `locations` forms of the elevation JSON API (at any URL path
+ending with /json) over keep-alive HTTP/1.1, with elevations from a synthetic terrain
+function. Each response is delayed by a latency drawn from a configurable distribution
+(plus an optional cost per sample), and can fail at configurable rates with HTTP errors or
+OVER_QUERY_LIMIT / UNKNOWN_ERROR API statuses. Requests above a QPS cap are answered with
+OVER_QUERY_LIMIT, like the real API. GET /stats returns server counters as JSON.
+
+Example: python -m pyccai.heightmap ... --base-url http://127.0.0.1:8765/json
+"""
+import argparse
+import asyncio
+import collections
+import math
+import random
+import time
+import urllib.parse
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+import ujson as json
+
+from pyccai.elevation import MAX_SAMPLES_PER_REQUEST, MAX_URL_LENGTH
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+SYNTHETIC_RESOLUTION = 4.77
+LATENCY_DISTRIBUTIONS = ('constant', 'uniform', 'normal', 'lognormal', 'exponential')
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 414: 'URI Too Long',
+                500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+def synthetic_elevations(latitudes, longitudes):
+    # type: (np.ndarray, np.ndarray) -> np.ndarray
+    # Smooth deterministic relief, in about [-45, 65] meters, with features of a few
+    # hundred meters to a few kilometers.
+    return (10.0
+            + 35.0 * np.sin(latitudes * 157.0) * np.cos(longitudes * 113.0)
+            + 15.0 * np.sin(latitudes * 911.0 + longitudes * 677.0)
+            + 5.0 * np.cos(latitudes * 3079.0 - longitudes * 2311.0))
+
+
+async def handle_http_connection(respond, reader, writer):
+    # type: (Callable, asyncio.StreamReader, asyncio.StreamWriter) -> None
+    # Serve GET requests of a keep-alive connection until client closes it, answering each
+    # with JSON body from await respond(target, host) -> (HTTP status, body).
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, value = line.decode('latin-1').split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            pieces = request_line.decode('latin-1').split()
+            if len(pieces) < 2 or pieces[0] != 'GET':
+                status, body = 400, b''
+            else:
+                status, body = await respond(pieces[1], headers.get('host', ''))
+            keep_alive = headers.get('connection', '').lower() != 'close'
+            writer.write((
+                'HTTP/1.1 %d %s\r\n'
+                'Content-Type: application/json\r\n'
+                'Content-Length: %d\r\n'
+                'Connection: %s\r\n\r\n' % (
+                    status, HTTP_REASONS.get(status, ''), len(body),
+                    'keep-alive' if keep_alive else 'close')).encode() + body)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+class LatencyModel:
+    # Response delay, in seconds: a random base latency of given mean and spread,
+    # plus per_sample seconds for each sample returned.
+    # - constant: mean;
+    # - uniform: uniform in [mean - spread, mean + spread];
+    # - normal: normal of standard deviation spread;
+    # - lognormal: log-normal of standard deviation spread (long right tail);
+    # - exponential: exponential (spread is ignored).
+    # Negative latencies are clipped to 0.
+    __slots__ = ('distribution', 'mean', 'spread', 'per_sample', 'random')
+
+    def __init__(self, distribution='constant', mean=0.0, spread=0.0, per_sample=0.0, seed=None):
+        # type: (str, float, float, float, Optional[int]) -> None
+        if distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError('Unknown latency distribution: %s' % distribution)
+        self.distribution = distribution
+        self.mean = mean
+        self.spread = spread
+        self.per_sample = per_sample
+        self.random = random.Random(seed)
+
+    def _base(self):
+        if self.mean <= 0 or self.distribution == 'constant':
+            return self.mean
+        if self.distribution == 'uniform':
+            return self.random.uniform(self.mean - self.spread, self.mean + self.spread)
+        if self.distribution == 'normal':
+            return self.random.gauss(self.mean, self.spread)
+        if self.distribution == 'lognormal':
+            sigma_2 = math.log(1 + (self.spread / self.mean) ** 2)
+            return self.random.lognormvariate(math.log(self.mean) - sigma_2 / 2,
+                                              math.sqrt(sigma_2))
+        return self.random.expovariate(1 / self.mean)
+
+    def sample(self, nb_samples=0):
+        # type: (int) -> float
+        return max(0.0, self._base() + self.per_sample * nb_samples)
+
+    def __str__(self):
+        return 'LatencyModel(%s, mean=%s, spread=%s, per_sample=%s)' % (
+            self.distribution, self.mean, self.spread, self.per_sample)
+
+
+class ServerStatistics:
+    __slots__ = ('start', 'nb_requests', 'nb_samples', 'statuses')
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.nb_requests = 0
+        self.nb_samples = 0
+        # Number of responses per API status, or per HTTP status for HTTP errors.
+        self.statuses = {}  # type: Dict[str, int]
+
+    def add(self, status, nb_samples=0):
+        # type: (str, int) -> None
+        self.nb_requests += 1
+        self.nb_samples += nb_samples
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def to_json(self):
+        duration = time.monotonic() - self.start
+        return {
+            'seconds': duration,
+            'requests': self.nb_requests,
+            'samples': self.nb_samples,
+            'requests_per_second': self.nb_requests / duration if duration else 0,
+            'samples_per_second': self.nb_samples / duration if duration else 0,
+            'statuses': self.statuses,
+        }
+
+    def __str__(self):
+        return '%d request(s), %d sample(s), statuses %s' % (
+            self.nb_requests, self.nb_samples, self.statuses)
+
+
+class ElevationServer:
+    # Failure rates are probabilities per request, checked in this order:
+    # HTTP error (http_error_status), OVER_QUERY_LIMIT, UNKNOWN_ERROR.
+    # If qps is set, requests beyond qps answered requests in last second get
+    # OVER_QUERY_LIMIT.
+    __slots__ = ('latency', 'http_error_rate', 'http_error_status', 'over_query_limit_rate',
+                 'unknown_error_rate', 'qps', 'random', 'answered', 'statistics', 'verbose')
+
+    def __init__(self, latency=None, http_error_rate=0.0, http_error_status=503,
+                 over_query_limit_rate=0.0, unknown_error_rate=0.0, qps=None, seed=None,
+                 verbose=False):
+        self.latency = latency or LatencyModel()
+        self.http_error_rate = http_error_rate
+        self.http_error_status = http_error_status
+        self.over_query_limit_rate = over_query_limit_rate
+        self.unknown_error_rate = unknown_error_rate
+        self.qps = qps
+        self.random = random.Random(seed)
+        # Times of requests answered during last second, for QPS cap.
+        self.answered = collections.deque()
+        self.statistics = ServerStatistics()
+        self.verbose = verbose
+
+    def _over_qps(self):
+        # type: () -> bool
+        if not self.qps:
+            return False
+        now = time.monotonic()
+        while self.answered and self.answered[0] < now - 1:
+            self.answered.popleft()
+        if len(self.answered) >= self.qps:
+            return True
+        self.answered.append(now)
+        return False
+
+    def _injected_error(self):
+        # type: () -> Optional[str]
+        draw = self.random.random()
+        if draw < self.http_error_rate:
+            return str(self.http_error_status)
+        draw -= self.http_error_rate
+        if draw < self.over_query_limit_rate:
+            return 'OVER_QUERY_LIMIT'
+        draw -= self.over_query_limit_rate
+        if draw < self.unknown_error_rate:
+            return 'UNKNOWN_ERROR'
+        return None
+
+    @staticmethod
+    def _parse_points(query):
+        # type: (Dict[str, list]) -> Tuple[np.ndarray, np.ndarray]
+        # Return (latitudes, longitudes) of requested samples. Raise ValueError on invalid
+        # request.
+        if 'path' in query:
+            positions = query['path'][0].split('|')
+            nb_samples = int(query['samples'][0])
+            if len(positions) != 2 or not 2 <= nb_samples <= MAX_SAMPLES_PER_REQUEST:
+                raise ValueError()
+            (from_lat, from_lng), (to_lat, to_lng) = (
+                [float(value) for value in position.split(',')] for position in positions)
+            return (np.linspace(from_lat, to_lat, nb_samples),
+                    np.linspace(from_lng, to_lng, nb_samples))
+        if 'locations' in query:
+            coordinates = np.array([[float(value) for value in location.split(',')]
+                                    for location in query['locations'][0].split('|')])
+            if coordinates.ndim != 2 or coordinates.shape[1] != 2 or (
+                    len(coordinates) > MAX_SAMPLES_PER_REQUEST):
+                raise ValueError()
+            return coordinates[:, 0], coordinates[:, 1]
+        raise ValueError()
+
+    async def respond(self, target, host=''):
+        # type: (str, str) -> Tuple[int, bytes]
+        # Return HTTP status and JSON body for a request target.
+        parsed = urllib.parse.urlsplit(target)
+        if parsed.path == '/stats':
+            return 200, json.dumps(self.statistics.to_json()).encode()
+        if not parsed.path.endswith('/json'):
+            self.statistics.add('404')
+            return 404, b''
+        if len('http://%s%s' % (host, target)) > MAX_URL_LENGTH:
+            self.statistics.add('414')
+            return 414, b''
+        try:
+            latitudes, longitudes = self._parse_points(urllib.parse.parse_qs(parsed.query))
+        except (ValueError, KeyError):
+            await asyncio.sleep(self.latency.sample())
+            self.statistics.add('INVALID_REQUEST')
+            return 400, json.dumps({'status': 'INVALID_REQUEST', 'results': []}).encode()
+        error = self._injected_error()
+        if error is None and self._over_qps():
+            error = 'OVER_QUERY_LIMIT'
+        if error is not None:
+            await asyncio.sleep(self.latency.sample())
+            self.statistics.add(error)
+            if error.isdigit():
+                return int(error), b''
+            return 200, json.dumps({'status': error, 'results': []}).encode()
+        nb_samples = len(latitudes)
+        await asyncio.sleep(self.latency.sample(nb_samples))
+        elevations = synthetic_elevations(latitudes, longitudes)
+        body = json.dumps({'status': 'OK', 'results': [
+            {'elevation': elevation, 'location': {'lat': lat, 'lng': lng},
+             'resolution': SYNTHETIC_RESOLUTION}
+            for elevation, lat, lng in zip(elevations.tolist(), latitudes.tolist(),
+                                           longitudes.tolist())]}).encode()
+        self.statistics.add('OK', nb_samples)
+        if self.verbose and self.statistics.nb_requests % 1000 == 0:
+            print('Served', self.statistics)
+        return 200, body
+
+    async def handle_connection(self, reader, writer):
+        # type: (asyncio.StreamReader, asyncio.StreamWriter) -> None
+        await handle_http_connection(self.respond, reader, writer)
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT, on_started=None):
+        # Serve forever. If given, on_started(port) is called once server listens.
+        server = await asyncio.start_server(self.handle_connection, host, port, backlog=1024)
+        port = server.sockets[0].getsockname()[1]
+        print('Elevation server listening on http://%s:%d/json' % (host, port))
+        if on_started is not None:
+            on_started(port)
+        async with server:
+            await server.serve_forever()
+
+
+def add_server_arguments(parser):
+    # Add elevation server behaviour options to an argparse parser.
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Mean response latency, in seconds (default: 0).')
+    parser.add_argument('--latency-spread', type=float, default=0.0,
+                        help='Latency spread (standard deviation, or half-width for uniform '
+                             'distribution), in seconds.')
+    parser.add_argument('--latency-distribution', type=str, default='constant',
+                        choices=LATENCY_DISTRIBUTIONS,
+                        help='Latency distribution (default: constant).')
+    parser.add_argument('--latency-per-sample', type=float, default=0.0,
+                        help='Additional latency per returned sample, in seconds.')
+    parser.add_argument('--http-error-rate', type=float, default=0.0,
+                        help='Fraction of requests answered with an HTTP error.')
+    parser.add_argument('--http-error-status', type=int, default=503,
+                        help='HTTP status of injected HTTP errors (default: 503).')
+    parser.add_argument('--over-query-limit-rate', type=float, default=0.0,
+                        help='Fraction of requests answered with OVER_QUERY_LIMIT status.')
+    parser.add_argument('--unknown-error-rate', type=float, default=0.0,
+                        help='Fraction of requests answered with UNKNOWN_ERROR status.')
+    parser.add_argument('--server-qps', type=float, default=0,
+                        help='Maximum number of requests answered per second; requests beyond '
+                             'get OVER_QUERY_LIMIT (default: 0, no limit).')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Random seed for latencies and injected errors.')
+
+
+def server_from_arguments(args, verbose=False):
+    # type: (argparse.Namespace, bool) -> ElevationServer
+    return ElevationServer(
+        LatencyModel(args.latency_distribution, args.latency, args.latency_spread,
+                     args.latency_per_sample, args.seed),
+        args.http_error_rate, args.http_error_status, args.over_query_limit_rate,
+        args.unknown_error_rate, args.server_qps or None, args.seed, verbose)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Serve a local stand-in of the elevation API, from synthetic terrain.')
+    parser.add_argument('--host', type=str, default=DEFAULT_HOST,
+                        help='Host to listen on (default: %s).' % DEFAULT_HOST)
+    parser.add_argument('--port', '-p', type=int, default=DEFAULT_PORT,
+                        help='Port to listen on (default: %d).' % DEFAULT_PORT)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    server = server_from_arguments(args, verbose=True)
+    print(server.latency)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    print('Served', server.statistics)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+"""Check heightmap and map_to_image fetch paths against local stand-in servers.
+
+heightmap and map_to_image are run as commands on a small region, against servers started
+in separate processes on free ports: a pyccai.elevation_server, and a static map server
+whose pixel colors encode their world pixel coordinates. Checks that:
+- elevation requests reuse keep-alive connections;
+- a heightmap fetched with injected HTTP errors, OVER_QUERY_LIMIT and UNKNOWN_ERROR statuses
+  (all retried) equals a clean fetch;
+- a heightmap fetch interrupted by an error, then resumed from its journal, equals a clean
+  fetch;
+- fetching a heightmap again with a filled cache sends no request, and gives same grid;
+- static maps are stitched in place (each image pixel has color of its world pixel), and
+  fetching again is served from static map cache.
+Exit status is 1 if any check fails.
+"""
+import argparse
+import asyncio
+import io
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import urllib.parse
+from typing import List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from pyccai.elevation_server import DEFAULT_HOST, add_server_arguments, handle_http_connection
+from pyccai.grid import load_map, read_map_metadata
+from pyccai.loadtest import SERVER_START_TIMEOUT, start_local_server
+from pyccai.map_to_image import static_map_zoom, world_pixels
+from pyccai.tiles import TILE_SIZE, lat_to_tile_y, lng_to_tile_x
+
+# North-west and south-east corners of checked region, and its resolution in meters.
+REGION = ('45.5', '-73.6', '45.48', '-73.56')
+RESOLUTION = 30
+CONCURRENCY = 8
+# Injected errors, all transient, retried at most FAULT_MAX_RETRIES times.
+FAULT_OPTIONS = ('--http-error-rate', '0.2', '--over-query-limit-rate', '0.1',
+                 '--unknown-error-rate', '0.05', '--seed', '1')
+FAULT_MAX_RETRIES = 30
+# Errors interrupting a fetch sent one request at a time, without retries.
+INTERRUPT_OPTIONS = ('--http-error-rate', '0.1', '--seed', '3')
+# Static maps are fetched at this many zoom levels above default, so that several are stitched.
+STATIC_MAP_EXTRA_ZOOM = 4
+SENT = re.compile(r'Sent (\d+) request\(s\) on (\d+) connection\(s\)')
+CACHE_HITS = re.compile(r'Cache hits: (\d+) / (\d+)')
+
+
+class CheckResult:
+    __slots__ = ('name', 'ok', 'detail')
+
+    def __init__(self, name, ok, detail=''):
+        # type: (str, bool, str) -> None
+        self.name = name
+        self.ok = ok
+        self.detail = detail
+
+    def __str__(self):
+        return '%s %s%s' % ('OK' if self.ok else 'FAILED', self.name,
+                            ' (%s)' % self.detail if self.detail else '')
+
+
+def run_module(module, *arguments):
+    # type: (str, str) -> Tuple[int, str]
+    # Run python -m pyccai.<module> with arguments. Return exit status and output.
+    environment = dict(os.environ)
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment['PYTHONPATH'] = os.pathsep.join(
+        path for path in (package_parent, environment.get('PYTHONPATH')) if path)
+    completed = subprocess.run(
+        [sys.executable, '-m', 'pyccai.%s' % module] + list(arguments), env=environment,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    return completed.returncode, completed.stdout
+
+
+def start_elevation_server(*options):
+    # type: (str) -> Tuple[multiprocessing.Process, str]
+    # Start an elevation server with given command line options.
+    # Return process and its elevation API URL.
+    parser = argparse.ArgumentParser()
+    add_server_arguments(parser)
+    return start_local_server(parser.parse_args(list(options)))
+
+
+def fetch_heightmap(directory, name, base_url, *options):
+    # type: (str, str, str, str) -> Tuple[int, str, Optional[np.ndarray]]
+    # Run heightmap on checked region into <name>.grid in directory.
+    # Return exit status, output, and (elevations, resolutions) array if successful.
+    grid_path = os.path.join(directory, '%s.grid' % name)
+    status, output = run_module(
+        'heightmap', *REGION, '--resolution', str(RESOLUTION),
+        '--concurrency', str(CONCURRENCY), '--base-url', base_url,
+        '--output', os.path.join(directory, '%s.png' % name), '--grid', grid_path, *options)
+    if status:
+        return status, output, None
+    grid = load_map(grid_path)
+    return status, output, np.stack((grid.altitudes, grid.resolutions))
+
+
+def world_pixel_colors(ys, xs):
+    # type: (np.ndarray, np.ndarray) -> np.ndarray
+    # RGB colors encoding world pixel rows ys and columns xs: low bytes of column and row,
+    # then their next 4 bits.
+    ys, xs = np.meshgrid(np.asarray(ys, dtype=np.int64), np.asarray(xs, dtype=np.int64),
+                         indexing='ij')
+    return np.stack((xs % 256, ys % 256, (xs // 256 % 16) * 16 + ys // 256 % 16),
+                    axis=-1).astype(np.uint8)
+
+
+async def respond_static_map(target, host=''):
+    # type: (str, str) -> Tuple[int, bytes]
+    # Answer a static map request (center, zoom, size) with a PNG image of world pixel colors.
+    parameters = urllib.parse.parse_qs(urllib.parse.urlsplit(target).query)
+    try:
+        lat, lng = (float(value) for value in parameters['center'][0].split(','))
+        zoom = int(parameters['zoom'][0])
+        width, height = (int(value) for value in parameters['size'][0].split('x'))
+    except (KeyError, ValueError):
+        return 400, b''
+    x = int(round(float(lng_to_tile_x(lng, zoom)) * TILE_SIZE - width / 2))
+    y = int(round(float(lat_to_tile_y(lat, zoom)) * TILE_SIZE - height / 2))
+    output = io.BytesIO()
+    Image.fromarray(world_pixel_colors(y + np.arange(height), x + np.arange(width))).save(
+        output, 'PNG')
+    return 200, output.getvalue()
+
+
+def _run_static_map_server(connection):
+    # Server process: serve static maps on a free port, and send port through connection.
+    async def serve():
+        server = await asyncio.start_server(
+            lambda reader, writer: handle_http_connection(respond_static_map, reader, writer),
+            DEFAULT_HOST, 0)
+        connection.send(server.sockets[0].getsockname()[1])
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+def start_static_map_server():
+    # type: () -> Tuple[multiprocessing.Process, str]
+    # Start a static map server process. Return process and its static map API URL.
+    parent_connection, child_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_run_static_map_server, args=(child_connection,),
+                                      daemon=True)
+    process.start()
+    if not parent_connection.poll(SERVER_START_TIMEOUT):
+        process.terminate()
+        raise RuntimeError('Static map server did not start')
+    return process, 'http://%s:%d/staticmap' % (DEFAULT_HOST, parent_connection.recv())
+
+
+def check_heightmap(directory):
+    # type: (str) -> Tuple[List[CheckResult], Optional[str]]
+    # Run heightmap checks. Return results, and clean heightmap grid path if fetched.
+    results = []
+    processes = []
+    try:
+        process, clean_url = start_elevation_server()
+        processes.append(process)
+        process, faulty_url = start_elevation_server(*FAULT_OPTIONS)
+        processes.append(process)
+        process, interrupting_url = start_elevation_server(*INTERRUPT_OPTIONS)
+        processes.append(process)
+
+        status, output, expected = fetch_heightmap(directory, 'clean', clean_url, '--no-journal')
+        if expected is None:
+            results.append(CheckResult('clean fetch', False, 'exit status %d' % status))
+            print(output)
+            return results, None
+        sent = SENT.search(output)
+        nb_requests, nb_connections = (int(value) for value in sent.groups())
+        results.append(CheckResult(
+            'keep-alive connections', nb_connections <= CONCURRENCY < nb_requests,
+            '%d request(s) on %d connection(s)' % (nb_requests, nb_connections)))
+
+        status, output, values = fetch_heightmap(
+            directory, 'faulty', faulty_url, '--no-journal',
+            '--max-retries', str(FAULT_MAX_RETRIES))
+        scheduler = re.search(r'RequestScheduler\(.*\)', output)
+        results.append(CheckResult(
+            'retried injected errors', values is not None and np.array_equal(values, expected),
+            scheduler.group(0) if scheduler else 'exit status %d' % status))
+
+        journal_path = os.path.join(directory, 'resumed.journal')
+        status, _, _ = fetch_heightmap(
+            directory, 'resumed', interrupting_url, '--journal', journal_path,
+            '--concurrency', '1', '--max-retries', '0')
+        if not status or not os.path.isfile(journal_path):
+            results.append(CheckResult('journal resume', False, 'fetch was not interrupted'))
+        else:
+            status, output, values = fetch_heightmap(
+                directory, 'resumed', clean_url, '--journal', journal_path)
+            resumed = re.search(r'Resuming from journal .* with (\d+) point', output)
+            results.append(CheckResult(
+                'journal resume',
+                resumed is not None and values is not None and np.array_equal(values, expected),
+                '%s point(s) journaled' % (resumed.group(1) if resumed else 'no')))
+
+        cache_path = os.path.join(directory, 'cache.sqlite')
+        _, _, first = fetch_heightmap(directory, 'cached', clean_url, '--no-journal',
+                                      '--cache', cache_path)
+        _, output, second = fetch_heightmap(directory, 'cached', clean_url, '--no-journal',
+                                            '--cache', cache_path)
+        sent = SENT.search(output)
+        results.append(CheckResult(
+            'cache', (first is not None and second is not None and sent is not None
+                      and int(sent.group(1)) == 0 and np.array_equal(first, second)),
+            sent.group(0) if sent else 'no request summary'))
+    finally:
+        for process in processes:
+            process.terminate()
+    return results, os.path.join(directory, 'clean.grid')
+
+
+def check_static_maps(directory, grid_path):
+    # type: (str, str) -> List[CheckResult]
+    results = []
+    process, base_url = start_static_map_server()
+    try:
+        metadata = read_map_metadata(grid_path)
+        zoom = static_map_zoom(metadata) + STATIC_MAP_EXTRA_ZOOM
+        ys, xs = world_pixels(metadata, zoom)
+        expected = world_pixel_colors(ys, xs)
+        output_name = os.path.join(directory, 'static')
+        cache_path = os.path.join(directory, 'static_maps')
+        for name in ('stitched static maps', 'static map cache'):
+            status, output = run_module(
+                'map_to_image', grid_path, output_name, '--zoom', str(zoom),
+                '--base-url', base_url, '--concurrency', str(CONCURRENCY), '--cache', cache_path)
+            hits = CACHE_HITS.search(output)
+            if status or hits is None:
+                results.append(CheckResult(name, False, 'exit status %d' % status))
+                print(output)
+                break
+            pixels = np.asarray(Image.open('%s.png' % output_name).convert('RGB'))
+            ok = np.array_equal(pixels, expected)
+            if name == 'static map cache':
+                ok = ok and hits.group(1) == hits.group(2)
+            results.append(CheckResult(name, ok, hits.group(0)))
+    finally:
+        process.terminate()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Check heightmap and map_to_image fetch paths against local stand-in servers.')
+    parser.add_argument('--directory', type=str, default=None,
+                        help='Directory where outputs are written (default: a temporary '
+                             'directory, removed at end).')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        directory = args.directory or temporary_directory
+        os.makedirs(directory, exist_ok=True)
+        results, grid_path = check_heightmap(directory)
+        if grid_path is not None:
+            results.extend(check_static_maps(directory, grid_path))
+    for result in results:
+        print(result)
+    if not all(result.ok for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
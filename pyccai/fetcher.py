@@ -0,0 +1,215 @@
+"""Asynchronous HTTP GET fetcher with keep-alive connection pooling.
+
+Minimal HTTP/1.1 client over asyncio streams (standard library only). Connections are
+kept open and reused across requests to the same host, so a run of many queries to
+the same API pays TCP/TLS setup only once per connection. Number of in-flight requests
+is bounded by fetch_all() concurrency, not by number of processes.
+"""
+import asyncio
+import ssl
+import time
+import urllib.parse
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import ujson as json
+
+USER_AGENT = 'pyccai'
+DEFAULT_CONCURRENCY = 64
+DEFAULT_TIMEOUT = 60
+
+
+class HttpError(RuntimeError):
+    __slots__ = ('status',)
+
+    def __init__(self, status, message):
+        # type: (int, str) -> None
+        super().__init__('HTTP %s %s' % (status, message))
+        self.status = status
+
+
+class Connection:
+    __slots__ = ('reader', 'writer', 'reused')
+
+    def __init__(self, reader, writer):
+        # type: (asyncio.StreamReader, asyncio.StreamWriter) -> None
+        self.reader = reader
+        self.writer = writer
+        self.reused = False
+
+    def close(self):
+        self.writer.close()
+
+
+class ConnectionPool:
+    # Idle connections per (scheme, host, port).
+    __slots__ = ('idle', 'ssl_context', 'nb_opened')
+
+    def __init__(self):
+        self.idle = {}  # type: Dict[Tuple[str, str, int], List[Connection]]
+        self.ssl_context = None  # type: Optional[ssl.SSLContext]
+        self.nb_opened = 0
+
+    async def acquire(self, scheme, host, port):
+        # type: (str, str, int) -> Connection
+        connections = self.idle.get((scheme, host, port))
+        while connections:
+            connection = connections.pop()
+            if not connection.reader.at_eof():
+                connection.reused = True
+                return connection
+            connection.close()
+        if scheme == 'https':
+            if self.ssl_context is None:
+                self.ssl_context = ssl.create_default_context()
+            reader, writer = await asyncio.open_connection(
+                host, port, ssl=self.ssl_context, server_hostname=host)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        self.nb_opened += 1
+        return Connection(reader, writer)
+
+    def release(self, scheme, host, port, connection):
+        # type: (str, str, int, Connection) -> None
+        self.idle.setdefault((scheme, host, port), []).append(connection)
+
+    def close(self):
+        for connections in self.idle.values():
+            for connection in connections:
+                connection.close()
+        self.idle.clear()
+
+
+async def _read_body(reader, headers):
+    # type: (asyncio.StreamReader, Dict[str, str]) -> bytes
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size_line = await reader.readline()
+            size = int(size_line.split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                # Skip trailers.
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+    if 'content-length' in headers:
+        return await reader.readexactly(int(headers['content-length']))
+    return await reader.read()
+
+
+class AsyncFetcher:
+    # If latencies is a list, duration of each answered request (including connection
+    # setup), in seconds, is appended to it.
+    __slots__ = ('pool', 'timeout', 'nb_requests', 'latencies')
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, latencies=None):
+        # type: (float, Optional[List[float]]) -> None
+        self.pool = ConnectionPool()
+        self.timeout = timeout
+        self.nb_requests = 0
+        self.latencies = latencies
+
+    async def _request(self, connection, host, target):
+        # type: (Connection, str, str) -> Tuple[int, str, bytes, bool]
+        connection.writer.write((
+            'GET %s HTTP/1.1\r\n'
+            'Host: %s\r\n'
+            'User-Agent: %s\r\n'
+            'Accept-Encoding: identity\r\n'
+            'Connection: keep-alive\r\n\r\n' % (target, host, USER_AGENT)).encode())
+        await connection.writer.drain()
+        status_line = await connection.reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed by server')
+        pieces = status_line.decode('latin-1').split(None, 2)
+        status = int(pieces[1])
+        reason = pieces[2].strip() if len(pieces) > 2 else ''
+        headers = {}
+        while True:
+            line = await connection.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, value = line.decode('latin-1').split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+        body = await _read_body(connection.reader, headers)
+        keep_alive = (headers.get('connection', '').lower() != 'close'
+                      and ('content-length' in headers or 'transfer-encoding' in headers))
+        return status, reason, body, keep_alive
+
+    async def get(self, url):
+        # type: (str) -> bytes
+        parsed = urllib.parse.urlsplit(url)
+        scheme = parsed.scheme
+        host = parsed.hostname
+        port = parsed.port or (443 if scheme == 'https' else 80)
+        host_header = parsed.netloc
+        target = parsed.path or '/'
+        if parsed.query:
+            target = '%s?%s' % (target, parsed.query)
+        start = time.perf_counter()
+        while True:
+            connection = await self.pool.acquire(scheme, host, port)
+            try:
+                status, reason, body, keep_alive = await asyncio.wait_for(
+                    self._request(connection, host_header, target), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                connection.close()
+                if connection.reused:
+                    # Server closed an idle keep-alive connection: retry on a new one.
+                    continue
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            break
+        self.nb_requests += 1
+        if self.latencies is not None:
+            self.latencies.append(time.perf_counter() - start)
+        if keep_alive:
+            self.pool.release(scheme, host, port, connection)
+        else:
+            connection.close()
+        if status != 200:
+            raise HttpError(status, reason)
+        return body
+
+    async def get_json(self, url):
+        # type: (str) -> Any
+        return json.loads((await self.get(url)).decode())
+
+    def close(self):
+        self.pool.close()
+
+
+async def fetch_all(fetcher, requests, handle, concurrency=DEFAULT_CONCURRENCY, scheduler=None,
+                    binary=False, parse=None):
+    # type: (AsyncFetcher, Iterable[Tuple[Any, str]], Callable, int, Any, bool, Any) -> None
+    # Fetch JSON for each (key, url) of requests, with at most `concurrency` requests
+    # in flight, and call handle(key, decoded_json) as each response arrives.
+    # If binary is True, handle receives raw response body instead.
+    # If parse is given, handle receives parse(key, response) instead: errors raised by
+    # parse (e.g. API error statuses) are errors of the request.
+    # Requests are pulled lazily from the iterable as workers become free.
+    # If a scheduler (ratelimit.RequestScheduler) is given, it paces, limits and retries
+    # each request, then handles its result once.
+    iterator = iter(requests)
+    get = fetcher.get if binary else fetcher.get_json
+
+    async def fetch(key, url):
+        response = await get(url)
+        return response if parse is None else parse(key, response)
+
+    async def worker():
+        for key, url in iterator:
+            if scheduler is None:
+                handle(key, await fetch(key, url))
+            else:
+                await scheduler.run(lambda: fetch(key, url), lambda output: handle(key, output))
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(max(1, concurrency))]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
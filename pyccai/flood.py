@@ -1,21 +1,24 @@
+import argparse
+import bisect
 import math
+import multiprocessing
 import os
-import sys
-from typing import Dict, List, Iterable, Set, Callable, Any
+from typing import Dict, List, Iterable, Any, Optional, Tuple
 
+import numpy as np
 import ujson as json
 from PIL import Image
-from geopy.distance import geodesic
 
-from pyccai.profiling import Profiler
+from pyccai.geodesy import GEODESY
+from pyccai.grid import load_map, read_map_metadata
+from pyccai.labeling import (CONNECTIVITY_8, count_band_components, count_components,
+                             label_components)
+from pyccai.profiling import (Profiler, add_profiling_arguments, count, save_profiling,
+                              setup_profiling)
 
 LAT, LNG, ALT, RES = 0, 1, 2, 3
 
 KILOMETER = 1000
-DEMI_KM_HYPOTHENUS = (KILOMETER) * math.sqrt(2) / 2
-DEMI_KM_HYPOTHENUS_GEODESIC = geodesic(meters=DEMI_KM_HYPOTHENUS)
-DEMI_KILOMETER_GEODESIC = geodesic(meters=KILOMETER / 2)
-FULL_KILOMETER_GEODESIC = geodesic(meters=KILOMETER)
 
 ANGLE_WEST = -90
 ANGLE_NORTH = 0
@@ -25,14 +28,37 @@ ANGLE_SOUTH = 180
 RED = (255, 0, 0)
 BLUE = (0, 0, 255)
 YELLOW = (255, 255, 0)
+MARKER_COLOR = RED
+
+
+SELECTION_ROWS = 4096
+# Band processing (see below): minimum width of bands of longitudes, and maximum number of
+# rounds of band grouping before grouping serially.
+BAND_MIN_METERS = 2 * KILOMETER
+MAX_BAND_ROUNDS = 2
 
 
 def pixel_is_blue(pixel):
     return pixel[2] > pixel[0] and pixel[2] > pixel[1]
 
 
+def pixels_are_blue(pixels):
+    # type: (np.ndarray) -> np.ndarray
+    # Vectorized pixel_is_blue() over an array of RGB pixels.
+    return (pixels[..., 2] > pixels[..., 0]) & (pixels[..., 2] > pixels[..., 1])
+
+
+def pixels_are_markers(pixels):
+    # type: (np.ndarray) -> np.ndarray
+    # Markers are pure red pixels.
+    return ((pixels[..., 0] == MARKER_COLOR[0]) & (pixels[..., 1] == MARKER_COLOR[1])
+            & (pixels[..., 2] == MARKER_COLOR[2]))
+
+
 class MapImage:
-    __slots__ = 'width', 'height', 'pixels'
+    # RGB pixels as a (height, width, 3) uint8 array,
+    # with boolean (height, width) masks of water and marker pixels.
+    __slots__ = 'width', 'height', 'pixels', 'water', 'markers'
 
     def __init__(self, path):
         image = Image.open(path)
@@ -41,17 +67,65 @@ class MapImage:
         width, height = image.size
         self.width = width
         self.height = height
-        self.pixels = list(image.getdata())
+        self.pixels = np.asarray(image)
+        self.water = pixels_are_blue(self.pixels)
+        self.markers = pixels_are_markers(self.pixels)
+
+    def marker_positions(self):
+        # type: () -> List[Tuple[int, int]]
+        # Return (x, y) of marker pixels, row by row.
+        return [(x, y) for y, x in np.argwhere(self.markers).tolist()]
+
+    def crop(self, left, upper, right, lower):
+        # type: (int, int, int, int) -> Image.Image
+        return Image.fromarray(self.pixels[upper:lower, left:right])
+
+    def water_mask(self, grid):
+        # type: (Any) -> np.ndarray
+        # Resample image to map grid (nearest pixel), image top being north and left being west.
+        # Returns a boolean (grid.height, grid.width) array, True where pixel is water (blue).
+        rows = np.arange(grid.height)
+        if grid.lat_step >= 0:
+            rows = rows[::-1]
+        columns = np.arange(grid.width)
+        if grid.lng_step < 0:
+            columns = columns[::-1]
+        img_y = np.rint(rows * (self.height - 1) / max(grid.height - 1, 1)).astype(np.intp)
+        img_x = np.rint(columns * (self.width - 1) / max(grid.width - 1, 1)).astype(np.intp)
+        return self.water[np.ix_(img_y, img_x)]
+
+
+def select_flooded(altitudes, flood_threshold, water=None):
+    # type: (np.ndarray, float, Optional[np.ndarray]) -> np.ndarray
+    # Return boolean raster of flooded cells: (alt <= threshold) & ~water.
+    # Computed by blocks of rows to bound temporaries on memory-mapped grids.
+    flooded = np.empty(altitudes.shape, dtype=bool)
+    for start in range(0, altitudes.shape[0], SELECTION_ROWS):
+        end = start + SELECTION_ROWS
+        block = np.less_equal(altitudes[start:end], flood_threshold, out=flooded[start:end])
+        if water is not None:
+            block &= ~water[start:end]
+    return flooded
+
+
+def flooded_points(grid, flooded):
+    # type: (Any, np.ndarray) -> List[Point]
+    latitudes = grid.latitudes
+    longitudes = grid.longitudes
+    rows, columns = np.nonzero(flooded)
+    return [Point(lat, lng, alt) for lat, lng, alt in zip(
+        latitudes[rows].tolist(),
+        longitudes[columns].tolist(),
+        grid.altitudes[rows, columns].tolist())]
 
 
 class Point:
-    __slots__ = ('lat', 'lng', 'alt', 'neighbors')
+    __slots__ = ('lat', 'lng', 'alt')
 
     def __init__(self, lat, lng, alt):
         self.lat = lat
         self.lng = lng
         self.alt = alt
-        self.neighbors = {}
 
     @property
     def position(self):
@@ -72,14 +146,9 @@ class Point:
     def __repr__(self):
         return str(self)
 
-    def connect(self, point, weight):
-        # type: (Point, float) -> None
-        self.neighbors[point] = weight
-        point.neighbors[self] = weight
-
 
 class Bounds:
-    __slots__ = ('north', 'south', 'east', 'west', 'nb_points')
+    __slots__ = ('north', 'south', 'east', 'west', 'nb_points', 'cached_width', 'cached_height')
     north: float
     south: float
     east: float
@@ -92,6 +161,22 @@ class Bounds:
         self.west = min(pt.lng for pt in points)
         self.east = max(pt.lng for pt in points)
         self.nb_points = len(points)
+        self.cached_width = None
+        self.cached_height = None
+
+    @staticmethod
+    def from_extents(north, south, west, east, nb_points):
+        # type: (float, float, float, float, int) -> Bounds
+        # Bounds of nb_points points with given extents.
+        bounds = Bounds.__new__(Bounds)
+        bounds.north = north
+        bounds.south = south
+        bounds.west = west
+        bounds.east = east
+        bounds.nb_points = nb_points
+        bounds.cached_width = None
+        bounds.cached_height = None
+        return bounds
 
     def to_json(self):
         return [self.north, self.south, self.west, self.east]
@@ -114,13 +199,17 @@ class Bounds:
 
     @property
     def width(self):
-        return max(geodesic(self.north_west, self.north_east).meters,
-                   geodesic(self.south_west, self.south_east).meters)
+        if self.cached_width is None:
+            self.cached_width = max(GEODESY.parallel_distance(self.north, self.west, self.east),
+                                    GEODESY.parallel_distance(self.south, self.west, self.east))
+        return self.cached_width
 
     @property
     def height(self):
-        return max(geodesic(self.north_west, self.south_west).meters,
-                   geodesic(self.north_east, self.south_east).meters)
+        # Meridian distance does not depend on longitude.
+        if self.cached_height is None:
+            self.cached_height = GEODESY.meridian_distance(self.south, self.north)
+        return self.cached_height
 
     def __str__(self):
         return 'Rectangle(north_west=%s, nb=%d, width=%s, height=%s)' % (
@@ -141,52 +230,113 @@ class Cases:
 
 
 class Coordinates:
-    __slots__ = ('map_north', 'map_south', 'map_west', 'map_east', 'coordinates')
+    # Spatial index of points: rows of points sorted by latitude, each row sorted by longitude.
+    # Points can be removed in place, and map bounds are kept up to date for remaining points.
+    __slots__ = ('coordinates', 'latitudes', 'row_longitudes', 'longitudes', 'longitude_counts',
+                 'nb_points')
 
     def __init__(self, points):
         # type: (Iterable[Point]) -> None
-        self.map_north = None
-        self.map_south = None
-        self.map_west = None
-        self.map_east = None
         lat_to_points = {}  # type: Dict[float, List[Point]]
+        for point in points:
+            lat_to_points.setdefault(point.lat, []).append(point)
+        self.latitudes = sorted(lat_to_points)  # type: List[float]
+        self.coordinates = []  # type: List[List[Point]]
+        self.row_longitudes = []  # type: List[List[float]]
+        self.longitude_counts = {}  # type: Dict[float, int]
+        self.nb_points = 0
+        for lat in self.latitudes:
+            row = lat_to_points[lat]
+            row.sort()
+            self.coordinates.append(row)
+            self.row_longitudes.append([pt.lng for pt in row])
+            for pt in row:
+                self.longitude_counts[pt.lng] = self.longitude_counts.get(pt.lng, 0) + 1
+            self.nb_points += len(row)
+        self.longitudes = sorted(self.longitude_counts)  # type: List[float]
+
+    def __len__(self):
+        return self.nb_points
+
+    def __bool__(self):
+        return self.nb_points > 0
 
-        for i, point in enumerate(points):
-            if i == 0:
-                self.map_north = self.map_south = point.lat
-                self.map_west = self.map_east = point.lng
-            else:
-                if self.map_north < point.lat:
-                    self.map_north = point.lat
-                if self.map_south > point.lat:
-                    self.map_south = point.lat
-                if self.map_west > point.lng:
-                    self.map_west = point.lng
-                if self.map_east < point.lng:
-                    self.map_east = point.lng
+    @property
+    def map_north(self):
+        return self.latitudes[-1] if self.latitudes else None
+
+    @property
+    def map_south(self):
+        return self.latitudes[0] if self.latitudes else None
+
+    @property
+    def map_west(self):
+        return self.longitudes[0] if self.longitudes else None
+
+    @property
+    def map_east(self):
+        return self.longitudes[-1] if self.longitudes else None
+
+    def max_point(self):
+        # type: () -> Point
+        return self.coordinates[-1][-1]
+
+    def get_points_in_rectangle(self, north, south, west, east):
+        # type: (float, float, float, float) -> List[Point]
+        points = []
+        for i in range(bisect.bisect_left(self.latitudes, south),
+                       bisect.bisect_right(self.latitudes, north)):
+            row_longitudes = self.row_longitudes[i]
+            points.extend(self.coordinates[i][bisect.bisect_left(row_longitudes, west):
+                                              bisect.bisect_right(row_longitudes, east)])
+        return points
+
+    def remove(self, points):
+        # type: (Iterable[Point]) -> None
+        lat_to_points = {}  # type: Dict[float, List[Point]]
+        for point in points:
             lat_to_points.setdefault(point.lat, []).append(point)
-        for lat in lat_to_points:
-            lat_to_points[lat].sort()
-        self.coordinates = [lat_to_points[lat] for lat in sorted(lat_to_points)]
-
-
-def isolate_groups(points):
-    # type: (Iterable[Point]) -> List[Set[Point]]
-    points = set(points)
-    groups = []
-    while points:
-        point = points.pop()
-        neighbors = list(point.neighbors)
-        group = {point}
-        while neighbors:
-            neighbor = neighbors.pop()
-            if neighbor not in group:
-                group.add(neighbor)
-                if neighbor in points:
-                    neighbors.extend(neighbor.neighbors)
-                    points.remove(neighbor)
-        groups.append(group)
-    return groups
+        empty_rows = []
+        for lat, row_points in lat_to_points.items():
+            i = bisect.bisect_left(self.latitudes, lat)
+            if i == len(self.latitudes) or self.latitudes[i] != lat:
+                continue
+            row = self.coordinates[i]
+            row_longitudes = self.row_longitudes[i]
+            positions = []
+            for point in row_points:
+                j = bisect.bisect_left(row_longitudes, point.lng)
+                if j < len(row_longitudes) and row_longitudes[j] == point.lng:
+                    positions.append(j)
+            # Delete from the end, merging contiguous positions into slices.
+            positions = sorted(set(positions), reverse=True)
+            cursor = 0
+            while cursor < len(positions):
+                end = cursor
+                while end + 1 < len(positions) and positions[end + 1] == positions[end] - 1:
+                    end += 1
+                first, last = positions[end], positions[cursor]
+                for lng in row_longitudes[first:(last + 1)]:
+                    self._discard_longitude(lng)
+                del row[first:(last + 1)]
+                del row_longitudes[first:(last + 1)]
+                self.nb_points -= last + 1 - first
+                cursor = end + 1
+            if not row:
+                empty_rows.append(i)
+        for i in sorted(empty_rows, reverse=True):
+            del self.latitudes[i]
+            del self.coordinates[i]
+            del self.row_longitudes[i]
+
+    def _discard_longitude(self, lng):
+        # type: (float) -> None
+        count = self.longitude_counts[lng] - 1
+        if count:
+            self.longitude_counts[lng] = count
+        else:
+            del self.longitude_counts[lng]
+            del self.longitudes[bisect.bisect_left(self.longitudes, lng)]
 
 
 def in_rectangle(lat, lng, north, south, west, east):
@@ -201,175 +351,529 @@ def select_rectangle_centers(points):
     centers = []
     points = list(points)
     print('Group with', len(points), 'point(s)')
-    while points:
-        point = points.pop()
-        top = DEMI_KILOMETER_GEODESIC.destination(point.position, 0)
-        right = DEMI_KILOMETER_GEODESIC.destination(point.position, 90)
-        bottom = DEMI_KILOMETER_GEODESIC.destination(point.position, 180)
-        left = DEMI_KILOMETER_GEODESIC.destination(point.position, -90)
-        north = top.latitude
-        south = bottom.latitude
-        west = left.longitude
-        east = right.longitude
+    norths, souths, wests, easts = GEODESY.neighborhoods(
+        [pt.lat for pt in points], [pt.lng for pt in points], KILOMETER / 2)
+    positions = list(range(len(points)))
+    while positions:
+        position = positions.pop()
+        point = points[position]
+        north = norths[position]
+        south = souths[position]
+        west = wests[position]
+        east = easts[position]
         group = [point]
-        new_points = []
-        for neighbor in points:
+        new_positions = []
+        for neighbor_position in positions:
+            neighbor = points[neighbor_position]
             if in_rectangle(neighbor.lat, neighbor.lng, north, south, west, east):
                 group.append(neighbor)
             else:
-                new_points.append(neighbor)
+                new_positions.append(neighbor_position)
         bounds = Bounds(group)
-        points = new_points
+        positions = new_positions
         centers.append(bounds)
-        if points:
-            print('\tremaining', len(points))
+        if positions:
+            print('\tremaining', len(positions))
     return centers
 
 
-def find_position(sorted_array, value, getter, left=None):
-    # type: (List, Any, Callable[[List, int], Any], bool) -> int
-    if left is True and value < getter(sorted_array, 0) and left:
-        return -1
-    if left is False and getter(sorted_array, -1) < value:
-        return -1
-
-    a = 0
-    b = len(sorted_array) - 1
-    c = None
-    side = None
-    while a <= b:
-        c = int((a + b) / 2)
-        current = getter(sorted_array, c)
-        if current == value:
-            return c
-        if current < value:
-            a = c + 1
-            side = 1
+def neighborhood_box(lat, lng, map_north, map_south, map_west, map_east):
+    # type: (float, float, float, float, float, float) -> Tuple[float, float, float, float]
+    # Return bounds (north, south, west, east) of 1 Km neighbourhood of a point, moved inside
+    # map bounds when it crosses them.
+    north, south, west, east = GEODESY.neighborhood(lat, lng, KILOMETER / 2)
+    # A---B
+    # |   |
+    # D---C
+    a_in = in_rectangle(north, west, map_north, map_south, map_west, map_east)
+    b_in = in_rectangle(north, east, map_north, map_south, map_west, map_east)
+    c_in = in_rectangle(south, east, map_north, map_south, map_west, map_east)
+    d_in = in_rectangle(south, west, map_north, map_south, map_west, map_east)
+    case = a_in * 8 + b_in * 4 + c_in * 2 + d_in
+    if case != Cases.ABCD:
+        if case == Cases.A:
+            south = map_south
+            east = map_east
+            north = GEODESY.destination(south, east, KILOMETER, 0)[0]
+            west = GEODESY.destination(south, east, KILOMETER, -90)[1]
+        elif case == Cases.B:
+            south = map_south
+            west = map_west
+            north = GEODESY.destination(south, west, KILOMETER, 0)[0]
+            east = GEODESY.destination(south, west, KILOMETER, 90)[1]
+        elif case == Cases.C:
+            north = map_north
+            west = map_west
+            south = GEODESY.destination(north, west, KILOMETER, 180)[0]
+            east = GEODESY.destination(north, west, KILOMETER, 90)[1]
+        elif case == Cases.D:
+            north = map_north
+            east = map_east
+            west = GEODESY.destination(north, east, KILOMETER, -90)[1]
+            south = GEODESY.destination(north, east, KILOMETER, 180)[0]
+        elif case == Cases.AB:
+            south = map_south
+            north = GEODESY.destination(south, west, KILOMETER, 0)[0]
+        elif case == Cases.CD:
+            north = map_north
+            south = GEODESY.destination(north, west, KILOMETER, 180)[0]
+        elif case == Cases.AD:
+            east = map_east
+            west = GEODESY.destination(north, east, KILOMETER, -90)[1]
+        elif case == Cases.BC:
+            west = map_west
+            east = GEODESY.destination(north, west, KILOMETER, 90)[1]
         else:
-            b = c - 1
-            side = -1
-    if left is None:
-        return -1
-    if left and side < 0:
-        c = c - 1
-    elif not left and side > 0:
-        c = c + 1
-        if c == len(sorted_array):
-            c = -1
-    return c
-
-
-def get_latitude(coordinates, position):
-    # type: (List[List[Point]], int) -> float
-    return coordinates[position][0].lat
-
-
-def get_longitude(points, position):
-    # type: (List[Point], int) -> float
-    return points[position].lng
-
-
-def get_points_in_rectangle(coordinates, north, south, west, east):
-    # type: (List[List[Point]], float, float, float, float) -> List[Point]
-    points = []
-    position_south = find_position(coordinates, south, get_latitude, left=False)
-    position_north = find_position(coordinates, north, get_latitude, left=True)
-    if position_south < 0 or position_north < 0:
-        return points
-    for i in range(position_south, position_north + 1):
-        position_west = find_position(coordinates[i], west, get_longitude, left=False)
-        position_east = find_position(coordinates[i], east, get_longitude, left=True)
-        if position_west < 0 or position_east < 0:
-            continue
-        points.extend(coordinates[i][j] for j in range(position_west, position_east + 1))
-    return points
+            is_error = True
+            if case == 0:
+                # map_a_in = in_rectangle(map_north, map_west, north, south, west, east)
+                # map_b_in = in_rectangle(map_north, map_east, north, south, west, east)
+                # map_c_in = in_rectangle(map_south, map_east, north, south, west, east)
+                # map_d_in = in_rectangle(map_south, map_west, north, south, west, east)
+                # map_case = map_a_in * 8 + map_b_in * 4 + map_c_in * 2 + map_d_in
+                # is_error = map_case not in (Cases.A, Cases.B, Cases.C, Cases.D, Cases.AB, Cases.CD, Cases.AD, Cases.BC)
+                is_error = False
+            if is_error:
+                print('Point', (lat, lng))
+                print('Rect_', north, south, west, east)
+                print('Map__', map_north, map_south, map_west, map_east)
+                raise RuntimeError('Impossible case %s' % Cases.strings[case])
+    return north, south, west, east
 
 
 def get_neighbors(point, coords, in_map=False):
     # type: (Point, Coordinates, bool) -> List[Point]
     # Compute bounds of rectangles centered on point with 1 Km side.
-    # north_east = DEMI_KILOMETER_GEODESIC.destination(point.position, 45)
-    # south_west = DEMI_KILOMETER_GEODESIC.destination(point.position, 180 + 45)
-    # north = north_east.latitude
-    # south = south_west.latitude
-    # west = south_west.longitude
-    # east = north_east.longitude
-    north = DEMI_KILOMETER_GEODESIC.destination(point.position, 0).latitude
-    south = DEMI_KILOMETER_GEODESIC.destination(point.position, 180).latitude
-    west = DEMI_KILOMETER_GEODESIC.destination(point.position, -90).longitude
-    east = DEMI_KILOMETER_GEODESIC.destination(point.position, 90).longitude
     if in_map:
-        # A---B
-        # |   |
-        # D---C
-        a_in = in_rectangle(
-            north, west, coords.map_north, coords.map_south, coords.map_west, coords.map_east)
-        b_in = in_rectangle(
-            north, east, coords.map_north, coords.map_south, coords.map_west, coords.map_east)
-        c_in = in_rectangle(
-            south, east, coords.map_north, coords.map_south, coords.map_west, coords.map_east)
-        d_in = in_rectangle(
-            south, west, coords.map_north, coords.map_south, coords.map_west, coords.map_east)
-        case = a_in * 8 + b_in * 4 + c_in * 2 + d_in
-        if case != Cases.ABCD:
-            if case == Cases.A:
-                south = coords.map_south
-                east = coords.map_east
-                north = FULL_KILOMETER_GEODESIC.destination((south, east), 0).latitude
-                west = FULL_KILOMETER_GEODESIC.destination((south, east), -90).longitude
-            elif case == Cases.B:
-                south = coords.map_south
-                west = coords.map_west
-                north = FULL_KILOMETER_GEODESIC.destination((south, west), 0).latitude
-                east = FULL_KILOMETER_GEODESIC.destination((south, west), 90).longitude
-            elif case == Cases.C:
-                north = coords.map_north
-                west = coords.map_west
-                south = FULL_KILOMETER_GEODESIC.destination((north, west), 180).latitude
-                east = FULL_KILOMETER_GEODESIC.destination((north, west), 90).longitude
-            elif case == Cases.D:
-                north = coords.map_north
-                east = coords.map_east
-                west = FULL_KILOMETER_GEODESIC.destination((north, east), -90).longitude
-                south = FULL_KILOMETER_GEODESIC.destination((north, east), 180).latitude
-            elif case == Cases.AB:
-                south = coords.map_south
-                north = FULL_KILOMETER_GEODESIC.destination((south, west), 0).latitude
-            elif case == Cases.CD:
-                north = coords.map_north
-                south = FULL_KILOMETER_GEODESIC.destination((north, west), 180).latitude
-            elif case == Cases.AD:
-                east = coords.map_east
-                west = FULL_KILOMETER_GEODESIC.destination((north, east), -90).longitude
-            elif case == Cases.BC:
-                west = coords.map_west
-                east = FULL_KILOMETER_GEODESIC.destination((north, west), 90).longitude
-            else:
-                is_error = True
-                if case == 0:
-                    # map_a_in = in_rectangle(coords.map_north, coords.map_west, north, south, west, east)
-                    # map_b_in = in_rectangle(coords.map_north, coords.map_east, north, south, west, east)
-                    # map_c_in = in_rectangle(coords.map_south, coords.map_east, north, south, west, east)
-                    # map_d_in = in_rectangle(coords.map_south, coords.map_west, north, south, west, east)
-                    # map_case = map_a_in * 8 + map_b_in * 4 + map_c_in * 2 + map_d_in
-                    # is_error = map_case not in (Cases.A, Cases.B, Cases.C, Cases.D, Cases.AB, Cases.CD, Cases.AD, Cases.BC)
-                    is_error = False
-                if is_error:
-                    print('Point', point.position)
-                    print('Rect_', north, south, west, east)
-                    print('Map__', coords.map_north, coords.map_south, coords.map_west, coords.map_east)
-                    raise RuntimeError('Impossible case %s' % Cases.strings[case])
+        north, south, west, east = neighborhood_box(
+            point.lat, point.lng, coords.map_north, coords.map_south, coords.map_west,
+            coords.map_east)
+    else:
+        north, south, west, east = GEODESY.neighborhood(point.lat, point.lng, KILOMETER / 2)
     # Get points in rectangle.
-    return get_points_in_rectangle(coords.coordinates, north, south, west, east)
+    return coords.get_points_in_rectangle(north, south, west, east)
+
+
+def group_rectangles(flood, verbose=True):
+    # type: (List[Point], bool) -> List[Bounds]
+    # Group flooded points into rectangles: repeatedly take and remove neighbours of
+    # Coordinates.max_point(), keeping groups at least 10 meters wide and high.
+    rectangles = []
+    coordinates = Coordinates(flood)
+    count('points', len(flood))
+    while coordinates:
+        count('neighbourhoods')
+        if verbose:
+            print('Remaining', len(coordinates), 'point(s).')
+        point = coordinates.max_point()
+        neighbors = get_neighbors(point, coordinates, True)
+        coordinates.remove(neighbors)
+        if len(neighbors) == 1:
+            continue
+        bounds = Bounds(neighbors)
+        if bounds.width < 10 or bounds.height < 10:
+            continue
+        rectangles.append(bounds)
+    count('rectangles', len(rectangles))
+    return rectangles
+
+
+# Band processing.
+#
+# Grid columns are split into bands, each processed by a worker process: flooded cells
+# are selected and labeled per band, and band components touching across band edges are
+# merged. group_rectangles() takes neighbourhoods of max remaining points, i.e. row by row
+# from north to south, and from east to west within a row. A neighbourhood spreads at most
+# 1 Km from its point, so with bands at least BAND_MIN_METERS wide, steps of a band in a
+# row only depend on steps of its east neighbour band in same row, and of its west neighbour
+# band in previous rows. Band workers thus run as a pipeline: before each row, a worker
+# receives steps (max point and neighbourhood) of west band's previous row and east band's
+# current row overlapping it, removes their neighbourhoods, then takes its own steps for
+# the row and sends them to its neighbours. Neighbourhoods near map edges also depend on
+# global map bounds, estimated from remaining points of other bands (row by row on first
+# round, from previous round after).
+#
+# Each worker records steps overlapping its band, with extents of band points they remove.
+# Results are then checked against serial grouping: steps taken at points of each band,
+# merged in processing order, must be exactly the steps every band saw overlapping it, and
+# each neighbourhood must match the one computed from global bounds of points remaining at
+# its step. Then, by induction on steps, each step removes same points as serial grouping,
+# and rectangles are the same. Otherwise, grouping is retried with updated bounds, and
+# finally done serially.
+
+# Step columns in band results.
+STEP_TIME, STEP_NORTH, STEP_SOUTH, STEP_WEST, STEP_EAST = range(5)
+STEP_COUNT, STEP_MAX_LAT, STEP_MIN_LAT, STEP_MIN_LNG, STEP_MAX_LNG = range(5, 10)
+
+
+def cell_times(rows, columns, layout):
+    # Return order in which group_rectangles() reaches cells as max point: from north to
+    # south, then from east to west. Layout is (height, width, lat_step, lng_step) of grid.
+    # Works on ints or arrays.
+    height, width, lat_step, lng_step = layout
+    if lat_step >= 0:
+        rows = height - 1 - rows
+    if lng_step > 0:
+        columns = width - 1 - columns
+    return rows * width + columns
+
+
+def time_columns(times, layout):
+    # type: (np.ndarray, tuple) -> np.ndarray
+    # Inverse of cell_times() for grid columns.
+    height, width, lat_step, lng_step = layout
+    columns = times.astype(np.int64) % width
+    return width - 1 - columns if lng_step > 0 else columns
+
+
+def time_rows(times, layout):
+    # type: (np.ndarray, tuple) -> np.ndarray
+    height, width, lat_step, lng_step = layout
+    rows = times.astype(np.int64) // width
+    return height - 1 - rows if lat_step >= 0 else rows
+
+
+class OuterBounds:
+    # South, west and east bounds of points of other bands still remaining at each time,
+    # from timelines: arrays of (time, south, west, east) rows, for points removed at time.
+    __slots__ = ('timelines',)
+
+    def __init__(self, timelines):
+        # type: (List[np.ndarray]) -> None
+        self.timelines = []
+        for timeline in timelines:
+            if not len(timeline):
+                continue
+            timeline = timeline[np.argsort(timeline[:, 0], kind='stable')]
+            # Bounds of points removed at or after each time.
+            self.timelines.append((timeline[:, 0],
+                                   np.minimum.accumulate(timeline[::-1, 1])[::-1],
+                                   np.minimum.accumulate(timeline[::-1, 2])[::-1],
+                                   np.maximum.accumulate(timeline[::-1, 3])[::-1]))
+
+    def at(self, time):
+        # type: (float) -> Tuple[float, float, float]
+        south = west = math.inf
+        east = -math.inf
+        for times, souths, wests, easts in self.timelines:
+            index = int(np.searchsorted(times, time))
+            if index < len(times):
+                south = min(south, souths[index])
+                west = min(west, wests[index])
+                east = max(east, easts[index])
+        return south, west, east
+
+
+class FloodBands:
+    # Flooded cells of a grid, selected by bands of columns [start, end).
+    __slots__ = ('grid', 'bands', 'rows', 'columns', 'nb_components')
+
+    def __init__(self, grid, bands):
+        # type: (Any, List[Tuple[int, int]]) -> None
+        self.grid = grid
+        self.bands = bands
+        self.rows = []  # type: List[np.ndarray]
+        self.columns = []  # type: List[np.ndarray]
+        self.nb_components = 0
+
+    def __len__(self):
+        return sum(len(rows) for rows in self.rows)
+
+    @property
+    def layout(self):
+        grid = self.grid
+        return grid.height, grid.width, grid.lat_step, grid.lng_step
+
+    def cells(self, start, end):
+        # type: (int, int) -> Tuple[np.ndarray, np.ndarray]
+        # Return rows and columns of flooded cells in columns [start, end).
+        rows = []
+        columns = []
+        for (band_start, band_end), band_rows, band_columns in zip(
+                self.bands, self.rows, self.columns):
+            if band_start < end and start < band_end:
+                inside = (band_columns >= start) & (band_columns < end)
+                rows.append(band_rows[inside])
+                columns.append(band_columns[inside])
+        return np.concatenate(rows), np.concatenate(columns)
+
+    def core_longitudes(self, band):
+        # type: (int) -> Tuple[float, float]
+        # Return west and east longitudes of a band.
+        start, end = self.bands[band]
+        longitudes = self.grid.longitudes[start:end]
+        return float(longitudes.min()), float(longitudes.max())
+
+    def row_timeline(self, band):
+        # type: (int) -> np.ndarray
+        # Timeline of band points assuming each row is removed at its end: rows of
+        # (time, south, west, east).
+        rows = self.rows[band]
+        if not len(rows):
+            return np.empty((0, 4))
+        # Cells are sorted by row.
+        starts = np.flatnonzero(np.diff(rows, prepend=-1))
+        unique_rows = rows[starts]
+        longitudes = self.grid.longitudes[self.columns[band]]
+        width = self.grid.width
+        return np.stack((cell_times(unique_rows.astype(np.int64), 0, self.layout) // width
+                         * width + width - 1,
+                         self.grid.latitudes[unique_rows],
+                         np.minimum.reduceat(longitudes, starts),
+                         np.maximum.reduceat(longitudes, starts)), axis=1)
+
+    def points(self):
+        # type: () -> List[Point]
+        rows, columns = self.cells(0, self.grid.width)
+        return [Point(lat, lng, alt) for lat, lng, alt in zip(
+            self.grid.latitudes[rows].tolist(),
+            self.grid.longitudes[columns].tolist(),
+            self.grid.altitudes[rows, columns].tolist())]
+
+
+def plan_bands(grid, nb_processes):
+    # type: (Any, int) -> List[Tuple[int, int]]
+    # Split grid columns into at most nb_processes bands at least BAND_MIN_METERS wide.
+    nb_bands = min(nb_processes, grid.width // distance_columns(grid, BAND_MIN_METERS))
+    edges = np.linspace(0, grid.width, max(1, nb_bands) + 1).round().astype(int).tolist()
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def distance_columns(grid, meters):
+    # type: (Any, float) -> int
+    # Number of columns covering at least given distance along any grid row.
+    latitudes = grid.latitudes
+    lat = float(max(abs(latitudes[0]), abs(latitudes[-1])))
+    degrees = GEODESY.destination(lat, 0.0, meters, ANGLE_EAST)[1]
+    return int(math.ceil(degrees / abs(grid.lng_step))) + 1
+
+
+def _select_band(task):
+    # Worker: select and label flooded cells of a band. Return rows and columns (in band)
+    # of flooded cells, number of components, and labels of first and last band columns.
+    altitudes, flood_threshold, water = task
+    flooded = select_flooded(altitudes, flood_threshold, water)
+    components = label_components(flooded, CONNECTIVITY_8)
+    rows, columns = np.nonzero(flooded)
+    return (rows.astype(np.int32), columns.astype(np.int32), components.count,
+            components.labels[:, 0].copy(), components.labels[:, -1].copy())
+
+
+def select_bands(grid, flood_threshold, water, bands, pool):
+    # type: (Any, float, Optional[np.ndarray], List[Tuple[int, int]], Any) -> FloodBands
+    flood_bands = FloodBands(grid, bands)
+    tasks = ((np.ascontiguousarray(grid.altitudes[:, start:end]), flood_threshold,
+              None if water is None else water[:, start:end]) for start, end in bands)
+    counts = []
+    first_columns = []
+    last_columns = []
+    for (start, end), (rows, columns, nb_components, first_column, last_column) in zip(
+            bands, pool.imap(_select_band, tasks)):
+        flood_bands.rows.append(rows)
+        flood_bands.columns.append(columns + start)
+        counts.append(nb_components)
+        first_columns.append(first_column)
+        last_columns.append(last_column)
+    flood_bands.nb_components = count_band_components(
+        counts, first_columns, last_columns, CONNECTIVITY_8)
+    return flood_bands
+
+
+def _remove_step(coordinates, step, core_west, core_east):
+    # type: (Coordinates, tuple, float, float) -> tuple
+    # Remove points in step neighbourhood, and return step (time, north, south, west, east)
+    # followed by number, max lat, min lat, min lng and max lng of removed band points.
+    time, north, south, west, east = step
+    neighbors = coordinates.get_points_in_rectangle(north, south, west, east)
+    coordinates.remove(neighbors)
+    lats = [pt.lat for pt in neighbors if core_west <= pt.lng <= core_east]
+    if not lats:
+        return step + (0,) + (math.nan,) * 4
+    lngs = [pt.lng for pt in neighbors if core_west <= pt.lng <= core_east]
+    return step + (len(lats), max(lats), min(lats), min(lngs), max(lngs))
+
+
+def _group_band(task, west_band, east_band, output):
+    # Worker: group points of a band, exchanging steps with neighbour bands through
+    # connections west_band and east_band (None at map edges), and send to output steps
+    # overlapping band, as an array of _remove_step() rows.
+    latitudes, longitudes, rows, columns, core, neighbor_cores, layout, fast, timelines = task
+    GEODESY.fast = fast
+    core_west, core_east = core
+    outer = OuterBounds(timelines)
+    column_of = dict(zip(longitudes.tolist(), range(len(longitudes))))
+    coordinates = Coordinates(Point(lat, lng, None) for lat, lng in zip(
+        latitudes[rows].tolist(), longitudes[columns].tolist()))
+    steps = []
+    row_order = range(len(latitudes)) if layout[2] < 0 else range(len(latitudes) - 1, -1, -1)
+    for index, row in enumerate(row_order):
+        imposed = []
+        if west_band is not None and index:
+            imposed.extend(west_band.recv())
+        if east_band is not None:
+            imposed.extend(east_band.recv())
+        for step in sorted(imposed):
+            steps.append(_remove_step(coordinates, step, core_west, core_east))
+        row_steps = []
+        lat = float(latitudes[row])
+        while coordinates and coordinates.map_north == lat:
+            point = coordinates.max_point()
+            time = cell_times(row, column_of[point.lng], layout)
+            outer_south, outer_west, outer_east = outer.at(time)
+            step = (time,) + neighborhood_box(
+                point.lat, point.lng, coordinates.map_north,
+                min(coordinates.map_south, outer_south), min(coordinates.map_west, outer_west),
+                max(coordinates.map_east, outer_east))
+            steps.append(_remove_step(coordinates, step, core_west, core_east))
+            row_steps.append(step)
+        for connection, (west, east) in zip((west_band, east_band), neighbor_cores):
+            if connection is not None:
+                connection.send([step for step in row_steps
+                                 if step[STEP_WEST] <= east and step[STEP_EAST] >= west])
+    if west_band is not None and len(row_order):
+        # Steps of west band last row cannot remove points of this band.
+        west_band.recv()
+    output.send(np.array(steps, dtype=np.float64).reshape(-1, 10))
+
+
+def merge_band_steps(flood_bands, band_steps):
+    # type: (FloodBands, List[np.ndarray]) -> Optional[List[Bounds]]
+    # Check band steps against serial grouping (see above), and return rectangles,
+    # or None if band steps are not consistent.
+    layout = flood_bands.layout
+    grid = flood_bands.grid
+    owned = []
+    for (start, end), steps in zip(flood_bands.bands, band_steps):
+        step_columns = time_columns(steps[:, STEP_TIME], layout)
+        owned.append(steps[(step_columns >= start) & (step_columns < end)])
+    plan = np.concatenate(owned)
+    plan = plan[np.argsort(plan[:, STEP_TIME], kind='stable')]
+    nb_steps = len(plan)
+    removed = np.zeros(nb_steps, dtype=np.int64)
+    max_lat = np.full(nb_steps, -math.inf)
+    min_lat = np.full(nb_steps, math.inf)
+    min_lng = np.full(nb_steps, math.inf)
+    max_lng = np.full(nb_steps, -math.inf)
+    for band, steps in enumerate(band_steps):
+        core_west, core_east = flood_bands.core_longitudes(band)
+        expected = plan[(plan[:, STEP_WEST] <= core_east) & (plan[:, STEP_EAST] >= core_west)]
+        if not np.array_equal(expected[:, :STEP_COUNT], steps[:, :STEP_COUNT]):
+            print('Band', band, 'steps differ from steps of other bands.')
+            return None
+        steps = steps[steps[:, STEP_COUNT] > 0]
+        indices = np.searchsorted(plan[:, STEP_TIME], steps[:, STEP_TIME])
+        removed[indices] += steps[:, STEP_COUNT].astype(np.int64)
+        max_lat[indices] = np.maximum(max_lat[indices], steps[:, STEP_MAX_LAT])
+        min_lat[indices] = np.minimum(min_lat[indices], steps[:, STEP_MIN_LAT])
+        min_lng[indices] = np.minimum(min_lng[indices], steps[:, STEP_MIN_LNG])
+        max_lng[indices] = np.maximum(max_lng[indices], steps[:, STEP_MAX_LNG])
+    if removed.sum() != len(flood_bands) or (removed == 0).any():
+        print('Band steps do not remove each point once.')
+        return None
+    # Bounds of points remaining before each step.
+    souths = np.minimum.accumulate(min_lat[::-1])[::-1]
+    wests = np.minimum.accumulate(min_lng[::-1])[::-1]
+    easts = np.maximum.accumulate(max_lng[::-1])[::-1]
+    lats = grid.latitudes[time_rows(plan[:, STEP_TIME], layout)].tolist()
+    lngs = grid.longitudes[time_columns(plan[:, STEP_TIME], layout)].tolist()
+    boxes = plan[:, STEP_NORTH:(STEP_EAST + 1)].tolist()
+    for step, (lat, lng, south, west, east) in enumerate(zip(
+            lats, lngs, souths.tolist(), wests.tolist(), easts.tolist())):
+        if list(neighborhood_box(lat, lng, lat, south, west, east)) != boxes[step]:
+            print('Band neighbourhood at', (lat, lng), 'differs from serial one.')
+            return None
+    rectangles = []
+    for nb_points, north, south, west, east in zip(
+            removed.tolist(), max_lat.tolist(), min_lat.tolist(), min_lng.tolist(),
+            max_lng.tolist()):
+        if nb_points == 1:
+            continue
+        bounds = Bounds.from_extents(north, south, west, east, nb_points)
+        if bounds.width < 10 or bounds.height < 10:
+            continue
+        rectangles.append(bounds)
+    count('neighbourhoods', nb_steps)
+    return rectangles
+
+
+def group_bands(flood_bands, nb_rounds=MAX_BAND_ROUNDS, context=multiprocessing):
+    # type: (FloodBands, int, Any) -> List[Bounds]
+    # Same as group_rectangles() on all flooded points, computed by bands.
+    # Band workers are started with given multiprocessing context.
+    grid = flood_bands.grid
+    nb_bands = len(flood_bands.bands)
+    cores = [flood_bands.core_longitudes(band) for band in range(nb_bands)]
+    timelines = [flood_bands.row_timeline(band) for band in range(nb_bands)]
+    for _ in range(nb_rounds):
+        count('rounds')
+        # Connections between each band and its east neighbour band, if any
+        # (bands are sorted by column, east being last if lng_step > 0).
+        links = [context.Pipe() for _ in range(nb_bands - 1)]
+        if grid.lng_step > 0:
+            east_links = [link[0] for link in links] + [None]
+            west_links = [None] + [link[1] for link in links]
+        else:
+            east_links = [None] + [link[1] for link in links]
+            west_links = [link[0] for link in links] + [None]
+        outputs = []
+        workers = []
+        for band, (start, end) in enumerate(flood_bands.bands):
+            rows, columns = flood_bands.cells(start, end)
+            west_core = east_core = (math.inf, -math.inf)
+            if west_links[band] is not None:
+                west_core = cores[band - 1 if grid.lng_step > 0 else band + 1]
+            if east_links[band] is not None:
+                east_core = cores[band + 1 if grid.lng_step > 0 else band - 1]
+            task = (grid.latitudes, grid.longitudes, rows, columns, cores[band],
+                    (west_core, east_core), flood_bands.layout, GEODESY.fast,
+                    timelines[:band] + timelines[(band + 1):])
+            output, worker_output = context.Pipe(duplex=False)
+            worker = context.Process(
+                target=_group_band,
+                args=(task, west_links[band], east_links[band], worker_output))
+            worker.start()
+            outputs.append(output)
+            workers.append(worker)
+        band_steps = [output.recv() for output in outputs]
+        for worker in workers:
+            worker.join()
+        rectangles = merge_band_steps(flood_bands, band_steps)
+        if rectangles is not None:
+            count('points', len(flood_bands))
+            count('rectangles', len(rectangles))
+            return rectangles
+        timelines = [steps[steps[:, STEP_COUNT] > 0][:, [STEP_TIME, STEP_MIN_LAT, STEP_MIN_LNG,
+                                                        STEP_MAX_LNG]]
+                     for steps in band_steps]
+        print('Retrying band grouping with updated map bounds.')
+    print('Grouping serially.')
+    count('serial fallbacks')
+    return group_rectangles(flood_bands.points(), verbose=False)
 
 
 def main():
-    if len(sys.argv) != 4:
-        print('Usage: python flood.py <map-file-name> <flood-threshold> <output-name>')
-        exit(-1)
-    map_file_name = sys.argv[1]
-    flood_threshold = float(sys.argv[2])
-    output_name = sys.argv[3]
+    parser = argparse.ArgumentParser(
+        prog='Select map points below a flood threshold and group them in rectangles.')
+    parser.add_argument('map_file_name', type=str,
+                        help='Map file (binary grid, GeoTIFF or text map). If a PNG image with '
+                             'same base name exists in working directory, it is used to skip '
+                             'water.')
+    parser.add_argument('flood_threshold', type=float, help='Flood threshold (altitude)')
+    parser.add_argument('output_name', type=str,
+                        help='Output name (rectangles are written in <output-name>.js)')
+    parser.add_argument('--fast-geodesy', action='store_true',
+                        help='Use local projection instead of geodesic computations '
+                             '(error below 1 mm on 1 Km neighbourhoods).')
+    parser.add_argument('--processes', '-p', type=int, default=None,
+                        help='Number of processes, each processing a band of map longitudes '
+                             '(default: number of CPUs). Output is the same as with 1 process.')
+    add_profiling_arguments(parser)
+    args = parser.parse_args()
+    setup_profiling(args)
+    map_file_name = args.map_file_name
+    flood_threshold = args.flood_threshold
+    output_name = args.output_name
+    GEODESY.fast = args.fast_geodesy
     map_title = os.path.splitext(os.path.basename(map_file_name))[0]
     map_image_path = '%s.png' % map_title
 
@@ -377,60 +881,64 @@ def main():
     if os.path.isfile(map_image_path):
         image = MapImage(map_image_path)
 
-    flood = []  # type: List[Point]
+    metadata = read_map_metadata(map_file_name, compute=False)
+    if metadata is not None:
+        print(metadata)
+        print('About', metadata.count_below(flood_threshold), 'point(s) /', metadata.nb_samples,
+              'below threshold', flood_threshold, '(from map histogram).')
     print('Loading map ...')
-    debug_step = 2000000
-    with open(map_file_name) as file:
-        iterator_lines = iter(file)
-        pieces = next(iterator_lines).strip().split()
-        width = int(pieces[1])
-        height = int(pieces[2])
-        size = int(pieces[3])
-        with Profiler('select flooded points.'):
-            for index_line, line in enumerate(iterator_lines):
-                pieces = line.strip().split()
-                alt = float(pieces[ALT])
-                if alt <= flood_threshold:
-                    if image:
-                        # skip water
-                        map_x = index_line % width
-                        map_y = index_line // width
-                        img_x = round(map_x * (image.width - 1) / (width - 1))
-                        img_y = round(map_y * (image.height - 1) / (height - 1))
-                        img_index = img_y * image.height + img_x
-                        if pixel_is_blue(image.pixels[img_index]):
-                            continue
-                    flood.append(Point(float(pieces[LAT]), float(pieces[LNG]), alt))
-                if (index_line + 1) % debug_step == 0:
-                    print('Loaded line', index_line + 1, '/', size)
-    assert (index_line + 1) == size == width * height
+    with Profiler('load map.') as profiler:
+        grid = load_map(map_file_name)
+        profiler.count('samples', grid.size)
+        profiler.count('file bytes', os.path.getsize(map_file_name))
+    size = grid.size
     print('Finished loading map.')
-
-    print('Got', len(flood), 'flooded points /', size, 'with threshold', flood_threshold,
-          '(%s %%)' % (len(flood) * 100 / size))
-
-    rectangles = []
-    points = set(flood)
-    with Profiler('Group flooded points in rectangle (very approximate algorithm)'):
-        while points:
-            print('Remaining', len(points), 'point(s).')
-            coordinates = Coordinates(points)
-            point = max(points)
-            neighbors = get_neighbors(point, coordinates, True)
-            points.difference_update(neighbors)
-            if len(neighbors) == 1:
-                continue
-            bounds = Bounds(neighbors)
-            if bounds.width < 10 or bounds.height < 10:
-                continue
-            rectangles.append(bounds)
-    print('Found', len(rectangles), 'rectangle(s) for', len(flood), 'point(s).')
-    print(min(r.nb_points for r in rectangles), max(r.nb_points for r in rectangles))
+    bands = plan_bands(grid, args.processes or os.cpu_count() or 1)
+    if len(bands) > 1:
+        print('Processing', len(bands), 'band(s) of longitudes in parallel.')
+        with multiprocessing.Pool(processes=len(bands)) as pool:
+            with Profiler('select and label flooded points by bands.') as profiler:
+                water = image.water_mask(grid) if image else None
+                flood_bands = select_bands(grid, flood_threshold, water, bands, pool)
+                nb_flooded = len(flood_bands)
+                profiler.count('altitude bytes', grid.size * grid.altitudes.dtype.itemsize)
+                profiler.count('flooded points', nb_flooded)
+                profiler.count('components', flood_bands.nb_components)
+        print('Got', nb_flooded, 'flooded points /', size, 'with threshold', flood_threshold,
+              '(%s %%)' % (nb_flooded * 100 / size))
+        print('Flooded points form', flood_bands.nb_components, 'connected area(s).')
+        with Profiler('Group flooded points in rectangle (very approximate algorithm)'):
+            rectangles = group_bands(flood_bands)
+    else:
+        with Profiler('select flooded points.') as profiler:
+            water = image.water_mask(grid) if image else None
+            flooded = select_flooded(grid.altitudes, flood_threshold, water)
+            flood = flooded_points(grid, flooded)
+            nb_flooded = len(flood)
+            profiler.count('altitude bytes', grid.size * grid.altitudes.dtype.itemsize)
+            profiler.count('flooded points', nb_flooded)
+
+        print('Got', nb_flooded, 'flooded points /', size, 'with threshold', flood_threshold,
+              '(%s %%)' % (nb_flooded * 100 / size))
+        with Profiler('count flooded areas.') as profiler:
+            nb_components = count_components(flooded, CONNECTIVITY_8)
+            profiler.count('components', nb_components)
+        print('Flooded points form', nb_components, 'connected area(s).')
+
+        with Profiler('Group flooded points in rectangle (very approximate algorithm)'):
+            rectangles = group_rectangles(flood)
+    print('Found', len(rectangles), 'rectangle(s) for', nb_flooded, 'point(s).')
+    if rectangles:
+        print(min(r.nb_points for r in rectangles), max(r.nb_points for r in rectangles))
 
     output_file_name = '%s.js' % output_name
-    with open(output_file_name, 'w') as file:
-        file.write('export const FLOOD = %s;' % json.dumps([r.to_json() for r in rectangles]))
+    with Profiler('write rectangles.') as profiler:
+        content = 'export const FLOOD = %s;' % json.dumps([r.to_json() for r in rectangles])
+        with open(output_file_name, 'w') as file:
+            file.write(content)
+        profiler.count('bytes', len(content))
     print('Output into', output_file_name)
+    save_profiling(args)
 
 
 if __name__ == '__main__':
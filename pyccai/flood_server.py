@@ -0,0 +1,320 @@
+"""Resident flood query service: load a map once, then answer flood queries for many thresholds.
+
+Each query is a flood threshold and an optional viewport (north, south, west, east). Flood
+rectangles of a threshold are computed as by pyccai.flood (same rectangles), then kept in a
+LRU cache, so that later queries for same threshold only clip cached rectangles to their
+viewport. Rectangles intersecting viewport are returned clipped to it.
+
+Queries are served over HTTP (GET /flood?threshold=T&bbox=north,south,west,east, GET /stats),
+or with --stdio as JSON lines on standard input ({"threshold": T, "bbox": [n, s, w, e]}),
+each answered by a JSON line on standard output. Invalid queries (including non-finite
+thresholds) are answered with status INVALID_REQUEST (HTTP 400), and failed computations with
+status ERROR (HTTP 500).
+"""
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import math
+import multiprocessing
+import os
+import sys
+import time
+import urllib.parse
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import ujson as json
+
+from pyccai.elevation_server import DEFAULT_HOST, handle_http_connection
+from pyccai.flood import (GEODESY, MapImage, flooded_points, group_bands, group_rectangles,
+                          plan_bands, select_bands, select_flooded)
+from pyccai.grid import MapGrid, load_map
+
+DEFAULT_PORT = 8766
+DEFAULT_CACHE_SIZE = 32
+
+
+class FloodRectangles:
+    # Flood rectangles of a threshold, as a (n, 4) array of (north, south, west, east) rows.
+    __slots__ = ('threshold', 'bounds', 'nb_points', 'seconds')
+
+    def __init__(self, threshold, rectangles, nb_points, seconds):
+        self.threshold = threshold
+        self.bounds = np.array([r.to_json() for r in rectangles],
+                               dtype=np.float64).reshape(-1, 4)
+        self.nb_points = nb_points
+        # Computation duration.
+        self.seconds = seconds
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def clip(self, bbox=None):
+        # type: (Optional[Tuple[float, float, float, float]]) -> np.ndarray
+        # Return rectangles intersecting bbox (north, south, west, east), clipped to bbox.
+        if bbox is None:
+            return self.bounds
+        north, south, west, east = bbox
+        bounds = self.bounds
+        inside = ((bounds[:, 0] >= south) & (bounds[:, 1] <= north)
+                  & (bounds[:, 3] >= west) & (bounds[:, 2] <= east))
+        clipped = bounds[inside]
+        np.minimum(clipped[:, 0], north, out=clipped[:, 0])
+        np.maximum(clipped[:, 1], south, out=clipped[:, 1])
+        np.maximum(clipped[:, 2], west, out=clipped[:, 2])
+        np.minimum(clipped[:, 3], east, out=clipped[:, 3])
+        return clipped
+
+
+class FloodService:
+    # Flood rectangles of a map for any threshold, with a LRU cache of cache_size thresholds.
+    # Thresholds are computed one at a time, in a background thread, so that cached queries
+    # are answered while a threshold is computed. Concurrent queries for a threshold being
+    # computed wait for same computation.
+    __slots__ = ('grid', 'water', 'nb_processes', 'cache_size', 'cache', 'pending', 'executor',
+                 'nb_hits', 'nb_misses', 'start')
+
+    def __init__(self, grid, water=None, cache_size=DEFAULT_CACHE_SIZE, nb_processes=1):
+        # type: (MapGrid, Optional[np.ndarray], int, int) -> None
+        self.grid = grid
+        self.water = water
+        self.nb_processes = nb_processes
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()  # type: Dict[float, FloodRectangles]
+        self.pending = {}  # type: Dict[float, asyncio.Future]
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.nb_hits = 0
+        self.nb_misses = 0
+        self.start = time.monotonic()
+
+    @staticmethod
+    def from_map_file(map_file_name, cache_size=DEFAULT_CACHE_SIZE, nb_processes=1):
+        # type: (str, int, int) -> FloodService
+        # Load map altitudes into memory, with water mask from <map title>.png in working
+        # directory if it exists (as pyccai.flood does).
+        grid = load_map(map_file_name)
+        grid.altitudes = np.array(grid.altitudes)
+        map_image_path = '%s.png' % os.path.splitext(os.path.basename(map_file_name))[0]
+        water = None
+        if os.path.isfile(map_image_path):
+            water = MapImage(map_image_path).water_mask(grid)
+        return FloodService(grid, water, cache_size, nb_processes)
+
+    def compute(self, threshold):
+        # type: (float) -> FloodRectangles
+        start = time.perf_counter()
+        grid = self.grid
+        bands = plan_bands(grid, self.nb_processes)
+        if len(bands) > 1:
+            # Thresholds are computed in a thread of a multithreaded process, which must not
+            # fork, so worker processes are spawned.
+            context = multiprocessing.get_context('spawn')
+            with context.Pool(processes=len(bands)) as pool:
+                flood_bands = select_bands(grid, threshold, self.water, bands, pool)
+            nb_points = len(flood_bands)
+            rectangles = group_bands(flood_bands, context=context)
+        else:
+            flood = flooded_points(grid, select_flooded(grid.altitudes, threshold, self.water))
+            nb_points = len(flood)
+            rectangles = group_rectangles(flood, verbose=False)
+        return FloodRectangles(threshold, rectangles, nb_points, time.perf_counter() - start)
+
+    def _add(self, rectangles):
+        # type: (FloodRectangles) -> None
+        self.cache[rectangles.threshold] = rectangles
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def get(self, threshold):
+        # type: (float) -> Tuple[FloodRectangles, bool]
+        # Return rectangles of threshold, and whether they were cached (blocking).
+        if threshold in self.cache:
+            self.nb_hits += 1
+            self.cache.move_to_end(threshold)
+            return self.cache[threshold], True
+        self.nb_misses += 1
+        rectangles = self.compute(threshold)
+        self._add(rectangles)
+        return rectangles, False
+
+    async def get_async(self, threshold):
+        # type: (float) -> Tuple[FloodRectangles, bool]
+        if threshold in self.cache:
+            return self.get(threshold)
+        if threshold not in self.pending:
+            self.nb_misses += 1
+            self.pending[threshold] = asyncio.get_running_loop().run_in_executor(
+                self.executor, self.compute, threshold)
+        else:
+            self.nb_hits += 1
+        future = self.pending[threshold]
+        try:
+            rectangles = await asyncio.shield(future)
+        finally:
+            if future.done() and self.pending.get(threshold) is future:
+                del self.pending[threshold]
+        if threshold not in self.cache:
+            self._add(rectangles)
+        return rectangles, False
+
+    def answer(self, rectangles, cached, bbox=None):
+        # type: (FloodRectangles, bool, Optional[tuple]) -> dict
+        clipped = rectangles.clip(bbox)
+        return {
+            'status': 'OK',
+            'threshold': rectangles.threshold,
+            'bbox': list(bbox) if bbox is not None else self.grid.to_json(),
+            'cached': cached,
+            'seconds': rectangles.seconds,
+            'points': rectangles.nb_points,
+            'total': len(rectangles),
+            'count': len(clipped),
+            'rectangles': clipped.tolist(),
+        }
+
+    def query(self, threshold, bbox=None):
+        # type: (float, Optional[tuple]) -> dict
+        return self.answer(*self.get(threshold), bbox)
+
+    def statistics(self):
+        return {
+            'seconds': time.monotonic() - self.start,
+            'map': [self.grid.width, self.grid.height] + self.grid.to_json(),
+            'hits': self.nb_hits,
+            'misses': self.nb_misses,
+            'cached': [[rectangles.threshold, len(rectangles), rectangles.seconds]
+                       for rectangles in self.cache.values()],
+        }
+
+    async def respond(self, target, host=''):
+        # type: (str, str) -> Tuple[int, bytes]
+        parsed = urllib.parse.urlsplit(target)
+        if parsed.path == '/stats':
+            return 200, json.dumps(self.statistics()).encode()
+        if parsed.path != '/flood':
+            return 404, b''
+        query = urllib.parse.parse_qs(parsed.query)
+        try:
+            threshold = parse_threshold(query['threshold'][0])
+            bbox = parse_bbox(query['bbox'][0]) if 'bbox' in query else None
+        except (ValueError, KeyError) as exc:
+            return 400, json.dumps({'status': 'INVALID_REQUEST', 'error': str(exc)}).encode()
+        start = time.perf_counter()
+        try:
+            rectangles, cached = await self.get_async(threshold)
+        except Exception as exc:
+            print('threshold', threshold, 'failed:', repr(exc))
+            return 500, json.dumps({'status': 'ERROR', 'error': str(exc)}).encode()
+        answer = self.answer(rectangles, cached, bbox)
+        body = json.dumps(answer).encode()
+        print('threshold', threshold, 'bbox', bbox, 'cached' if cached else 'computed',
+              answer['count'], '/', answer['total'], 'rectangle(s) in %.3f sec'
+              % (time.perf_counter() - start))
+        return 200, body
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT, on_started=None):
+        # Serve forever. If given, on_started(port) is called once server listens.
+        server = await asyncio.start_server(
+            lambda reader, writer: handle_http_connection(self.respond, reader, writer),
+            host, port)
+        port = server.sockets[0].getsockname()[1]
+        print('Flood server listening on http://%s:%d/flood' % (host, port))
+        if on_started is not None:
+            on_started(port)
+        async with server:
+            await server.serve_forever()
+
+    def serve_stdio(self, input_file, output_file):
+        # Answer each JSON line query of input file by a JSON line, until end of input.
+        for line in input_file:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                threshold = parse_threshold(request['threshold'])
+                bbox = request.get('bbox')
+                if bbox is not None:
+                    bbox = parse_bbox(','.join(str(value) for value in bbox))
+            except (ValueError, KeyError, TypeError, AttributeError) as exc:
+                answer = {'status': 'INVALID_REQUEST', 'error': str(exc)}
+            else:
+                try:
+                    answer = self.query(threshold, bbox)
+                except Exception as exc:
+                    print('threshold', threshold, 'failed:', repr(exc))
+                    answer = {'status': 'ERROR', 'error': str(exc)}
+            output_file.write(json.dumps(answer) + '\n')
+            output_file.flush()
+
+
+def parse_threshold(value):
+    # type: (object) -> float
+    # Parse a finite threshold. Raise ValueError if invalid.
+    threshold = float(value)
+    if not math.isfinite(threshold):
+        raise ValueError('Expected a finite threshold')
+    return threshold
+
+
+def parse_bbox(text):
+    # type: (str) -> Tuple[float, float, float, float]
+    # Parse "north,south,west,east". Raise ValueError if invalid.
+    values = [float(value) for value in text.split(',')]
+    if len(values) != 4:
+        raise ValueError('Expected bbox north,south,west,east')
+    if not all(math.isfinite(value) for value in values):
+        raise ValueError('Expected finite bbox values')
+    north, south, west, east = values
+    if north < south or east < west:
+        raise ValueError('Expected bbox north >= south and east >= west')
+    return north, south, west, east
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Serve flood rectangles of a map for any threshold, with a cache of thresholds.')
+    parser.add_argument('map_file_name', type=str,
+                        help='Map file (binary grid, GeoTIFF or text map). If a PNG image with '
+                             'same base name exists in working directory, it is used to skip '
+                             'water.')
+    parser.add_argument('--host', type=str, default=DEFAULT_HOST,
+                        help='Host to listen on (default: %s).' % DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='Port to listen on (default: %d).' % DEFAULT_PORT)
+    parser.add_argument('--stdio', action='store_true',
+                        help='Read JSON line queries from standard input and write answers to '
+                             'standard output, instead of serving HTTP.')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+                        help='Number of thresholds kept in cache '
+                             '(default: %d).' % DEFAULT_CACHE_SIZE)
+    parser.add_argument('--fast-geodesy', action='store_true',
+                        help='Use local projection instead of geodesic computations '
+                             '(error below 1 mm on 1 Km neighbourhoods).')
+    parser.add_argument('--processes', '-p', type=int, default=None,
+                        help='Number of processes used to compute a threshold '
+                             '(default: number of CPUs).')
+    args = parser.parse_args()
+    GEODESY.fast = args.fast_geodesy
+    start = time.perf_counter()
+    service = FloodService.from_map_file(args.map_file_name, max(1, args.cache_size),
+                                         args.processes or os.cpu_count() or 1)
+    print('Loaded map', args.map_file_name, '(%d x %d) in %.3f sec' % (
+        service.grid.width, service.grid.height, time.perf_counter() - start),
+        file=sys.stderr if args.stdio else sys.stdout)
+    if args.stdio:
+        # Messages printed while computing thresholds go to standard error.
+        output_file = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            service.serve_stdio(sys.stdin, output_file)
+        return
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    print('Hits', service.nb_hits, 'misses', service.nb_misses)
+
+
+if __name__ == '__main__':
+    main()
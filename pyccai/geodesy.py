@@ -0,0 +1,177 @@
+"""Batched geodesic destinations and distances on WGS-84.
+
+On a regular lat/lng grid, a destination from (lat, lng) at a given distance and bearing
+has a latitude which depends only on lat, and a longitude offset which depends only on lat.
+Likewise, distance between two points on a same parallel depends only on latitude and
+longitude gap, and distance between two points on a same meridian does not depend on
+longitude. Exact results (geopy geodesic) are thus computed once per grid row and cached.
+
+Fast mode replaces geodesic computations with a local projection using meridional and
+prime-vertical radii of curvature, plus second-order curvature terms. For distances up to
+1 km and latitudes within [-80, 80] degrees, destinations and distances differ from
+geodesic ones by less than FAST_MODE_MAX_ERROR_METERS (1 mm). Error grows with the cube of
+distance: up to 3 cm at 10 km within [-60, 60] degrees, 30 cm at 10 km and 80 degrees.
+"""
+import math
+from typing import Dict, Tuple
+
+import numpy as np
+from geopy.distance import geodesic
+
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_E2 = WGS84_F * (2 - WGS84_F)
+FAST_MODE_MAX_ERROR_METERS = 1e-3
+CACHE_SIZE = 1000000
+
+Destination = Tuple[float, float]
+
+
+def meridional_radius(lat):
+    # Works on floats or arrays of latitudes (degrees).
+    sin_lat = np.sin(np.radians(lat))
+    return WGS84_A * (1 - WGS84_E2) / (1 - WGS84_E2 * sin_lat * sin_lat) ** 1.5
+
+
+def normal_radius(lat):
+    # Prime vertical radius of curvature. Works on floats or arrays of latitudes (degrees).
+    sin_lat = np.sin(np.radians(lat))
+    return WGS84_A / np.sqrt(1 - WGS84_E2 * sin_lat * sin_lat)
+
+
+class Geodesy:
+    __slots__ = ('fast', 'destination_cache', 'distance_cache', 'calculators')
+
+    def __init__(self, fast=False):
+        # type: (bool) -> None
+        self.fast = fast
+        # (lat, meters, bearing) -> (destination lat, destination lng offset)
+        self.destination_cache = {}  # type: Dict[Tuple[float, float, float], Destination]
+        # ('parallel', lat, lng gap) or ('meridian', south, north) -> meters
+        self.distance_cache = {}  # type: Dict[Tuple[str, float, float], float]
+        self.calculators = {}  # type: Dict[float, geodesic]
+
+    def _fast_offsets(self, lats, meters, bearing):
+        # Local projection, with first curvature terms of a geodesic: heading east or west,
+        # it drifts toward equator, and longitude offset depends on latitude travelled.
+        bearing = math.radians(bearing)
+        d_north = meters * math.cos(bearing)
+        d_east = meters * math.sin(bearing)
+        tan_lats = np.tan(np.radians(lats))
+        normal = normal_radius(lats)
+        north_ratio = d_north / normal
+        east_ratio = d_east / normal
+        d_north = d_north - d_east * east_ratio * tan_lats / 2
+        mid_lats = lats + np.degrees(d_north / (2 * meridional_radius(lats)))
+        end_lats = lats + np.degrees(d_north / meridional_radius(mid_lats))
+        mid_lats = (lats + end_lats) / 2
+        scale = 1 + north_ratio * tan_lats / 2 - (east_ratio * tan_lats) ** 2 / 3
+        lng_offsets = np.degrees(
+            d_east * scale / (normal_radius(mid_lats) * np.cos(np.radians(mid_lats))))
+        return end_lats, lng_offsets
+
+    def _exact_offset(self, lat, meters, bearing):
+        # type: (float, float, float) -> Destination
+        key = (lat, meters, bearing)
+        offset = self.destination_cache.get(key)
+        if offset is None:
+            calculator = self.calculators.get(meters)
+            if calculator is None:
+                calculator = self.calculators.setdefault(meters, geodesic(meters=meters))
+            point = calculator.destination((lat, 0), bearing)
+            offset = (point.latitude, point.longitude)
+            if len(self.destination_cache) >= CACHE_SIZE:
+                self.destination_cache.clear()
+            self.destination_cache[key] = offset
+        return offset
+
+    def destination(self, lat, lng, meters, bearing):
+        # type: (float, float, float, float) -> Destination
+        if self.fast:
+            end_lat, lng_offset = self._fast_offsets(lat, meters, bearing)
+            return float(end_lat), lng + float(lng_offset)
+        end_lat, lng_offset = self._exact_offset(lat, meters, bearing)
+        return end_lat, lng + lng_offset
+
+    def destinations(self, lats, lngs, meters, bearing):
+        # type: (np.ndarray, np.ndarray, float, float) -> Tuple[np.ndarray, np.ndarray]
+        lats = np.asarray(lats, dtype=np.float64)
+        lngs = np.asarray(lngs, dtype=np.float64)
+        if self.fast:
+            end_lats, lng_offsets = self._fast_offsets(lats, meters, bearing)
+            return end_lats, lngs + lng_offsets
+        unique_lats, inverse = np.unique(lats, return_inverse=True)
+        offsets = np.array([self._exact_offset(lat, meters, bearing)
+                            for lat in unique_lats.tolist()], dtype=np.float64).reshape(-1, 2)
+        return offsets[inverse, 0].reshape(lats.shape), lngs + offsets[inverse, 1].reshape(
+            lats.shape)
+
+    def neighborhood(self, lat, lng, meters):
+        # type: (float, float, float) -> Tuple[float, float, float, float]
+        # Return (north, south, west, east) reached from given point at given distance.
+        north = self.destination(lat, lng, meters, 0)[0]
+        south = self.destination(lat, lng, meters, 180)[0]
+        west = self.destination(lat, lng, meters, -90)[1]
+        east = self.destination(lat, lng, meters, 90)[1]
+        return north, south, west, east
+
+    def neighborhoods(self, lats, lngs, meters):
+        # Vectorized neighborhood(): return arrays (north, south, west, east).
+        north = self.destinations(lats, lngs, meters, 0)[0]
+        south = self.destinations(lats, lngs, meters, 180)[0]
+        west = self.destinations(lats, lngs, meters, -90)[1]
+        east = self.destinations(lats, lngs, meters, 90)[1]
+        return north, south, west, east
+
+    def parallel_distance(self, lat, west, east):
+        # type: (float, float, float) -> float
+        # Geodesic distance between (lat, west) and (lat, east).
+        gap = east - west
+        if self.fast:
+            return float(abs(np.radians(gap)) * normal_radius(lat) * math.cos(math.radians(lat)))
+        key = ('parallel', lat, gap)
+        distance = self.distance_cache.get(key)
+        if distance is None:
+            distance = geodesic((lat, 0), (lat, gap)).meters
+            self._cache_distance(key, distance)
+        return distance
+
+    def meridian_distance(self, south, north):
+        # type: (float, float) -> float
+        # Geodesic distance between (south, lng) and (north, lng), for any lng.
+        if self.fast:
+            return float(abs(np.radians(north - south)) * meridional_radius((north + south) / 2))
+        key = ('meridian', south, north)
+        distance = self.distance_cache.get(key)
+        if distance is None:
+            distance = geodesic((south, 0), (north, 0)).meters
+            self._cache_distance(key, distance)
+        return distance
+
+    def parallel_distances(self, lats, wests, easts):
+        # type: (np.ndarray, np.ndarray, np.ndarray) -> np.ndarray
+        lats = np.asarray(lats, dtype=np.float64)
+        gaps = np.asarray(easts, dtype=np.float64) - np.asarray(wests, dtype=np.float64)
+        if self.fast:
+            return np.abs(np.radians(gaps)) * normal_radius(lats) * np.cos(np.radians(lats))
+        return np.array([self.parallel_distance(lat, 0, gap)
+                         for lat, gap in zip(lats.ravel().tolist(), gaps.ravel().tolist())],
+                        dtype=np.float64).reshape(lats.shape)
+
+    def meridian_distances(self, souths, norths):
+        # type: (np.ndarray, np.ndarray) -> np.ndarray
+        souths = np.asarray(souths, dtype=np.float64)
+        norths = np.asarray(norths, dtype=np.float64)
+        if self.fast:
+            return np.abs(np.radians(norths - souths)) * meridional_radius((norths + souths) / 2)
+        return np.array([self.meridian_distance(south, north)
+                         for south, north in zip(souths.ravel().tolist(), norths.ravel().tolist())],
+                        dtype=np.float64).reshape(souths.shape)
+
+    def _cache_distance(self, key, distance):
+        if len(self.distance_cache) >= CACHE_SIZE:
+            self.distance_cache.clear()
+        self.distance_cache[key] = distance
+
+
+GEODESY = Geodesy()
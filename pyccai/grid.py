@@ -0,0 +1,591 @@
+"""Binary elevation grid format.
+
+A grid file is a fixed-size little-endian header followed by two contiguous
+float32 columns (altitudes, then resolutions), each stored row by row.
+Row ``r`` and column ``c`` are located at ``(origin_lat + r * lat_step,
+origin_lng + c * lng_step)``, so steps may be negative.
+
+Text maps written by ``restore_map`` (``# width height size lat lng alt res``
+header, then one padded ``lat lng alt res`` line per sample, sorted by
+latitude then longitude) can still be read and written.
+
+Altitudes can also be read from and written to float32 GeoTIFF files in
+geographic coordinates, as written by ``heightmap``. GeoTIFF stores no
+resolutions: they are read as pixel height in meters.
+
+Grid and text map writers append metadata (bounds, altitude and resolution
+statistics, byte offset of each row) as JSON: after grid columns, at an offset
+stored in the header (0 if absent), or as a last ``# metadata`` text line.
+Metadata can then be read without reading samples.
+"""
+import argparse
+import itertools
+import math
+import struct
+from typing import List, Optional, Tuple
+
+import numpy as np
+import ujson as json
+
+from pyccai.dem import (KEY_MODEL_TYPE, KEY_RASTER_TYPE, MODEL_TYPE_GEOGRAPHIC,
+                        RASTER_PIXEL_IS_POINT, TAG_BITS_PER_SAMPLE, TAG_COMPRESSION,
+                        TAG_GDAL_NODATA, TAG_GEO_KEY_DIRECTORY, TAG_IMAGE_LENGTH,
+                        TAG_IMAGE_WIDTH, TAG_MODEL_PIXEL_SCALE, TAG_MODEL_TIEPOINT,
+                        TAG_ROWS_PER_STRIP, TAG_SAMPLE_FORMAT, TAG_SAMPLES_PER_PIXEL,
+                        TAG_STRIP_BYTE_COUNTS, TAG_STRIP_OFFSETS, TIFF_EXTENSIONS, TIFF_TYPES,
+                        read_geotiff)
+from pyccai.geodesy import meridional_radius
+
+GRID_MAGIC = b'PYCCAIGR'
+GRID_VERSION = 1
+GRID_EXTENSION = '.grid'
+# Header ends with metadata offset, in space left zero by older writers.
+GRID_HEADER_FORMAT = '<8sIII4x8dQ'
+GRID_HEADER_SIZE = 128
+GRID_DTYPE = np.dtype('<f4')
+
+TEXT_CHUNK_LINES = 1000000
+TEXT_METADATA_PREFIX = '# metadata '
+TEXT_METADATA_SEARCH_SIZE = 1 << 16
+ROWS_PER_BLOCK = 4096
+HISTOGRAM_BINS = 64
+# Tolerance, in rows, when looking for rows of a latitude band.
+ROW_TOLERANCE = 1e-6
+
+TIFF_MAGICS = (b'II*\0', b'MM\0*')
+TAG_PHOTOMETRIC_INTERPRETATION = 262
+KEY_GEOGRAPHIC_TYPE = 2048
+GEOGRAPHIC_TYPE_WGS84 = 4326
+
+
+class MapGrid:
+    __slots__ = ('width', 'height', 'origin_lat', 'origin_lng', 'lat_step', 'lng_step',
+                 'north', 'south', 'west', 'east', 'altitudes', 'resolutions')
+
+    def __init__(self, width, height, origin_lat, origin_lng, lat_step, lng_step,
+                 altitudes, resolutions, bounds=None):
+        # type: (int, int, float, float, float, float, np.ndarray, np.ndarray, tuple) -> None
+        self.width = width
+        self.height = height
+        self.origin_lat = origin_lat
+        self.origin_lng = origin_lng
+        self.lat_step = lat_step
+        self.lng_step = lng_step
+        self.altitudes = altitudes.reshape(height, width)
+        self.resolutions = resolutions.reshape(height, width)
+        if bounds is None:
+            last_lat = origin_lat + (height - 1) * lat_step
+            last_lng = origin_lng + (width - 1) * lng_step
+            bounds = (max(origin_lat, last_lat), min(origin_lat, last_lat),
+                      min(origin_lng, last_lng), max(origin_lng, last_lng))
+        self.north, self.south, self.west, self.east = bounds
+
+    @property
+    def size(self):
+        return self.width * self.height
+
+    @property
+    def latitudes(self):
+        # Latitude of each row.
+        return self.origin_lat + np.arange(self.height, dtype=np.float64) * self.lat_step
+
+    @property
+    def longitudes(self):
+        # Longitude of each column.
+        return self.origin_lng + np.arange(self.width, dtype=np.float64) * self.lng_step
+
+    def to_json(self):
+        return [self.north, self.south, self.west, self.east]
+
+    def flush(self):
+        # Flush columns to disk if grid is memory-mapped for writing.
+        for column in (self.altitudes, self.resolutions):
+            if isinstance(column, np.memmap):
+                column.flush()
+
+    def __str__(self):
+        return 'MapGrid(%d x %d, north=%s, south=%s, west=%s, east=%s)' % (
+            self.width, self.height, self.north, self.south, self.west, self.east)
+
+    def __repr__(self):
+        return str(self)
+
+
+def _rows_between(first_lat, lat_step, height, north, south):
+    # type: (float, float, int, float, float) -> Tuple[int, int]
+    # Return range [start, stop) of rows between latitudes north and south,
+    # row i being at latitude first_lat + i * lat_step.
+    if not lat_step:
+        inside = south - ROW_TOLERANCE <= first_lat <= north + ROW_TOLERANCE
+        return 0, height if inside else 0
+    low, high = sorted(((north - first_lat) / lat_step, (south - first_lat) / lat_step))
+    start = max(0, math.ceil(low - ROW_TOLERANCE))
+    stop = min(height, math.floor(high + ROW_TOLERANCE) + 1)
+    return start, max(start, stop)
+
+
+class MapMetadata:
+    # Summary of a map file. Rows are in file order: row i is at latitude
+    # first_lat + i * lat_step, and its first sample is at byte row_offsets[i] in file,
+    # if known. Altitude histogram has HISTOGRAM_BINS bins from min to max altitude.
+    __slots__ = ('width', 'height', 'north', 'south', 'west', 'east', 'first_lat', 'lat_step',
+                 'nb_samples', 'min_altitude', 'max_altitude', 'altitude_histogram',
+                 'min_resolution', 'max_resolution', 'mean_resolution', 'row_offsets')
+
+    def __init__(self, width, height, north, south, west, east, first_lat, lat_step,
+                 nb_samples, min_altitude, max_altitude, altitude_histogram,
+                 min_resolution, max_resolution, mean_resolution, row_offsets=None):
+        self.width = width
+        self.height = height
+        self.north = north
+        self.south = south
+        self.west = west
+        self.east = east
+        self.first_lat = first_lat
+        self.lat_step = lat_step
+        self.nb_samples = nb_samples
+        self.min_altitude = min_altitude
+        self.max_altitude = max_altitude
+        self.altitude_histogram = altitude_histogram
+        self.min_resolution = min_resolution
+        self.max_resolution = max_resolution
+        self.mean_resolution = mean_resolution
+        self.row_offsets = row_offsets
+
+    @property
+    def histogram_edges(self):
+        return np.linspace(self.min_altitude, self.max_altitude, len(self.altitude_histogram) + 1)
+
+    def count_below(self, threshold):
+        # type: (float) -> int
+        # Estimate number of samples with altitude <= threshold from histogram,
+        # assuming altitudes are uniform in each bin.
+        if not self.nb_samples or threshold < self.min_altitude:
+            return 0
+        if threshold >= self.max_altitude:
+            return self.nb_samples
+        edges = self.histogram_edges
+        index = int(np.searchsorted(edges, threshold, side='right')) - 1
+        fraction = (threshold - edges[index]) / (edges[index + 1] - edges[index])
+        below = sum(self.altitude_histogram[:index]) + self.altitude_histogram[index] * fraction
+        return int(round(below))
+
+    def rows_between(self, north, south):
+        # type: (float, float) -> Tuple[int, int]
+        # Return range [start, stop) of file rows between latitudes north and south.
+        return _rows_between(self.first_lat, self.lat_step, self.height, north, south)
+
+    def to_json(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @staticmethod
+    def from_json(dct):
+        return MapMetadata(**dct)
+
+    def __str__(self):
+        return ('MapMetadata(%d x %d, north=%s, south=%s, west=%s, east=%s, %d sample(s), '
+                'altitude in [%s, %s], resolution in [%s, %s])' % (
+                    self.width, self.height, self.north, self.south, self.west, self.east,
+                    self.nb_samples, self.min_altitude, self.max_altitude,
+                    self.min_resolution, self.max_resolution))
+
+    def __repr__(self):
+        return str(self)
+
+
+def compute_metadata(grid, row_offsets=None, ascending=False):
+    # type: (MapGrid, Optional[List[int]], bool) -> MapMetadata
+    # Compute metadata of a grid by blocks of rows. File rows are grid rows,
+    # or rows by increasing latitude if ascending is True. NaN altitudes are not counted.
+    nb_samples = 0
+    min_altitude = max_altitude = None
+    min_resolution = max_resolution = None
+    resolution_sum = 0.0
+    for start in range(0, grid.height, ROWS_PER_BLOCK):
+        altitudes = np.asarray(grid.altitudes[start:(start + ROWS_PER_BLOCK)])
+        available = ~np.isnan(altitudes)
+        count = int(np.count_nonzero(available))
+        if not count:
+            continue
+        altitudes = altitudes[available]
+        resolutions = np.asarray(grid.resolutions[start:(start + ROWS_PER_BLOCK)])[available]
+        block_bounds = (float(altitudes.min()), float(altitudes.max()),
+                        float(resolutions.min()), float(resolutions.max()))
+        if not nb_samples:
+            min_altitude, max_altitude, min_resolution, max_resolution = block_bounds
+        else:
+            min_altitude = min(min_altitude, block_bounds[0])
+            max_altitude = max(max_altitude, block_bounds[1])
+            min_resolution = min(min_resolution, block_bounds[2])
+            max_resolution = max(max_resolution, block_bounds[3])
+        resolution_sum += float(resolutions.sum(dtype=np.float64))
+        nb_samples += count
+    histogram = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+    if nb_samples:
+        for start in range(0, grid.height, ROWS_PER_BLOCK):
+            altitudes = np.asarray(grid.altitudes[start:(start + ROWS_PER_BLOCK)])
+            histogram += np.histogram(altitudes[~np.isnan(altitudes)], bins=HISTOGRAM_BINS,
+                                      range=(min_altitude, max_altitude))[0]
+    first_lat, lat_step = grid.origin_lat, grid.lat_step
+    if ascending and lat_step < 0:
+        first_lat, lat_step = grid.south, -lat_step
+    return MapMetadata(grid.width, grid.height, grid.north, grid.south, grid.west, grid.east,
+                       first_lat, lat_step, nb_samples, min_altitude, max_altitude,
+                       histogram.tolist(), min_resolution, max_resolution,
+                       resolution_sum / nb_samples if nb_samples else None, row_offsets)
+
+
+def grid_from_columns(width, height, latitudes, longitudes, altitudes, resolutions):
+    # type: (int, int, np.ndarray, np.ndarray, np.ndarray, np.ndarray) -> MapGrid
+    # Build a grid from flat per-sample columns sorted row by row.
+    row_latitudes = latitudes[::width]
+    column_longitudes = longitudes[:width]
+    lat_step = (row_latitudes[-1] - row_latitudes[0]) / (height - 1) if height > 1 else 0.0
+    lng_step = (column_longitudes[-1] - column_longitudes[0]) / (width - 1) if width > 1 else 0.0
+    return MapGrid(width, height, float(row_latitudes[0]), float(column_longitudes[0]),
+                   float(lat_step), float(lng_step),
+                   np.ascontiguousarray(altitudes, dtype=GRID_DTYPE),
+                   np.ascontiguousarray(resolutions, dtype=GRID_DTYPE),
+                   bounds=(float(latitudes.max()), float(latitudes.min()),
+                           float(longitudes.min()), float(longitudes.max())))
+
+
+def is_grid_file(path):
+    # type: (str) -> bool
+    with open(path, 'rb') as file:
+        return file.read(len(GRID_MAGIC)) == GRID_MAGIC
+
+
+def read_grid(path):
+    # type: (str) -> MapGrid
+    # Columns are memory-mapped read-only: no sample is read before it is accessed.
+    with open(path, 'rb') as file:
+        header = file.read(GRID_HEADER_SIZE)
+    (magic, version, width, height,
+     origin_lat, origin_lng, lat_step, lng_step,
+     north, south, west, east, _) = struct.unpack_from(GRID_HEADER_FORMAT, header)
+    if magic != GRID_MAGIC:
+        raise RuntimeError('Not a grid file: %s' % path)
+    if version != GRID_VERSION:
+        raise RuntimeError('Unsupported grid version %s' % version)
+    size = width * height
+    altitudes = np.memmap(path, dtype=GRID_DTYPE, mode='r', offset=GRID_HEADER_SIZE,
+                          shape=(size,))
+    resolutions = np.memmap(path, dtype=GRID_DTYPE, mode='r',
+                            offset=GRID_HEADER_SIZE + size * GRID_DTYPE.itemsize, shape=(size,))
+    return MapGrid(width, height, origin_lat, origin_lng, lat_step, lng_step,
+                   altitudes, resolutions, bounds=(north, south, west, east))
+
+
+def _pack_header(grid, metadata_offset=0):
+    # type: (MapGrid, int) -> bytes
+    header = struct.pack(GRID_HEADER_FORMAT, GRID_MAGIC, GRID_VERSION, grid.width, grid.height,
+                         grid.origin_lat, grid.origin_lng, grid.lat_step, grid.lng_step,
+                         grid.north, grid.south, grid.west, grid.east, metadata_offset)
+    return header.ljust(GRID_HEADER_SIZE, b'\0')
+
+
+def write_grid(path, grid):
+    # type: (str, MapGrid) -> None
+    with open(path, 'wb') as file:
+        file.write(_pack_header(grid))
+        np.ascontiguousarray(grid.altitudes, dtype=GRID_DTYPE).tofile(file)
+        np.ascontiguousarray(grid.resolutions, dtype=GRID_DTYPE).tofile(file)
+    write_grid_metadata(path, grid)
+
+
+def write_grid_metadata(path, grid):
+    # type: (str, MapGrid) -> MapMetadata
+    # Compute metadata of grid written in file, and write it after grid columns.
+    # Call it once samples of a grid from create_grid() are written and flushed.
+    row_size = grid.width * GRID_DTYPE.itemsize
+    metadata = compute_metadata(
+        grid, [GRID_HEADER_SIZE + row * row_size for row in range(grid.height)])
+    metadata_offset = GRID_HEADER_SIZE + 2 * grid.height * row_size
+    with open(path, 'rb+') as file:
+        file.truncate(metadata_offset)
+        file.seek(metadata_offset)
+        file.write(json.dumps(metadata.to_json()).encode())
+        file.seek(0)
+        file.write(_pack_header(grid, metadata_offset))
+    return metadata
+
+
+def read_grid_metadata(path):
+    # type: (str) -> Optional[MapMetadata]
+    # Return metadata written in grid file, or None if absent.
+    with open(path, 'rb') as file:
+        header = file.read(GRID_HEADER_SIZE)
+        metadata_offset = struct.unpack_from(GRID_HEADER_FORMAT, header)[-1]
+        if not metadata_offset:
+            return None
+        file.seek(metadata_offset)
+        return MapMetadata.from_json(json.loads(file.read().decode()))
+
+
+def create_grid(path, width, height, origin_lat, origin_lng, lat_step, lng_step,
+                fill_value=np.nan):
+    # type: (str, int, int, float, float, float, float, Optional[float]) -> MapGrid
+    # Create a grid file filled with fill_value and return it with columns
+    # memory-mapped for writing. Call flush() once samples are written.
+    # If fill_value is None, file is left sparse (samples read as zero until written).
+    size = width * height
+    with open(path, 'wb') as file:
+        file.truncate(GRID_HEADER_SIZE + 2 * size * GRID_DTYPE.itemsize)
+    columns = np.memmap(path, dtype=GRID_DTYPE, mode='r+', offset=GRID_HEADER_SIZE,
+                        shape=(2, height, width))
+    if fill_value is not None:
+        for column in columns:
+            for start in range(0, height, ROWS_PER_BLOCK):
+                column[start:(start + ROWS_PER_BLOCK)] = fill_value
+    grid = MapGrid(width, height, origin_lat, origin_lng, lat_step, lng_step,
+                   columns[0], columns[1])
+    with open(path, 'rb+') as file:
+        file.write(_pack_header(grid))
+    return grid
+
+
+def read_text_map(path):
+    # type: (str) -> MapGrid
+    with open(path) as file:
+        pieces = next(file).strip().split()
+        width = int(pieces[1])
+        height = int(pieces[2])
+        size = int(pieces[3])
+        assert size == width * height
+        columns = np.empty((size, 4), dtype=np.float64)
+        cursor = 0
+        while cursor < size:
+            lines = list(itertools.islice(file, TEXT_CHUNK_LINES))
+            if not lines:
+                break
+            chunk = np.loadtxt(lines, dtype=np.float64, ndmin=2)
+            columns[cursor:(cursor + len(chunk))] = chunk
+            cursor += len(chunk)
+            print('Loaded line', cursor, '/', size)
+    assert cursor == size
+    return grid_from_columns(width, height, columns[:, 0], columns[:, 1],
+                             columns[:, 2], columns[:, 3])
+
+
+def write_text_map(path, grid):
+    # type: (str, MapGrid) -> None
+    # Rows are written by increasing latitude, then by increasing longitude,
+    # each line padded to the length of the longest one.
+    row_order = range(grid.height) if grid.lat_step >= 0 else range(grid.height - 1, -1, -1)
+    column_order = slice(None) if grid.lng_step >= 0 else slice(None, None, -1)
+    latitudes = grid.latitudes.tolist()
+    longitudes = [str(lng) for lng in grid.longitudes[column_order].tolist()]
+
+    def iter_rows():
+        for row in row_order:
+            lat = str(latitudes[row])
+            altitudes = grid.altitudes[row, column_order].tolist()
+            resolutions = grid.resolutions[row, column_order].tolist()
+            yield ['%s %s %s %s' % (lat, lng, alt, res)
+                   for lng, alt, res in zip(longitudes, altitudes, resolutions)]
+
+    line_length = max(max(len(line) for line in lines) for lines in iter_rows())
+    header = ('# %s %s %s lat lng alt res' % (grid.width, grid.height, grid.size)).ljust(
+        line_length)
+    # Lines are ASCII with a fixed length, so row offsets are known before writing.
+    row_size = grid.width * (line_length + 1)
+    metadata = compute_metadata(
+        grid, [len(header) + 1 + row * row_size for row in range(grid.height)], ascending=True)
+    with open(path, 'w') as file:
+        file.write(header)
+        file.write('\n')
+        for lines in iter_rows():
+            for line in lines:
+                file.write(line.ljust(line_length))
+                file.write('\n')
+        file.write(TEXT_METADATA_PREFIX)
+        file.write(json.dumps(metadata.to_json()))
+        file.write('\n')
+
+
+def read_text_metadata(path):
+    # type: (str) -> Optional[MapMetadata]
+    # Return metadata written in last line of text map, or None if absent.
+    # File is read backwards from its end up to start of last line.
+    with open(path, 'rb') as file:
+        file.seek(0, 2)
+        end = file.tell()
+        tail = b''
+        while True:
+            start = max(0, end - len(tail) - TEXT_METADATA_SEARCH_SIZE)
+            file.seek(start)
+            tail = file.read(end - len(tail) - start) + tail
+            line_start = tail.rfind(b'\n', 0, len(tail) - 1)
+            if line_start >= 0 or not start:
+                break
+    last_line = tail[(line_start + 1):].decode()
+    if not last_line.startswith(TEXT_METADATA_PREFIX):
+        return None
+    return MapMetadata.from_json(json.loads(last_line[len(TEXT_METADATA_PREFIX):]))
+
+
+def is_tiff_file(path):
+    # type: (str) -> bool
+    with open(path, 'rb') as file:
+        return file.read(4) in TIFF_MAGICS
+
+
+def read_geotiff_map(path):
+    # type: (str) -> MapGrid
+    # Altitudes are memory-mapped read-only.
+    tile = read_geotiff(path)
+    altitudes = tile.data
+    if altitudes.dtype != GRID_DTYPE:
+        altitudes = altitudes.astype(GRID_DTYPE)
+    # Resolution of each row: north-south size of its cells, in meters.
+    latitudes = tile.north - np.arange(tile.height, dtype=np.float64) * tile.lat_step
+    row_resolutions = meridional_radius(latitudes) * math.radians(abs(tile.lat_step))
+    resolutions = np.broadcast_to(row_resolutions.astype(GRID_DTYPE)[:, None], altitudes.shape)
+    return MapGrid(tile.width, tile.height, tile.north, tile.west, -tile.lat_step,
+                   tile.lng_step, altitudes, resolutions)
+
+
+def write_geotiff(path, grid):
+    # type: (str, MapGrid) -> None
+    # Write altitudes as an uncompressed float32 GeoTIFF (WGS 84, pixel is point,
+    # NaN as nodata), rows from north to south, by blocks of rows.
+    rows = slice(None) if grid.lat_step <= 0 else slice(None, None, -1)
+    columns = slice(None) if grid.lng_step >= 0 else slice(None, None, -1)
+    data_size = grid.size * GRID_DTYPE.itemsize
+    geo_keys = [1, 1, 0, 3,
+                KEY_MODEL_TYPE, 0, 1, MODEL_TYPE_GEOGRAPHIC,
+                KEY_RASTER_TYPE, 0, 1, RASTER_PIXEL_IS_POINT,
+                KEY_GEOGRAPHIC_TYPE, 0, 1, GEOGRAPHIC_TYPE_WGS84]
+    # Header, then IFD, then values not fitting in IFD entries, then samples.
+    # Sorted by tag: (tag, TIFF field type, values).
+    entries = [
+        (TAG_IMAGE_WIDTH, 4, [grid.width]),
+        (TAG_IMAGE_LENGTH, 4, [grid.height]),
+        (TAG_BITS_PER_SAMPLE, 3, [32]),
+        (TAG_COMPRESSION, 3, [1]),
+        (TAG_PHOTOMETRIC_INTERPRETATION, 3, [1]),
+        (TAG_STRIP_OFFSETS, 4, [0]),
+        (TAG_SAMPLES_PER_PIXEL, 3, [1]),
+        (TAG_ROWS_PER_STRIP, 4, [grid.height]),
+        (TAG_STRIP_BYTE_COUNTS, 4, [data_size]),
+        (TAG_SAMPLE_FORMAT, 3, [3]),
+        (TAG_MODEL_PIXEL_SCALE, 12, [abs(grid.lng_step), abs(grid.lat_step), 0.0]),
+        (TAG_MODEL_TIEPOINT, 12, [0.0, 0.0, 0.0, grid.west, grid.north, 0.0]),
+        (TAG_GEO_KEY_DIRECTORY, 3, geo_keys),
+        (TAG_GDAL_NODATA, 2, b'nan\0'),
+    ]
+    extra_offset = 8 + 2 + 12 * len(entries) + 4
+    extra_size = sum(len(values) * TIFF_TYPES[field_type][1] for _, field_type, values in entries
+                     if len(values) * TIFF_TYPES[field_type][1] > 4)
+    data_offset = extra_offset + extra_size
+    data_offset += -data_offset % GRID_DTYPE.itemsize
+    if data_offset + data_size >= 1 << 32:
+        raise RuntimeError('Grid too large for a classic TIFF file: %s' % grid)
+    ifd = [struct.pack('<H', len(entries))]
+    extra = []
+    for tag, field_type, values in entries:
+        if tag == TAG_STRIP_OFFSETS:
+            values = [data_offset]
+        if field_type == 2:
+            payload = values
+        else:
+            payload = struct.pack('<%d%s' % (len(values), TIFF_TYPES[field_type][0]), *values)
+        if len(payload) > 4:
+            ifd.append(struct.pack('<HHII', tag, field_type, len(values), extra_offset))
+            extra.append(payload)
+            extra_offset += len(payload)
+        else:
+            ifd.append(struct.pack('<HHI4s', tag, field_type, len(values), payload))
+    ifd.append(struct.pack('<I', 0))
+    with open(path, 'wb') as file:
+        file.write(b'II*\0' + struct.pack('<I', 8))
+        file.write(b''.join(ifd))
+        file.write(b''.join(extra))
+        file.write(b'\0' * (data_offset - file.tell()))
+        altitudes = grid.altitudes[rows, columns]
+        for start in range(0, grid.height, ROWS_PER_BLOCK):
+            np.ascontiguousarray(altitudes[start:(start + ROWS_PER_BLOCK)],
+                                 dtype=GRID_DTYPE).tofile(file)
+
+
+def read_map_metadata(path, compute=True):
+    # type: (str, bool) -> Optional[MapMetadata]
+    # Return metadata of a map file. If file has no metadata, compute it from samples
+    # (reading whole map) if compute is True, else return None.
+    if is_grid_file(path):
+        metadata = read_grid_metadata(path)
+    elif is_tiff_file(path):
+        metadata = None
+    else:
+        metadata = read_text_metadata(path)
+    if metadata is None and compute:
+        grid = load_map(path)
+        metadata = compute_metadata(grid, ascending=not (is_grid_file(path) or is_tiff_file(path)))
+    return metadata
+
+
+def read_map_band(path, north, south):
+    # type: (str, float, float) -> MapGrid
+    # Read rows of a map between latitudes north and south. Binary grids and GeoTIFF files
+    # are memory-mapped, and text maps with metadata are read from the first band row.
+    if is_grid_file(path) or is_tiff_file(path):
+        grid = load_map(path)
+        start, stop = _rows_between(grid.origin_lat, grid.lat_step, grid.height, north, south)
+        return MapGrid(grid.width, stop - start, grid.origin_lat + start * grid.lat_step,
+                       grid.origin_lng, grid.lat_step, grid.lng_step,
+                       grid.altitudes[start:stop], grid.resolutions[start:stop])
+    metadata = read_text_metadata(path)
+    if metadata is None or metadata.row_offsets is None:
+        grid = read_text_map(path)
+        width = grid.width
+        start, stop = _rows_between(grid.origin_lat, grid.lat_step, grid.height, north, south)
+        columns = [np.repeat(grid.latitudes[start:stop], grid.width),
+                   np.tile(grid.longitudes, stop - start),
+                   grid.altitudes[start:stop].ravel(), grid.resolutions[start:stop].ravel()]
+    else:
+        width = metadata.width
+        start, stop = metadata.rows_between(north, south)
+        size = (stop - start) * width
+        lines = []
+        if size:
+            with open(path, 'rb') as file:
+                file.seek(metadata.row_offsets[start])
+                lines = [line.decode() for line in itertools.islice(file, size)]
+        columns = np.loadtxt(lines, dtype=np.float64, ndmin=2).reshape(-1, 4).T
+    return grid_from_columns(width, stop - start, *columns)
+
+
+def load_map(path):
+    # type: (str) -> MapGrid
+    # Read a map file in binary grid, GeoTIFF or text format.
+    if is_grid_file(path):
+        return read_grid(path)
+    if is_tiff_file(path):
+        return read_geotiff_map(path)
+    return read_text_map(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Convert a map file between binary grid, GeoTIFF and text formats.')
+    parser.add_argument('input', type=str, help='Input map file (binary grid, GeoTIFF or text)')
+    parser.add_argument('output', type=str,
+                        help='Output map file. Altitudes are written as GeoTIFF if output file '
+                             'name ends with %s.' % ' or '.join(TIFF_EXTENSIONS))
+    parser.add_argument('--text', '-t', action='store_true',
+                        help='Write output as padded text map instead of binary grid.')
+    args = parser.parse_args()
+    grid = load_map(args.input)
+    print(grid)
+    if args.text:
+        write_text_map(args.output, grid)
+    elif args.output.lower().endswith(TIFF_EXTENSIONS):
+        write_geotiff(args.output, grid)
+    else:
+        write_grid(args.output, grid)
+    print('Output into', args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Append-only journal of fetched elevation queries, to resume interrupted runs.
+
+Journal is a JSON-lines file. First line describes the sampled region; each following
+line holds one completed query: {"row": r, "column": c, "values": [[elevation, resolution], ...]}.
+Lines are flushed as soon as written, so a killed process loses at most the queries in flight.
+A truncated last line (process killed while writing) is ignored on reload.
+"""
+import os
+from typing import Any, Dict, Iterator, List, Tuple
+
+import ujson as json
+
+JOURNAL_EXTENSION = '.journal'
+
+
+class FetchJournal:
+    __slots__ = ('path', 'header', 'file')
+
+    def __init__(self, path, header):
+        # type: (str, Dict[str, Any]) -> None
+        self.path = path
+        self.header = header
+        self.file = None
+
+    def load(self):
+        # type: () -> Iterator[Tuple[int, int, List[List[float]]]]
+        # Yield (row, column, values) of queries already journaled.
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path) as file:
+            first_line = file.readline()
+            if not first_line.endswith('\n'):
+                return
+            header = json.loads(first_line)
+            if header != self.header:
+                raise RuntimeError(
+                    'Journal %s was written for another region (%s), expected %s. '
+                    'Remove it to start over.' % (self.path, header, self.header))
+            for line in file:
+                if not line.endswith('\n'):
+                    break
+                entry = json.loads(line)
+                yield entry['row'], entry['column'], entry['values']
+
+    def open(self):
+        # Open journal for appending, writing header if journal is new or empty.
+        is_new = not os.path.isfile(self.path) or os.path.getsize(self.path) == 0
+        if not is_new:
+            # Drop a truncated last line, if any.
+            with open(self.path, 'rb+') as file:
+                content_end = file.seek(0, os.SEEK_END)
+                position = content_end
+                while position > 0:
+                    file.seek(position - 1)
+                    if file.read(1) == b'\n':
+                        break
+                    position -= 1
+                if position < content_end:
+                    file.truncate(position)
+                is_new = position == 0
+        self.file = open(self.path, 'a')
+        if is_new:
+            self.file.write(json.dumps(self.header) + '\n')
+            self.file.flush()
+
+    def append(self, row, column, values):
+        # type: (int, int, List[List[float]]) -> None
+        self.file.write(json.dumps({'row': row, 'column': column, 'values': values}) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        self.close()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
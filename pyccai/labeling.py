@@ -0,0 +1,202 @@
+"""Connected-component labeling of boolean rasters (e.g. flooded cells of a map grid).
+
+Two passes over the raster, one row at a time. First pass splits each row in runs of
+True cells, gives each run a provisional label and unites it (union-find) with
+overlapping runs of previous row. Second pass writes final labels and accumulates
+per-component statistics. Memory is proportional to number of runs, plus output labels
+(which may be a memory-mapped array). Components can also be only counted, after first pass.
+"""
+from array import array
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+CONNECTIVITY_4 = 4
+CONNECTIVITY_8 = 8
+LABEL_DTYPE = np.int32
+
+
+class Components:
+    # Labels start at 1 (0 is background). Statistics are arrays indexed by label,
+    # entry 0 being unused. Bounding boxes are given in grid rows and columns (inclusive).
+    __slots__ = ('labels', 'count', 'sizes', 'row_min', 'row_max', 'col_min', 'col_max',
+                 'alt_min', 'alt_max')
+
+    def __init__(self, labels, count):
+        # type: (np.ndarray, int) -> None
+        self.labels = labels
+        self.count = count
+        self.sizes = np.zeros(count + 1, dtype=np.int64)
+        self.row_min = np.full(count + 1, np.iinfo(np.int64).max, dtype=np.int64)
+        self.row_max = np.full(count + 1, -1, dtype=np.int64)
+        self.col_min = np.full(count + 1, np.iinfo(np.int64).max, dtype=np.int64)
+        self.col_max = np.full(count + 1, -1, dtype=np.int64)
+        self.alt_min = None  # type: Optional[np.ndarray]
+        self.alt_max = None  # type: Optional[np.ndarray]
+
+    def __len__(self):
+        return self.count
+
+    def bounding_box(self, label):
+        # type: (int) -> Tuple[int, int, int, int]
+        return (int(self.row_min[label]), int(self.row_max[label]),
+                int(self.col_min[label]), int(self.col_max[label]))
+
+    def __str__(self):
+        return 'Components(count=%d, largest=%d)' % (
+            self.count, self.sizes.max() if self.count else 0)
+
+    def __repr__(self):
+        return str(self)
+
+
+def row_runs(row):
+    # type: (np.ndarray) -> Tuple[np.ndarray, np.ndarray]
+    # Return (starts, ends) of runs of True values in a boolean row, ends being exclusive.
+    padded = np.zeros(len(row) + 2, dtype=np.int8)
+    padded[1:-1] = row
+    changes = np.flatnonzero(np.diff(padded))
+    return changes[0::2], changes[1::2]
+
+
+def _find(parent, x):
+    # type: (array, int) -> int
+    while parent[x] != x:
+        parent[x] = parent[parent[x]]
+        x = parent[x]
+    return x
+
+
+def _overlaps(prev_starts, prev_ends, starts, ends, connectivity):
+    # For each current run, range [lo, hi) of previous-row runs touching it.
+    if connectivity == CONNECTIVITY_8:
+        lo = np.searchsorted(prev_ends, starts, side='left')
+        hi = np.searchsorted(prev_starts, ends, side='right')
+    else:
+        lo = np.searchsorted(prev_ends, starts, side='right')
+        hi = np.searchsorted(prev_starts, ends, side='left')
+    return lo, hi
+
+
+def _unite_runs(mask, connectivity):
+    # type: (np.ndarray, int) -> Tuple[array, np.ndarray]
+    # First pass: provisional labels per run, united with touching runs of previous row.
+    # Return union-find parents of runs, and offset of first run of each row (plus total).
+    if connectivity not in (CONNECTIVITY_4, CONNECTIVITY_8):
+        raise ValueError('Connectivity must be 4 or 8, got %s' % connectivity)
+    height = mask.shape[0]
+    parent = array('q')
+    row_offsets = np.zeros(height + 1, dtype=np.int64)
+    prev_starts = prev_ends = np.empty(0, dtype=np.intp)
+    prev_offset = 0
+    for r in range(height):
+        starts, ends = row_runs(mask[r])
+        offset = len(parent)
+        row_offsets[r] = offset
+        parent.extend(range(offset, offset + len(starts)))
+        if len(starts) and len(prev_starts):
+            lo, hi = _overlaps(prev_starts, prev_ends, starts, ends, connectivity)
+            for k in np.flatnonzero(hi > lo).tolist():
+                x = _find(parent, offset + k)
+                for j in range(int(lo[k]), int(hi[k])):
+                    y = _find(parent, prev_offset + j)
+                    if x < y:
+                        parent[y] = x
+                    elif y < x:
+                        parent[x] = y
+                        x = y
+        prev_starts, prev_ends, prev_offset = starts, ends, offset
+    row_offsets[height] = len(parent)
+    return parent, row_offsets
+
+
+def count_components(mask, connectivity=CONNECTIVITY_4):
+    # type: (np.ndarray, int) -> int
+    # Count connected True cells of a 2D boolean raster, without labeling cells.
+    parent, _ = _unite_runs(mask, connectivity)
+    if not len(parent):
+        return 0
+    # Roots are the runs which are their own parent.
+    parents = np.frombuffer(parent, dtype=np.int64)
+    return int(np.count_nonzero(parents == np.arange(len(parents))))
+
+
+def label_components(mask, connectivity=CONNECTIVITY_4, altitudes=None, out=None):
+    # type: (np.ndarray, int, Optional[np.ndarray], Optional[np.ndarray]) -> Components
+    # Label connected True cells of a 2D boolean raster.
+    # If altitudes (same shape) are given, per-component min/max altitudes are computed.
+    # If out is given (e.g. np.memmap), labels are written into it.
+    height, width = mask.shape
+    parent, row_offsets = _unite_runs(mask, connectivity)
+
+    # Resolve roots by pointer jumping, then number roots consecutively from 1.
+    roots = np.frombuffer(parent, dtype=np.int64).copy() if len(parent) else np.empty(
+        0, dtype=np.int64)
+    del parent
+    while True:
+        jumped = roots[roots]
+        if np.array_equal(jumped, roots):
+            break
+        roots = jumped
+    is_root = roots == np.arange(len(roots))
+    final = (np.cumsum(is_root) if len(roots) else roots)[roots].astype(LABEL_DTYPE)
+    del roots, is_root
+    count = int(final.max()) if len(final) else 0
+
+    # Second pass: write labels and accumulate statistics.
+    labels = out if out is not None else np.zeros((height, width), dtype=LABEL_DTYPE)
+    components = Components(labels, count)
+    if altitudes is not None:
+        components.alt_min = np.full(count + 1, np.inf, dtype=np.float64)
+        components.alt_max = np.full(count + 1, -np.inf, dtype=np.float64)
+    for r in range(height):
+        labels[r] = 0
+        run_labels = final[row_offsets[r]:row_offsets[r + 1]]
+        if not len(run_labels):
+            continue
+        starts, ends = row_runs(mask[r])
+        lengths = ends - starts
+        cells = np.flatnonzero(mask[r])
+        cell_labels = np.repeat(run_labels, lengths)
+        labels[r, cells] = cell_labels
+        np.add.at(components.sizes, run_labels, lengths)
+        # Rows are scanned in increasing order.
+        components.row_min[run_labels] = np.minimum(components.row_min[run_labels], r)
+        components.row_max[run_labels] = r
+        np.minimum.at(components.col_min, run_labels, starts)
+        np.maximum.at(components.col_max, run_labels, ends - 1)
+        if altitudes is not None:
+            cell_altitudes = altitudes[r, cells]
+            np.minimum.at(components.alt_min, cell_labels, cell_altitudes)
+            np.maximum.at(components.alt_max, cell_labels, cell_altitudes)
+    return components
+
+
+def count_band_components(counts, first_columns, last_columns, connectivity=CONNECTIVITY_4):
+    # type: (Sequence[int], Sequence[np.ndarray], Sequence[np.ndarray], int) -> int
+    # Count connected components of a raster split into bands of consecutive columns,
+    # each labeled separately: band i has counts[i] components, and labels first_columns[i]
+    # and last_columns[i] in its first and last columns. Components touching across band
+    # edges are merged (union-find on band labels shifted to global labels).
+    offsets = np.concatenate(([0], np.cumsum(counts))).tolist()
+    parent = array('q', range(offsets[-1] + 1))
+    nb_merges = 0
+    shifts = (-1, 0, 1) if connectivity == CONNECTIVITY_8 else (0,)
+    for band in range(len(counts) - 1):
+        left = last_columns[band]
+        right = first_columns[band + 1]
+        for shift in shifts:
+            # Pairs of cells (r, last column of band) and (r + shift, first column of next band).
+            a = left[max(0, -shift):(len(left) - max(0, shift))]
+            b = right[max(0, shift):(len(right) - max(0, -shift))]
+            touching = (a > 0) & (b > 0)
+            pairs = np.unique(np.stack((a[touching].astype(np.int64) + offsets[band],
+                                        b[touching].astype(np.int64) + offsets[band + 1]),
+                                       axis=1), axis=0)
+            for x, y in pairs.tolist():
+                x = _find(parent, x)
+                y = _find(parent, y)
+                if x != y:
+                    parent[max(x, y)] = min(x, y)
+                    nb_merges += 1
+    return offsets[-1] - nb_merges
@@ -0,0 +1,206 @@
+"""Load test of the heightmap elevation fetch pipeline.
+
+A synthetic sampling grid of width x height cells is fetched through the same pipeline as
+heightmap: queries planned by pyccai.planner, sent by GoogleElevationProvider through
+keep-alive connections, paced and retried by a RequestScheduler, and assembled into rows.
+By default, requests go to a local pyccai.elevation_server started in a separate process
+with given latency, error and QPS options (fetched elevations are then checked against its
+synthetic terrain). Use --base-url to target another server. Reports requests/s, samples/s
+and request latency percentiles.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import platform
+import urllib.parse
+import urllib.request
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+import numpy as np
+import ujson as json
+
+from pyccai.elevation import GoogleElevationProvider
+from pyccai.elevation_server import (DEFAULT_HOST, add_server_arguments, server_from_arguments,
+                                     synthetic_elevations)
+from pyccai.fetcher import DEFAULT_CONCURRENCY
+from pyccai.grid import GRID_DTYPE
+from pyccai.planner import PlanSummary, Query, plan_queries
+from pyccai.profiling import Profiler
+from pyccai.ratelimit import DEFAULT_MAX_RETRIES, RequestScheduler
+
+ORIGIN_LAT = 45.6
+ORIGIN_LNG = -73.8
+LAT_STEP = -0.0001
+LNG_STEP = 0.00013
+LATENCY_PERCENTILES = (50, 90, 99, 99.9)
+SERVER_START_TIMEOUT = 30
+
+
+def _run_server(args, connection):
+    # Server process: serve on a free port, and send port through connection.
+    server = server_from_arguments(args)
+    asyncio.run(server.serve(DEFAULT_HOST, 0, on_started=connection.send))
+
+
+def start_local_server(args):
+    # type: (argparse.Namespace) -> Tuple[multiprocessing.Process, str]
+    # Start an elevation server process with server options from args.
+    # Return process and its elevation API URL.
+    parent_connection, child_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_run_server, args=(args, child_connection),
+                                      daemon=True)
+    process.start()
+    if not parent_connection.poll(SERVER_START_TIMEOUT):
+        process.terminate()
+        raise RuntimeError('Elevation server did not start')
+    return process, 'http://%s:%d/json' % (DEFAULT_HOST, parent_connection.recv())
+
+
+def get_server_statistics(base_url):
+    # type: (str) -> Optional[dict]
+    # Return counters of a pyccai.elevation_server, None if server does not provide them.
+    parsed = urllib.parse.urlsplit(base_url)
+    try:
+        with urllib.request.urlopen('%s://%s/stats' % (parsed.scheme, parsed.netloc)) as response:
+            return json.loads(response.read().decode())
+    except (OSError, ValueError):
+        return None
+
+
+def run_load_test(base_url, width, height, concurrency=DEFAULT_CONCURRENCY, qps=None,
+                  max_retries=DEFAULT_MAX_RETRIES):
+    # type: (str, int, int, int, Optional[float], int) -> Tuple[dict, tuple, np.ndarray]
+    # Fetch a width x height sampling grid from elevation API at base_url.
+    # Return report, (latitudes, longitudes) of grid rows and columns, and elevations.
+    latitudes = ORIGIN_LAT + np.arange(height) * LAT_STEP
+    longitudes = ORIGIN_LNG + np.arange(width) * LNG_STEP
+    scheduler = RequestScheduler(concurrency, qps, max_retries)
+    latencies = []  # type: List[float]
+    provider = GoogleElevationProvider(base_url, concurrency, scheduler, latencies)
+    elevations = np.full((height, width), np.nan, dtype=GRID_DTYPE)
+    summary = PlanSummary()
+
+    def iter_queries():
+        runs = ((row, np.zeros(1, dtype=np.int64), np.full(1, width, dtype=np.int64))
+                for row in range(height))
+        for query in plan_queries(runs, width, provider.max_samples,
+                                  provider.locations_capacity(latitudes, longitudes)):
+            summary.add(query)
+            yield query
+
+    def on_result(query, output):
+        # type: (Query, list) -> None
+        values = np.array(output, dtype=np.float64).reshape(-1, 2)
+        offset = 0
+        for row, column, length in query.spans:
+            elevations[row, column:(column + length)] = values[offset:(offset + length), 0]
+            offset += length
+
+    with Profiler('fetch elevations.', verbose=False) as profiler:
+        provider.fetch(latitudes, longitudes, iter_queries(), on_result)
+    seconds = profiler.span.duration
+    report = {
+        'base_url': base_url,
+        'width': width,
+        'height': height,
+        'concurrency': concurrency,
+        'qps': qps,
+        'seconds': seconds,
+        'path_queries': summary.nb_path_queries,
+        'locations_queries': summary.nb_locations_queries,
+        'samples': summary.nb_samples,
+        'requests': len(latencies),
+        'retries': scheduler.nb_retries,
+        'throttled': scheduler.nb_throttled,
+        'requests_per_second': len(latencies) / seconds,
+        'queries_per_second': summary.nb_queries / seconds,
+        'samples_per_second': summary.nb_samples / seconds,
+        'missing': int(np.isnan(elevations).sum()),
+        'scheduler': str(scheduler),
+        'latency': {},
+    }
+    if latencies:
+        values = np.percentile(latencies, LATENCY_PERCENTILES).tolist()
+        report['latency'] = {'p%g' % percentile: value
+                             for percentile, value in zip(LATENCY_PERCENTILES, values)}
+        report['latency']['mean'] = float(np.mean(latencies))
+        report['latency']['max'] = max(latencies)
+    return report, (latitudes, longitudes), elevations
+
+
+def print_report(report):
+    # type: (dict) -> None
+    print('Fetched %d x %d = %d sample(s) in %.3f sec with %d concurrent request(s).' % (
+        report['width'], report['height'], report['samples'], report['seconds'],
+        report['concurrency']))
+    print('Queries: %d path, %d locations; %d request(s), %d retry(ies), %d throttled.' % (
+        report['path_queries'], report['locations_queries'], report['requests'],
+        report['retries'], report['throttled']))
+    print('Throughput: %.1f requests/s, %.1f queries/s, %.1f samples/s.' % (
+        report['requests_per_second'], report['queries_per_second'],
+        report['samples_per_second']))
+    if report['latency']:
+        print('Latency (ms):', ', '.join('%s %.1f' % (name, value * 1000)
+                                         for name, value in report['latency'].items()))
+    print('Final', report['scheduler'])
+    if report.get('server'):
+        print('Server: %(requests)d request(s), %(samples)d sample(s), statuses %(statuses)s'
+              % report['server'])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Load test heightmap elevation fetch pipeline against an elevation API server.')
+    parser.add_argument('--width', '-W', type=int, default=2000,
+                        help='Sampling grid width, in cells (default: 2000).')
+    parser.add_argument('--height', '-H', type=int, default=50,
+                        help='Sampling grid height, in cells (default: 50).')
+    parser.add_argument('--concurrency', '-n', type=int, default=DEFAULT_CONCURRENCY,
+                        help='Maximum number of requests in flight '
+                             '(default: %d).' % DEFAULT_CONCURRENCY)
+    parser.add_argument('--qps', type=float, default=0,
+                        help='Client maximum number of requests per second '
+                             '(default: 0, no limit).')
+    parser.add_argument('--max-retries', type=int, default=DEFAULT_MAX_RETRIES,
+                        help='Maximum number of retries per request on transient errors '
+                             '(default: %d).' % DEFAULT_MAX_RETRIES)
+    parser.add_argument('--base-url', type=str, default=None,
+                        help='Elevation API URL. By default, a local elevation server is '
+                             'started with server options below.')
+    parser.add_argument('--label', type=str, default=None,
+                        help='Label saved with report, e.g. a version name.')
+    parser.add_argument('--output', '-o', type=str, default=None,
+                        help='Write report as JSON into this file.')
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    process = None
+    base_url = args.base_url
+    if base_url is None:
+        process, base_url = start_local_server(args)
+        print('Started elevation server on', base_url)
+    try:
+        report, (latitudes, longitudes), elevations = run_load_test(
+            base_url, args.width, args.height, args.concurrency, args.qps or None,
+            args.max_retries)
+        report['server'] = get_server_statistics(base_url)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.join()
+    if process is not None:
+        expected = synthetic_elevations(latitudes[:, None], longitudes[None, :])
+        report['valid'] = bool(np.allclose(elevations, expected, atol=1e-3))
+    report.update(label=args.label, date=datetime.now().isoformat(),
+                  python=platform.python_version(), platform=platform.platform())
+    print_report(report)
+    if 'valid' in report:
+        print('Elevations match server terrain:', report['valid'])
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(json.dumps(report, indent=2))
+        print('Report saved in', args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""Plan elevation queries for missing cells of a sampling grid.
+
+Missing cells come as runs of consecutive columns in grid rows. A path query samples up to
+max_samples consecutive cells of a row in one request; a locations query samples up to
+locations_capacity arbitrary cells. Each run is split into path queries of max_samples cells,
+and its remainder, if not longer than locations_capacity, is packed with other remainders
+into locations queries instead of taking a path query of its own. Under a cost of one per
+request, this is the cheapest mix: moving a remainder of r <= locations_capacity cells to
+locations queries saves one path query and adds at most one locations query.
+"""
+from typing import Any, Iterable, Iterator, List, Tuple
+
+# (row, first column, number of columns)
+Span = Tuple[int, int, int]
+
+
+class Query:
+    # Cells to fetch in one request, as spans of consecutive cells. A path query has one span.
+    __slots__ = ('spans', 'path')
+
+    def __init__(self, spans, path):
+        # type: (List[Span], bool) -> None
+        self.spans = spans
+        self.path = path
+
+    @property
+    def size(self):
+        return sum(span[2] for span in self.spans)
+
+    def __str__(self):
+        return '%s(%s)' % ('Path' if self.path else 'Locations', self.spans)
+
+    def __repr__(self):
+        return str(self)
+
+
+class PlanSummary:
+    __slots__ = ('nb_path_queries', 'nb_path_samples', 'nb_locations_queries',
+                 'nb_locations_samples', 'nb_missing')
+
+    def __init__(self):
+        self.nb_path_queries = 0
+        self.nb_path_samples = 0
+        self.nb_locations_queries = 0
+        self.nb_locations_samples = 0
+        self.nb_missing = 0
+
+    @property
+    def nb_queries(self):
+        return self.nb_path_queries + self.nb_locations_queries
+
+    @property
+    def nb_samples(self):
+        return self.nb_path_samples + self.nb_locations_samples
+
+    def add(self, query):
+        # type: (Query) -> None
+        if query.path:
+            self.nb_path_queries += 1
+            self.nb_path_samples += query.size
+        else:
+            self.nb_locations_queries += 1
+            self.nb_locations_samples += query.size
+
+    def __str__(self):
+        return ('%d request(s): %d path query(ies) for %d sample(s), '
+                '%d locations query(ies) for %d sample(s); '
+                '%d sample(s) requested for %d missing point(s)' % (
+                    self.nb_queries, self.nb_path_queries, self.nb_path_samples,
+                    self.nb_locations_queries, self.nb_locations_samples,
+                    self.nb_samples, self.nb_missing))
+
+
+def split_run(row, start, end, width, max_samples):
+    # type: (int, int, int, int, int) -> List[Span]
+    # Split missing columns [start, end) of a row into path spans of at most max_samples
+    # cells. A path needs at least 2 samples, so a single missing column is queried along
+    # with a neighbour column.
+    if end - start == 1:
+        start = max(0, min(start, width - 2))
+        return [(row, start, 2)]
+    spans = []
+    cursor = start
+    while cursor < end:
+        stop = min(cursor + max_samples, end)
+        if end - stop == 1:
+            stop -= 1
+        spans.append((row, cursor, stop - cursor))
+        cursor = stop
+    return spans
+
+
+def plan_queries(runs, width, max_samples, locations_capacity=0):
+    # type: (Iterable[Tuple[int, Any, Any]], int, int, int) -> Iterator[Query]
+    # Yield queries for missing runs given as (row, starts, ends) by increasing row,
+    # starts and ends being numpy arrays, with run i covering columns [starts[i], ends[i]).
+    # If locations_capacity is 0, only path queries are planned.
+    pool = []  # type: List[Span]
+    pool_size = 0
+    for row, starts, ends in runs:
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            remainder = (end - start) % max_samples
+            if 0 < remainder <= locations_capacity:
+                end -= remainder
+                pool.append((row, end, remainder))
+                pool_size += remainder
+            if end > start:
+                for span in split_run(row, start, end, width, max_samples):
+                    yield Query([span], True)
+            while pool_size >= locations_capacity > 0:
+                spans, pool, pool_size = _take_locations(pool, locations_capacity)
+                yield Query(spans, False)
+    if pool:
+        yield Query(pool, False)
+
+
+def plan_grid(width, height, max_samples, locations_capacity=0):
+    # type: (int, int, int, int) -> PlanSummary
+    # Summary of queries planned by plan_queries when all cells of a grid are missing,
+    # computed without planning them.
+    summary = PlanSummary()
+    summary.nb_missing = width * height
+    remainder = width % max_samples
+    if 0 < remainder <= locations_capacity:
+        summary.nb_path_queries = (width // max_samples) * height
+        summary.nb_path_samples = (width - remainder) * height
+        summary.nb_locations_samples = remainder * height
+        summary.nb_locations_queries = -(-summary.nb_locations_samples // locations_capacity)
+    else:
+        summary.nb_path_queries = -(-width // max_samples) * height
+        summary.nb_path_samples = max(width, 2) * height
+    return summary
+
+
+def _take_locations(pool, capacity):
+    # type: (List[Span], int) -> Tuple[List[Span], List[Span], int]
+    # Take spans for capacity cells from pool, splitting last span if needed.
+    # Return taken spans, spans left and number of cells left.
+    taken = []
+    count = 0
+    left = []  # type: List[Span]
+    for index, (row, column, length) in enumerate(pool):
+        size = min(length, capacity - count)
+        taken.append((row, column, size))
+        count += size
+        if count == capacity:
+            left = pool[(index + 1):]
+            if size < length:
+                left.insert(0, (row, column + size, length - size))
+            break
+    return taken, left, sum(span[2] for span in left)
@@ -1,13 +1,37 @@
-from datetime import datetime
+"""Profiling spans: nested timed sections, with counters and optional peak memory.
+
+Each Profiler section (context manager, or @profiled function call) records a span in TRACE:
+start and end on a monotonic clock, counters added with count(), and, if memory tracking is
+enabled, peak memory traced by tracemalloc while span was open. Spans opened inside another
+span are its children. Finished spans can be written as a JSON tree or as a Chrome trace
+(chrome://tracing, Perfetto).
+"""
+import functools
+import os
+import threading
+import time
+import tracemalloc
+from datetime import timedelta
+from typing import Callable, Dict, List, Optional
+
+import ujson as json
 
 
 class Profile(object):
+    # Duration between two times: datetimes, or numbers of seconds.
     __slots__ = ('seconds', 'microseconds')
 
     def __init__(self, time_start, time_end):
         difference = time_end - time_start
-        self.seconds = difference.seconds + difference.days * 24 * 3600
-        self.microseconds = difference.microseconds
+        if isinstance(difference, timedelta):
+            self.seconds = difference.seconds + difference.days * 24 * 3600
+            self.microseconds = difference.microseconds
+        else:
+            self.seconds, self.microseconds = divmod(int(round(difference * 1000000)), 1000000)
+
+    @property
+    def total_microseconds(self):
+        return self.seconds * 1000000 + self.microseconds
 
     def __str__(self):
         hours = self.seconds // 3600
@@ -25,21 +49,224 @@ class Profile(object):
         return '(%s)' % (' '.join(pieces) if pieces else '0 sec')
 
 
+class Span:
+    __slots__ = ('title', 'start', 'end', 'counters', 'peak_memory', 'children')
+
+    def __init__(self, title, start):
+        # type: (str, float) -> None
+        self.title = title
+        self.start = start
+        self.end = None  # type: Optional[float]
+        self.counters = {}  # type: Dict[str, float]
+        # Peak of memory traced by tracemalloc while span was open, in bytes.
+        self.peak_memory = None  # type: Optional[int]
+        self.children = []  # type: List[Span]
+
+    @property
+    def duration(self):
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    @property
+    def profile(self):
+        return Profile(0, self.duration)
+
+    def count(self, name, value=1):
+        # type: (str, float) -> None
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_json(self, origin=0.0):
+        # type: (float) -> dict
+        # Times are in seconds since origin.
+        return {
+            'title': self.title,
+            'start': self.start - origin,
+            'duration': self.duration,
+            'counters': self.counters,
+            'peak_memory': self.peak_memory,
+            'children': [child.to_json(origin) for child in self.children],
+        }
+
+    def __str__(self):
+        pieces = [self.title, str(self.profile)]
+        pieces.extend('%s=%s' % item for item in self.counters.items())
+        if self.peak_memory is not None:
+            pieces.append('peak memory %.1f MB' % (self.peak_memory / (1 << 20)))
+        return ' '.join(pieces)
+
+
+class Trace:
+    # Spans recorded by Profiler sections. If memory is True, tracemalloc is started on first
+    # span and peak memory of each span is recorded (this slows allocations down).
+    __slots__ = ('memory', 'origin', 'spans', 'stack')
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.origin = time.perf_counter()
+        self.spans = []  # type: List[Span]
+        self.stack = []  # type: List[Span]
+
+    @property
+    def current(self):
+        # type: () -> Optional[Span]
+        return self.stack[-1] if self.stack else None
+
+    def _collect_peak(self):
+        # Give peak memory since last collection to open spans, then reset peak.
+        peak = tracemalloc.get_traced_memory()[1]
+        for span in self.stack:
+            span.peak_memory = max(span.peak_memory or 0, peak)
+        tracemalloc.reset_peak()
+
+    def open(self, title):
+        # type: (str) -> Span
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self._collect_peak()
+        span = Span(title, time.perf_counter())
+        if self.memory:
+            span.peak_memory = tracemalloc.get_traced_memory()[0]
+        (self.stack[-1].children if self.stack else self.spans).append(span)
+        self.stack.append(span)
+        return span
+
+    def close(self, span):
+        # type: (Span) -> None
+        span.end = time.perf_counter()
+        if self.memory and tracemalloc.is_tracing():
+            self._collect_peak()
+        # Spans left open by an exception inside this one are closed with it.
+        while self.stack:
+            closed = self.stack.pop()
+            if closed.end is None:
+                closed.end = span.end
+            if closed is span:
+                break
+
+    def to_json(self):
+        return [span.to_json(self.origin) for span in self.spans]
+
+    def to_chrome_trace(self):
+        # Complete events ("X"), with times in microseconds.
+        events = []
+        pid = os.getpid()
+        tid = threading.get_ident()
+
+        def add(span):
+            arguments = dict(span.counters)
+            if span.peak_memory is not None:
+                arguments['peak_memory'] = span.peak_memory
+            events.append({
+                'name': span.title,
+                'ph': 'X',
+                'ts': (span.start - self.origin) * 1000000,
+                'dur': span.duration * 1000000,
+                'pid': pid,
+                'tid': tid,
+                'args': arguments,
+            })
+            for child in span.children:
+                add(child)
+
+        for root in self.spans:
+            add(root)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, path, chrome=False):
+        # type: (str, bool) -> None
+        with open(path, 'w') as file:
+            file.write(json.dumps(self.to_chrome_trace() if chrome else self.to_json()))
+
+    def clear(self):
+        self.origin = time.perf_counter()
+        self.spans.clear()
+        self.stack.clear()
+
+
+TRACE = Trace()
+
+
+def count(name, value=1):
+    # type: (str, float) -> None
+    # Add value to a counter of innermost open span, if any.
+    span = TRACE.current
+    if span is not None:
+        span.count(name, value)
+
+
 class Profiler(object):
-    __slots__ = ('__title', '__time_start', '__time_end')
+    # Section recorded as a span in TRACE. If verbose, section start and end are printed.
+    __slots__ = ('__title', '__verbose', '__span')
     DEFAULT_PLACE_HOLDER = '__time__'
 
-    def __init__(self, title):
+    def __init__(self, title, verbose=True):
+        # type: (str, bool) -> None
         self.__title = title
-        self.__time_start = None
-        self.__time_end = None
+        self.__verbose = verbose
+        self.__span = None  # type: Optional[Span]
+
+    @property
+    def span(self):
+        # type: () -> Optional[Span]
+        return self.__span
+
+    def count(self, name, value=1):
+        # type: (str, float) -> None
+        self.__span.count(name, value)
 
     def __enter__(self):
-        print('[starting]', self.__title)
-        self.__time_start = datetime.now()
+        if self.__verbose:
+            print('[starting]', self.__title)
+        self.__span = TRACE.open(self.__title)
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.__time_end = datetime.now()
-        profiling = Profile(self.__time_start, self.__time_end)
-        print('[ending]', self.__title, profiling)
-        print()
+        TRACE.close(self.__span)
+        if self.__verbose:
+            print('[ending]', self.__span)
+            print()
+
+
+def profiled(title=None, verbose=False):
+    # type: (Optional[str], bool) -> Callable
+    # Decorator recording each call of a function as a span (titled by function name
+    # by default).
+    def decorator(function):
+        span_title = title or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with Profiler(span_title, verbose):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def add_profiling_arguments(parser):
+    # Add profiling options to an argparse parser.
+    parser.add_argument('--profile', type=str, default=None,
+                        help='Write profiling spans (durations, counters, peak memory) '
+                             'as a JSON tree into this file.')
+    parser.add_argument('--chrome-trace', type=str, default=None,
+                        help='Write profiling spans as a Chrome trace (chrome://tracing, '
+                             'Perfetto) into this file.')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='Record peak memory of each profiling span with tracemalloc '
+                             '(slows allocations down).')
+
+
+def setup_profiling(args):
+    # Configure TRACE from parsed profiling options.
+    TRACE.memory = args.profile_memory
+
+
+def save_profiling(args):
+    # Write TRACE into files requested by parsed profiling options.
+    if args.profile:
+        TRACE.save(args.profile)
+        print('Profile saved in', args.profile)
+    if args.chrome_trace:
+        TRACE.save(args.chrome_trace, chrome=True)
+        print('Chrome trace saved in', args.chrome_trace)
@@ -0,0 +1,197 @@
+"""Request scheduling for quota-limited APIs: rate limiting, adaptive concurrency and retries.
+
+RequestScheduler combines:
+- an AIMD limit on requests in flight: limit grows by ~1 per round of successful requests
+  (additive increase), and is multiplied by DECREASE_FACTOR on throttling errors, HTTP 5xx
+  server errors, or when latency rises well above its baseline (multiplicative decrease, at
+  most once per DECREASE_INTERVAL);
+- a token bucket limiting request rate (queries per second), following same AIMD rule:
+  rate grows by about RATE_INCREASE queries per second every second, and is multiplied by
+  RATE_DECREASE_FACTOR on congestion. If no rate is configured, bucket is created on first
+  throttling error, starting from currently observed rate;
+- per-request retries on transient errors (connection and timeout errors, transient HTTP and
+  API statuses), with exponential backoff and full jitter. Other network errors, such as
+  TLS certificate or DNS resolution failures, are not retried. Only requests are retried:
+  their results are handled once, after they succeed.
+"""
+import asyncio
+import collections
+import random
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from pyccai.fetcher import HttpError
+
+TRANSIENT_API_STATUSES = ('OVER_QUERY_LIMIT', 'UNKNOWN_ERROR')
+TRANSIENT_HTTP_STATUSES = (429, 500, 502, 503, 504)
+THROTTLE_API_STATUSES = ('OVER_QUERY_LIMIT',)
+DEFAULT_MAX_RETRIES = 8
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60.0
+DECREASE_FACTOR = 0.5
+RATE_DECREASE_FACTOR = 0.8
+RATE_INCREASE = 1.0
+MIN_CONCURRENCY = 1
+MIN_RATE = 0.5
+LATENCY_TOLERANCE = 3.0
+LATENCY_MIN_EXCESS = 0.1
+LATENCY_SMOOTHING = 0.1
+DECREASE_INTERVAL = 1.0
+
+
+def is_transient(error):
+    # type: (BaseException) -> bool
+    if isinstance(error, HttpError):
+        return error.status in TRANSIENT_HTTP_STATUSES
+    if isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError,
+                          asyncio.IncompleteReadError)):
+        return True
+    return isinstance(error, RuntimeError) and str(error) in TRANSIENT_API_STATUSES
+
+
+def is_throttling(error):
+    # type: (BaseException) -> bool
+    if isinstance(error, HttpError):
+        return error.status == 429
+    return isinstance(error, RuntimeError) and str(error) in THROTTLE_API_STATUSES
+
+
+def is_server_error(error):
+    # type: (BaseException) -> bool
+    return isinstance(error, HttpError) and 500 <= error.status < 600
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity=None):
+        # type: (float, Optional[float]) -> None
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RequestScheduler:
+    __slots__ = ('max_concurrency', 'limit', 'in_flight', 'bucket', 'max_rate', 'max_retries',
+                 'latency', 'baseline_latency', 'last_decrease', 'condition', 'completions',
+                 'nb_retries', 'nb_throttled')
+
+    def __init__(self, max_concurrency, rate=None, max_retries=DEFAULT_MAX_RETRIES):
+        # type: (int, Optional[float], int) -> None
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.bucket = TokenBucket(rate) if rate else None
+        self.max_rate = rate
+        self.max_retries = max_retries
+        self.latency = None  # type: Optional[float]
+        self.baseline_latency = None  # type: Optional[float]
+        self.last_decrease = 0.0
+        self.condition = None  # type: Optional[asyncio.Condition]
+        # Times of successful requests during last second.
+        self.completions = collections.deque()
+        self.nb_retries = 0
+        self.nb_throttled = 0
+
+    async def _acquire(self):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        if self.bucket is not None:
+            await self.bucket.acquire()
+
+    async def _release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def _increase(self):
+        # Additive increase: about +1 in flight per round of `limit` successful requests,
+        # and about +RATE_INCREASE queries per second every second.
+        now = time.monotonic()
+        self.completions.append(now)
+        while self.completions[0] < now - 1:
+            self.completions.popleft()
+        self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+        if self.bucket is not None:
+            rate = self.bucket.rate + RATE_INCREASE / self.bucket.rate
+            self.bucket.rate = min(self.max_rate, rate) if self.max_rate else rate
+
+    def _decrease(self, throttled):
+        # type: (bool) -> None
+        # Multiplicative decrease, at most once per DECREASE_INTERVAL or smoothed latency.
+        now = time.monotonic()
+        if now - self.last_decrease < max(DECREASE_INTERVAL, self.latency or 0):
+            return
+        self.last_decrease = now
+        self.limit = max(float(MIN_CONCURRENCY), self.limit * DECREASE_FACTOR)
+        if self.bucket is None:
+            if not throttled:
+                return
+            self.bucket = TokenBucket(max(MIN_RATE, len(self.completions)), capacity=1)
+        self.bucket.rate = max(MIN_RATE, self.bucket.rate * RATE_DECREASE_FACTOR)
+
+    def _observe_latency(self, latency):
+        # type: (float) -> bool
+        # Update smoothed latency. Return True if latency suggests congestion.
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+        if self.baseline_latency is None or self.latency < self.baseline_latency:
+            self.baseline_latency = self.latency
+        return (self.latency > LATENCY_TOLERANCE * self.baseline_latency
+                and self.latency - self.baseline_latency > LATENCY_MIN_EXCESS)
+
+    async def run(self, request, handle):
+        # type: (Callable[[], Awaitable[Any]], Callable[[Any], None]) -> None
+        # Send request(), retrying it on transient errors, then pass its result to handle().
+        # handle() is called once, so that its side effects (e.g. journal) are not repeated.
+        attempt = 0
+        while True:
+            await self._acquire()
+            start = time.monotonic()
+            try:
+                result = await request()
+            except Exception as error:
+                if not is_transient(error) or attempt >= self.max_retries:
+                    raise
+                if is_throttling(error):
+                    self.nb_throttled += 1
+                    self._decrease(True)
+                elif is_server_error(error):
+                    self._decrease(False)
+            else:
+                if self._observe_latency(time.monotonic() - start):
+                    self._decrease(False)
+                else:
+                    self._increase()
+                break
+            finally:
+                await self._release()
+            # Exponential backoff with full jitter.
+            attempt += 1
+            self.nb_retries += 1
+            await asyncio.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)))
+        handle(result)
+
+    def __str__(self):
+        return 'RequestScheduler(limit=%.1f, rate=%s, retries=%d, throttled=%d)' % (
+            self.limit, '%.1f' % self.bucket.rate if self.bucket else None,
+            self.nb_retries, self.nb_throttled)
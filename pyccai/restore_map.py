@@ -1,86 +1,325 @@
-import sys
-from pyccai.heightmap import Profile
-import ujson as json
+"""Rebuild a map file from a JSON dictionary of elevation API responses.
+
+JSON maps path query URLs (a row segment: path=lat,from_lng|lat,to_lng and samples=n) to
+their [[elevation, resolution], ...] values. File is split into shards of whole entries
+(values end at first "]" followed by "]", whitespace aside), parsed in parallel by a pool of
+processes, in two passes, so that memory stays near the size of the output grid:
+1. URLs are parsed (values are skipped) to get each segment's row, first longitude and
+   longitude step. Segments are clustered by step, using buckets of STEP_TOLERANCE, and only
+   the cluster with most samples is kept. Row and column of each segment are then computed
+   from its latitude and first longitude.
+2. Values are parsed into runs of consecutive samples per row, which are written at their
+   place in a preallocated grid.
+Sample coordinates are those of the grid (origin + index * step), not sums of each
+segment's steps, so a text map may differ from segment coordinates by float rounding
+(e.g. -73.7831 instead of -73.78309999999999), and its lines padding with them.
+Entries are scanned whatever the whitespace between JSON tokens. If entries cannot be scanned
+this way, JSON is loaded with json.load and rewritten compactly into a temporary file, which
+is then parsed as above.
+"""
+import argparse
+import json as std_json
+import multiprocessing
+import os
+import re
+import tempfile
 import urllib.parse
+from typing import Dict, Iterator, List, Optional, Tuple
 
-def main():
-    if len(sys.argv) != 3:
-        return
-    json_path = sys.argv[1]
-    output_path = sys.argv[2]
-    print('Opening JSON ...')
-    with open(json_path) as file:
-        data = json.load(file)
-    points = []
-    total_samples = 0
-    count = 0
-    print('Reading JSON ...')
-    for url, values in data.items():
-        parameters = urllib.parse.parse_qs(url.split('?', 1)[1])
-        n_samples = int(parameters['samples'][0])
-        assert len(values) == n_samples > 1
-        total_samples += n_samples
-        string_from, string_to = parameters['path'][0].split('|')
-        string_from_lat, string_from_lng = string_from.split(',')
-        string_to_lat, string_to_lng = string_to.split(',')
-        from_lat = float(string_from_lat)
-        from_lng = float(string_from_lng)
-        to_lat = float(string_to_lat)
-        to_lng = float(string_to_lng)
-        assert from_lat == to_lat
-        lng_gap = to_lng - from_lng
-        estimated_lng_step = lng_gap / (n_samples - 1)
-        latest_point = (from_lat, from_lng, values[0][0], values[0][1], estimated_lng_step)
-        points.append(latest_point)
-        for i in range(n_samples - 2):
-            latest_point = (from_lat, latest_point[1] + estimated_lng_step, values[i + 1][0], values[i + 1][1], estimated_lng_step)
-            points.append(latest_point)
-        points.append((to_lat, to_lng, values[-1][0], values[-1][1], estimated_lng_step))
-        count += 1
-        if count % 2000 == 0:
-            print('Reading entry', count + 1, '/', len(data))
-    print('Finished reading.')
-    assert total_samples == len(points)
-    step_to_points = {}
-    for point in points:
-        step = point[-1]
-        step_to_use = None
-        for saved_step in step_to_points:
-            if abs(saved_step - step) < 1e-10:
-                step_to_use = saved_step
+import numpy as np
+import ujson as json
+
+from pyccai.grid import (ROWS_PER_BLOCK, MapGrid, create_grid, write_grid_metadata,
+                         write_text_map)
+
+STEP_TOLERANCE = 1e-10
+# End of an entry values (end of group 1), in file bytes, then in shard text.
+ENTRY_END = re.compile(rb'(\]\s*\])\s*[,}]')
+VALUES_END = re.compile(r'\]\s*\]')
+ENTRY_SEPARATOR = re.compile(r'[\s,]*')
+KEY_SEPARATOR = re.compile(r'\s*:\s*\[')
+# Shards are between MIN_SHARD_SIZE and MAX_SHARD_SIZE bytes,
+# aiming at SHARDS_PER_PROCESS shards per process for load balancing.
+MIN_SHARD_SIZE = 1 << 20
+MAX_SHARD_SIZE = 1 << 26
+SHARDS_PER_PROCESS = 4
+BOUNDARY_SEARCH_SIZE = 1 << 16
+
+# (start, end) byte range of a JSON file.
+Shard = Tuple[int, int]
+
+
+class EntryScanError(RuntimeError):
+    # JSON entries cannot be scanned without parsing whole JSON.
+    pass
+
+
+def _find_entry_end(file, offset, file_size):
+    # Return first end of entry values from offset, or file size if none.
+    if offset >= file_size:
+        return file_size
+    file.seek(offset)
+    pending = b''
+    position = offset
+    while True:
+        block = file.read(BOUNDARY_SEARCH_SIZE)
+        if not block:
+            return file_size
+        data = pending + block
+        match = ENTRY_END.search(data)
+        if match is not None:
+            return position - len(pending) + match.end(1)
+        # Keep trailing brackets and whitespace, which may start an entry end.
+        pending = data[len(data.rstrip(b' \t\r\n]')):]
+        position += len(block)
+
+
+def find_shards(path, shard_size):
+    # type: (str, int) -> List[Shard]
+    # Split entries of a JSON dictionary file into shards of about shard_size bytes.
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        head = file.read(BOUNDARY_SEARCH_SIZE)
+        opening = head.find(b'{')
+        if opening < 0 or head[:opening].strip():
+            raise EntryScanError('Expected a JSON dictionary in %s' % path)
+        shards = []
+        start = opening + 1
+        while start < file_size:
+            end = _find_entry_end(file, start + shard_size, file_size)
+            shards.append((start, end))
+            start = end
+    return shards
+
+
+def _read_shard(path, shard):
+    # type: (str, Shard) -> str
+    start, end = shard
+    with open(path, 'rb') as file:
+        file.seek(start)
+        return file.read(end - start).decode()
+
+
+def iter_shard_entries(text, with_values=True):
+    # type: (str, bool) -> Iterator[Tuple[str, Optional[str]]]
+    # Yield (url, values) for each entry of a shard text. Values are yielded
+    # as JSON text, or None if with_values is False.
+    decoder = std_json.JSONDecoder()
+    position = 0
+    while True:
+        position = ENTRY_SEPARATOR.match(text, position).end()
+        if position == len(text) or text[position] == '}':
+            if text[position:].strip(' \t\r\n}'):
+                raise EntryScanError('Unexpected end of JSON entry')
+            return
+        if text[position] != '"':
+            raise EntryScanError('Expected a JSON entry key')
+        try:
+            url, cursor = decoder.raw_decode(text, position)
+        except ValueError as exc:
+            raise EntryScanError('Invalid JSON entry key') from exc
+        separator = KEY_SEPARATOR.match(text, cursor)
+        end = VALUES_END.search(text, cursor) if separator is not None else None
+        if end is None:
+            raise EntryScanError('Unexpected end of JSON entry')
+        position = end.end()
+        yield url, text[(separator.end() - 1):position] if with_values else None
+
+
+def parse_segment(url):
+    # type: (str) -> Tuple[float, float, float, int]
+    # Return (lat, from_lng, to_lng, n_samples) of a path query URL.
+    parameters = urllib.parse.parse_qs(url.split('?', 1)[1])
+    n_samples = int(parameters['samples'][0])
+    string_from, string_to = parameters['path'][0].split('|')
+    string_from_lat, string_from_lng = string_from.split(',')
+    string_to_lat, string_to_lng = string_to.split(',')
+    from_lat = float(string_from_lat)
+    to_lat = float(string_to_lat)
+    assert from_lat == to_lat and n_samples > 1
+    return from_lat, float(string_from_lng), float(string_to_lng), n_samples
+
+
+def cluster_steps(steps):
+    # type: (np.ndarray) -> np.ndarray
+    # Return cluster label of each step. Steps closer than STEP_TOLERANCE to a cluster's
+    # first step belong to this cluster. Clusters are looked up in hash buckets of
+    # STEP_TOLERANCE, so only current and neighbour buckets are checked for each step.
+    buckets = {}  # type: Dict[int, List[int]]
+    representatives = []  # type: List[float]
+    labels = np.empty(len(steps), dtype=np.int64)
+    for index, step in enumerate(steps.tolist()):
+        bucket = int(step // STEP_TOLERANCE)
+        label = None
+        for key in (bucket - 1, bucket, bucket + 1):
+            for candidate in buckets.get(key, ()):
+                if abs(representatives[candidate] - step) < STEP_TOLERANCE:
+                    label = candidate
+                    break
+            if label is not None:
                 break
-        if step_to_use is None:
-            step_to_use = step
-        step_to_points.setdefault(step_to_use, []).append(point)
-    max_step, max_points = None, []
-    for step, step_points in step_to_points.items():
-        if len(max_points) < len(step_points):
-            max_step, max_points = step, step_points
-    print('Extracted', len(max_points), 'points')
-    lat_to_nb_points = {}
-    line_length = 0
-    for point in max_points:
-        line_length = max(line_length, len(' '.join(str(value) for value in point[:-1])))
-        lat = point[0]
-        if lat in lat_to_nb_points:
-            lat_to_nb_points[lat] += 1
-        else:
-            lat_to_nb_points[lat] = 1
-    assert len(set(lat_to_nb_points.values())) == 1
-    height = len(lat_to_nb_points)
-    width = next(iter(lat_to_nb_points.values()))
-    print('Size:', width, 'x', height, '=', len(max_points))
-    print('line length', line_length)
-    print('Sorting')
-    max_points.sort(key=lambda val: (val[0], val[1]))
-    print('Sorted, writing into', output_path)
+        if label is None:
+            label = len(representatives)
+            representatives.append(step)
+            buckets.setdefault(bucket, []).append(label)
+        labels[index] = label
+    return labels
+
+
+def _parse_shard_segments(task):
+    # type: (Tuple[str, Shard]) -> np.ndarray
+    # Return (lat, from_lng, to_lng, n_samples) of each entry of a shard.
+    path, shard = task
+    segments = [parse_segment(url)
+                for url, _ in iter_shard_entries(_read_shard(path, shard), with_values=False)]
+    return np.array(segments, dtype=np.float64).reshape(-1, 4)
+
+
+def _parse_shard_values(task):
+    # type: (Tuple[str, Shard, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]
+    # Parse values of kept entries of a shard, given their places, and return them as runs
+    # of consecutive samples in rows: runs (row, first column, length), and their values
+    # (elevation, resolution) concatenated in run order.
+    path, shard, places = task
+    kept_places = []
+    kept_values = []
+    entries = iter_shard_entries(_read_shard(path, shard))
+    for (row, column, n_samples), (_, values) in zip(places.tolist(), entries):
+        if row < 0:
+            continue
+        try:
+            values = json.loads(values)
+        except ValueError as exc:
+            raise EntryScanError('Invalid JSON entry values') from exc
+        values = np.array(values, dtype=np.float64).reshape(-1, 2)
+        assert len(values) == n_samples
+        kept_places.append((row, column, n_samples))
+        kept_values.append(values)
+    if not kept_places:
+        return np.empty((0, 3), dtype=np.int64), np.empty((0, 2), dtype=np.float64)
+    kept_places = np.array(kept_places, dtype=np.int64)
+    order = np.lexsort((kept_places[:, 1], kept_places[:, 0]))
+    kept_places = kept_places[order]
+    values = np.concatenate([kept_values[index] for index in order.tolist()])
+    # An entry starts a new run unless it continues previous entry in same row.
+    ends = kept_places[:, 1] + kept_places[:, 2]
+    starts_run = np.ones(len(kept_places), dtype=bool)
+    starts_run[1:] = ((kept_places[1:, 0] != kept_places[:-1, 0])
+                      | (kept_places[1:, 1] != ends[:-1]))
+    first_entries = np.flatnonzero(starts_run)
+    runs = kept_places[first_entries]
+    runs[:, 2] = np.add.reduceat(kept_places[:, 2], first_entries)
+    return runs, values
+
+
+def plan_grid(segments):
+    # type: (np.ndarray) -> tuple
+    # Return (width, height, south, west, lat_step, lng_step, places) for segments
+    # (lat, from_lng, to_lng, n_samples) of entries, where places give (row, first column,
+    # number of samples) of each entry, with row -1 for entries not kept.
+    lats, from_lngs, to_lngs, n_samples = segments.T
+    labels = cluster_steps((to_lngs - from_lngs) / (n_samples - 1))
+    kept = labels == np.argmax(np.bincount(labels, weights=n_samples))
+    print('Extracted', int(n_samples[kept].sum()), 'points')
+    row_lats, row_of_kept = np.unique(lats[kept], return_inverse=True)
+    row_sizes = np.bincount(row_of_kept, weights=n_samples[kept])
+    assert len(set(row_sizes.tolist())) == 1
+    height = len(row_lats)
+    width = int(row_sizes[0])
+    south = float(row_lats[0])
+    west = float(from_lngs[kept].min())
+    lat_step = float(row_lats[-1] - south) / (height - 1) if height > 1 else 0.0
+    lng_step = float(to_lngs[kept].max() - west) / (width - 1) if width > 1 else 0.0
+    places = np.full((len(segments), 3), -1, dtype=np.int64)
+    places[:, 2] = n_samples
+    # Rows and columns are computed directly from coordinates.
+    places[kept, 0] = np.rint((lats[kept] - south) / lat_step) if height > 1 else 0
+    places[kept, 1] = np.rint((from_lngs[kept] - west) / lng_step) if width > 1 else 0
+    assert np.array_equal(places[kept, 0], row_of_kept)
+    assert (places[kept, 1] + n_samples[kept] <= width).all()
+    return width, height, south, west, lat_step, lng_step, places
+
+
+def write_compact_json(json_path, output_path):
+    # type: (str, str) -> None
+    # Rewrite JSON dictionary of responses without whitespace, one entry after another.
+    with open(json_path) as file:
+        responses = std_json.load(file)
     with open(output_path, 'w') as file:
-        file.write(('# %s %s %s lat lng alt res' % (width, height, len(max_points))).ljust(line_length))
-        file.write('\n')
-        for point in max_points:
-            file.write((' '.join(str(value) for value in point[:-1])).ljust(line_length))
-            file.write('\n')
+        std_json.dump(responses, file, separators=(',', ':'))
+
+
+def rebuild_map(json_path, output_path, text=False, nb_processes=None):
+    # type: (str, str, bool, Optional[int]) -> MapGrid
+    # Rebuild map from JSON file into output path, as a binary grid or a text map.
+    try:
+        return _rebuild_map(json_path, output_path, text, nb_processes)
+    except EntryScanError as exc:
+        print('Cannot scan JSON entries (%s), loading JSON.' % exc)
+    with tempfile.TemporaryDirectory() as directory:
+        compact_path = os.path.join(directory, 'compact.json')
+        write_compact_json(json_path, compact_path)
+        return _rebuild_map(compact_path, output_path, text, nb_processes)
+
+
+def _rebuild_map(json_path, output_path, text, nb_processes):
+    # type: (str, str, bool, Optional[int]) -> MapGrid
+    nb_processes = nb_processes or os.cpu_count() or 1
+    shard_size = os.path.getsize(json_path) // (SHARDS_PER_PROCESS * nb_processes)
+    shards = find_shards(json_path, max(MIN_SHARD_SIZE, min(MAX_SHARD_SIZE, shard_size)))
+    print('Parsing', len(shards), 'shard(s) with', nb_processes, 'process(es)')
+    with multiprocessing.Pool(processes=nb_processes) as pool:
+        print('Reading URLs ...')
+        shard_segments = pool.map(_parse_shard_segments,
+                                  ((json_path, shard) for shard in shards))
+        segments = np.concatenate(shard_segments)
+        print('Read', len(segments), 'entries.')
+        width, height, south, west, lat_step, lng_step, places = plan_grid(segments)
+        print('Size:', width, 'x', height, '=', width * height)
+        if text:
+            # Text map is written from an in-memory grid, keeping values as parsed.
+            grid = MapGrid(width, height, south, west, lat_step, lng_step,
+                           np.full(width * height, np.nan), np.full(width * height, np.nan))
+        else:
+            grid = create_grid(output_path, width, height, south, west, lat_step, lng_step)
+        print('Placing values ...')
+        shard_ends = np.cumsum([len(entries) for entries in shard_segments]).tolist()
+        tasks = ((json_path, shard, places[(end - len(entries)):end])
+                 for shard, entries, end in zip(shards, shard_segments, shard_ends))
+        for index, (runs, values) in enumerate(pool.imap_unordered(_parse_shard_values, tasks)):
+            cursor = 0
+            for row, column, length in runs.tolist():
+                run_values = values[cursor:(cursor + length)]
+                grid.altitudes[row, column:(column + length)] = run_values[:, 0]
+                grid.resolutions[row, column:(column + length)] = run_values[:, 1]
+                cursor += length
+            print('Placed shard', index + 1, '/', len(shards))
+    for start in range(0, height, ROWS_PER_BLOCK):
+        if np.isnan(grid.altitudes[start:(start + ROWS_PER_BLOCK)]).any():
+            raise RuntimeError('Some map samples are missing.')
+    print('Writing into', output_path)
+    if text:
+        write_text_map(output_path, grid)
+    else:
+        grid.flush()
+        write_grid_metadata(output_path, grid)
     print('End')
+    return grid
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Rebuild a map file from a JSON dictionary of elevation API responses.')
+    parser.add_argument('json_path', type=str, help='JSON file mapping URLs to elevation values')
+    parser.add_argument('output_path', type=str, help='Output map file')
+    parser.add_argument('--text', '-t', action='store_true',
+                        help='Write padded text map (lat lng alt res per line, coordinates '
+                             'computed from grid origin and steps) instead of binary grid.')
+    parser.add_argument('--processes', '-p', type=int, default=None,
+                        help='Number of processes (default: number of CPUs).')
+    args = parser.parse_args()
+    rebuild_map(args.json_path, args.output_path, args.text, args.processes)
+
 
 if __name__ == '__main__':
     main()
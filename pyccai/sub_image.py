@@ -1,36 +1,49 @@
-import sys
+import argparse
+import os
+from typing import Iterable, List, Tuple
 
-from PIL import Image
+from pyccai.flood import MapImage
+
+
+def crop_to_markers(image_path, output_path):
+    # type: (str, str) -> Tuple[int, int]
+    # Crop image to rectangle between its 2 marker pixels (top-left and bottom-right,
+    # both included), save crop into output path and return crop size.
+    image = MapImage(image_path)
+    markers = image.marker_positions()
+    if len(markers) != 2:
+        raise RuntimeError('Expected 2 markers in %s, got %d' % (image_path, len(markers)))
+    (x_1, y_1), (x_2, y_2) = markers
+    crop = image.crop(x_1, y_1, x_2 + 1, y_2 + 1)
+    print(image_path, image.width, image.height, '->', output_path, crop.size)
+    crop.save(output_path)
+    return crop.size
+
+
+def crop_images(pairs):
+    # type: (Iterable[Tuple[str, str]]) -> List[Tuple[int, int]]
+    # Crop each (image path, output path) pair, and return crop sizes.
+    return [crop_to_markers(image_path, output_path) for image_path, output_path in pairs]
 
 
 def main():
-    if len(sys.argv) != 3:
-        return
-    image_file_name = sys.argv[1]
-    output_file_name = sys.argv[2]
-    image = Image.open(image_file_name)
-    if image.mode != 'RGB':
-        image = image.convert('RGB')
-    width, height = image.size
-    red_pixels = []
-    for index_pixel, pixel in enumerate(image.getdata()):
-        if pixel == (255, 0, 0):
-            y = index_pixel // width
-            x = index_pixel % width
-            red_pixels.append((x, y))
-    assert len(red_pixels) == 2
-    (x_1, y_1), (x_2, y_2) = red_pixels
-    new_width = (x_2 - x_1 + 1)
-    new_height = (y_2 - y_1 + 1)
-    left = x_1
-    upper = y_1
-    right = x_2 + 1
-    lower = y_2 + 1
-    crop = image.crop((left, upper, right, lower))
-    print(width, height)
-    print(new_width, new_height)
-    print(crop.size)
-    crop.save(output_file_name)
+    parser = argparse.ArgumentParser(
+        prog='Crop images to rectangles delimited by 2 red marker pixels.')
+    parser.add_argument('paths', type=str, nargs='+',
+                        help='Input image and output image, or input images if --output-dir '
+                             'is given.')
+    parser.add_argument('--output-dir', '-o', type=str, default=None,
+                        help='Crop all input images into this directory, with same file names.')
+    args = parser.parse_args()
+    if args.output_dir is None:
+        if len(args.paths) != 2:
+            parser.error('Expected an input image and an output image.')
+        pairs = [tuple(args.paths)]
+    else:
+        os.makedirs(args.output_dir, exist_ok=True)
+        pairs = [(path, os.path.join(args.output_dir, os.path.basename(path)))
+                 for path in args.paths]
+    crop_images(pairs)
 
 
 if __name__ == '__main__':
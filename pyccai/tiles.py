@@ -0,0 +1,344 @@
+"""Export a map as a pyramid of XYZ web map tiles, for viewers to fetch only visible tiles.
+
+Tiles use web map (Web Mercator) numbering, with TILE_SIZE x TILE_SIZE pixels:
+- elevation/{z}/{x}/{y}.png: elevations in Terrarium encoding
+  (elevation = R * 256 + G + B / 256 - 32768), transparent where there is no sample;
+- flood/{z}/{x}/{y}.png: flooded cells (altitude <= threshold, water excluded), in blue;
+- flood/{z}/{x}/{y}.json: flood rectangles [north, south, west, east] intersecting tile.
+
+Most detailed level samples the map cell nearest to each pixel center. Each lower level is
+built from its 4 children tiles: mean elevation of valid pixels, flooded if any child pixel
+is flooded. Tiles of a level are rendered in parallel by a pool of processes.
+tiles.json describes bounds, zoom levels and tile paths.
+"""
+import argparse
+import math
+import multiprocessing
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import ujson as json
+from PIL import Image
+
+from pyccai.flood import MapImage, select_flooded
+from pyccai.geodesy import meridional_radius
+from pyccai.grid import MapGrid, is_grid_file, is_tiff_file, load_map, write_grid
+
+TILE_SIZE = 256
+EARTH_CIRCUMFERENCE = 40075016.686
+TERRARIUM_OFFSET = 32768
+FLOOD_COLOR = (0, 0, 255, 160)
+FLOOD_JS_PREFIX = 'export const FLOOD = '
+FLOODED_MASK_FILE = 'flooded.npy'
+SHARED_GRID_FILE = 'map.grid'
+TILE_PATH = '{z}/{x}/{y}'
+
+Tile = Tuple[int, int, int]
+
+# Per-process state, set by _init_worker().
+_WORKER = {}  # type: Dict[str, object]
+
+
+def lng_to_tile_x(lng, zoom):
+    # Fractional tile column of a longitude.
+    return (np.asarray(lng, dtype=np.float64) + 180) / 360 * (1 << zoom)
+
+
+def lat_to_tile_y(lat, zoom):
+    # Fractional tile row of a latitude.
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    return (1 - np.arcsinh(np.tan(lat)) / math.pi) / 2 * (1 << zoom)
+
+
+def tile_x_to_lng(x, zoom):
+    return np.asarray(x, dtype=np.float64) / (1 << zoom) * 360 - 180
+
+
+def tile_y_to_lat(y, zoom):
+    y = np.asarray(y, dtype=np.float64)
+    return np.degrees(np.arctan(np.sinh(math.pi * (1 - 2 * y / (1 << zoom)))))
+
+
+def tile_range(north, south, west, east, zoom):
+    # type: (float, float, float, float, int) -> Tuple[int, int, int, int]
+    # Return (x_min, x_max, y_min, y_max) of tiles covering bounds, inclusive.
+    last = (1 << zoom) - 1
+    x_min, x_max = np.clip(np.floor(lng_to_tile_x([west, east], zoom)), 0, last).astype(int)
+    y_min, y_max = np.clip(np.floor(lat_to_tile_y([north, south], zoom)), 0, last).astype(int)
+    return int(x_min), int(x_max), int(y_min), int(y_max)
+
+
+def default_max_zoom(grid):
+    # type: (MapGrid) -> int
+    # Lowest zoom whose pixels are not larger than map cells.
+    lat = (grid.north + grid.south) / 2
+    cell_size = float(meridional_radius(lat)) * math.radians(abs(grid.lat_step))
+    pixel_size_at_zoom_0 = EARTH_CIRCUMFERENCE * math.cos(math.radians(lat)) / TILE_SIZE
+    return max(0, int(math.ceil(math.log2(pixel_size_at_zoom_0 / max(cell_size, 1e-3)))))
+
+
+def default_min_zoom(grid, max_zoom):
+    # type: (MapGrid, int) -> int
+    # Highest zoom at which map is covered by at most 2 x 2 tiles.
+    for zoom in range(max_zoom, -1, -1):
+        x_min, x_max, y_min, y_max = tile_range(grid.north, grid.south, grid.west, grid.east,
+                                                zoom)
+        if x_max - x_min <= 1 and y_max - y_min <= 1:
+            return zoom
+    return 0
+
+
+def encode_terrarium(elevations):
+    # type: (np.ndarray) -> np.ndarray
+    # Return RGBA pixels for elevations, transparent where elevation is NaN.
+    valid = ~np.isnan(elevations)
+    value = np.where(valid, elevations, 0).astype(np.float64) + TERRARIUM_OFFSET
+    value = np.clip(value, 0, 65536 - 1 / 256)
+    integer = np.floor(value)
+    pixels = np.empty(elevations.shape + (4,), dtype=np.uint8)
+    pixels[..., 0] = integer // 256
+    pixels[..., 1] = integer % 256
+    pixels[..., 2] = np.floor((value - integer) * 256)
+    pixels[..., 3] = np.where(valid, 255, 0)
+    return pixels
+
+
+def decode_terrarium(pixels):
+    # type: (np.ndarray) -> np.ndarray
+    pixels = pixels.astype(np.float64)
+    elevations = pixels[..., 0] * 256 + pixels[..., 1] + pixels[..., 2] / 256 - TERRARIUM_OFFSET
+    elevations[pixels[..., 3] == 0] = np.nan
+    return elevations
+
+
+def encode_flooded(flooded):
+    # type: (np.ndarray) -> np.ndarray
+    pixels = np.zeros(flooded.shape + (4,), dtype=np.uint8)
+    pixels[flooded] = FLOOD_COLOR
+    return pixels
+
+
+def read_flood_rectangles(path):
+    # type: (str) -> np.ndarray
+    # Read rectangles [north, south, west, east] from a flood output file (<name>.js).
+    with open(path) as file:
+        content = file.read().strip()
+    if content.startswith(FLOOD_JS_PREFIX):
+        content = content[len(FLOOD_JS_PREFIX):]
+    return np.array(json.loads(content.rstrip(';')), dtype=np.float64).reshape(-1, 4)
+
+
+def assign_rectangles(rectangles, zoom):
+    # type: (np.ndarray, int) -> Dict[Tuple[int, int], List[int]]
+    # Return indices of rectangles intersecting each tile (x, y) of a zoom level.
+    tiles = {}  # type: Dict[Tuple[int, int], List[int]]
+    if not len(rectangles):
+        return tiles
+    last = (1 << zoom) - 1
+    x_min = np.clip(np.floor(lng_to_tile_x(rectangles[:, 2], zoom)), 0, last).astype(int)
+    x_max = np.clip(np.floor(lng_to_tile_x(rectangles[:, 3], zoom)), 0, last).astype(int)
+    y_min = np.clip(np.floor(lat_to_tile_y(rectangles[:, 0], zoom)), 0, last).astype(int)
+    y_max = np.clip(np.floor(lat_to_tile_y(rectangles[:, 1], zoom)), 0, last).astype(int)
+    for index, (x0, x1, y0, y1) in enumerate(zip(x_min.tolist(), x_max.tolist(),
+                                                 y_min.tolist(), y_max.tolist())):
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                tiles.setdefault((x, y), []).append(index)
+    return tiles
+
+
+def _tile_file(kind, tile, extension):
+    # type: (str, Tile, str) -> str
+    zoom, x, y = tile
+    return os.path.join(_WORKER['output'], kind, str(zoom), str(x), '%d%s' % (y, extension))
+
+
+def _save_tile(kind, tile, pixels):
+    # type: (str, Tile, np.ndarray) -> None
+    path = _tile_file(kind, tile, '.png')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.fromarray(pixels).save(path)
+
+
+def _init_worker(map_path, output, flooded_path):
+    # type: (str, str, Optional[str]) -> None
+    _WORKER['grid'] = load_map(map_path)
+    _WORKER['output'] = output
+    _WORKER['flooded'] = np.load(flooded_path, mmap_mode='r') if flooded_path else None
+
+
+def _sample_tile(tile):
+    # type: (Tile) -> Tuple[np.ndarray, Optional[np.ndarray]]
+    # Return elevations and flooded mask of map cells nearest to tile pixel centers.
+    grid = _WORKER['grid']  # type: MapGrid
+    flooded = _WORKER['flooded']
+    zoom, x, y = tile
+    offsets = np.arange(TILE_SIZE) + 0.5
+    lats = tile_y_to_lat(y + offsets / TILE_SIZE, zoom)
+    lngs = tile_x_to_lng(x + offsets / TILE_SIZE, zoom)
+    rows = np.rint((lats - grid.origin_lat) / grid.lat_step).astype(np.int64)
+    columns = np.rint((lngs - grid.origin_lng) / grid.lng_step).astype(np.int64)
+    valid_rows = (rows >= 0) & (rows < grid.height)
+    valid_columns = (columns >= 0) & (columns < grid.width)
+    elevations = np.full((TILE_SIZE, TILE_SIZE), np.nan)
+    mask = np.zeros((TILE_SIZE, TILE_SIZE), dtype=bool) if flooded is not None else None
+    if valid_rows.any() and valid_columns.any():
+        window = np.ix_(np.flatnonzero(valid_rows), np.flatnonzero(valid_columns))
+        cells = np.ix_(rows[valid_rows], columns[valid_columns])
+        elevations[window] = grid.altitudes[cells]
+        if flooded is not None:
+            mask[window] = flooded[cells]
+    return elevations, mask
+
+
+def _merge_children(tile):
+    # type: (Tile) -> Tuple[np.ndarray, Optional[np.ndarray]]
+    # Return elevations and flooded mask of a tile downsampled from its 4 children.
+    zoom, x, y = tile
+    elevations = np.full((2 * TILE_SIZE, 2 * TILE_SIZE), np.nan)
+    mask = None
+    if _WORKER['flooded'] is not None:
+        mask = np.zeros((2 * TILE_SIZE, 2 * TILE_SIZE), dtype=bool)
+    for dy in (0, 1):
+        for dx in (0, 1):
+            child = (zoom + 1, 2 * x + dx, 2 * y + dy)
+            window = (slice(dy * TILE_SIZE, (dy + 1) * TILE_SIZE),
+                      slice(dx * TILE_SIZE, (dx + 1) * TILE_SIZE))
+            path = _tile_file('elevation', child, '.png')
+            if os.path.isfile(path):
+                with Image.open(path) as image:
+                    elevations[window] = decode_terrarium(np.asarray(image.convert('RGBA')))
+            path = _tile_file('flood', child, '.png')
+            if mask is not None and os.path.isfile(path):
+                with Image.open(path) as image:
+                    mask[window] = np.asarray(image.convert('RGBA'))[..., 3] > 0
+    blocks = elevations.reshape(TILE_SIZE, 2, TILE_SIZE, 2)
+    valid = ~np.isnan(blocks)
+    counts = valid.sum(axis=(1, 3))
+    sums = np.where(valid, blocks, 0).sum(axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        merged = np.where(counts > 0, sums / counts, np.nan)
+    if mask is not None:
+        mask = mask.reshape(TILE_SIZE, 2, TILE_SIZE, 2).any(axis=(1, 3))
+    return merged, mask
+
+
+def _render_tile(task):
+    # type: (Tuple[Tile, bool]) -> int
+    # Render a tile, sampled from map or merged from children. Return 1 if tile was written.
+    tile, from_children = task
+    elevations, mask = _merge_children(tile) if from_children else _sample_tile(tile)
+    if np.isnan(elevations).all():
+        return 0
+    _save_tile('elevation', tile, encode_terrarium(elevations))
+    if mask is not None:
+        _save_tile('flood', tile, encode_flooded(mask))
+    return 1
+
+
+def iter_level_tiles(grid, zoom):
+    # type: (MapGrid, int) -> Iterable[Tile]
+    x_min, x_max, y_min, y_max = tile_range(grid.north, grid.south, grid.west, grid.east, zoom)
+    for y in range(y_min, y_max + 1):
+        for x in range(x_min, x_max + 1):
+            yield zoom, x, y
+
+
+def export_tiles(map_path, output, min_zoom=None, max_zoom=None, flood_threshold=None,
+                 water=None, rectangles=None, nb_processes=None, grid=None):
+    # type: (str, str, int, int, float, np.ndarray, np.ndarray, int, MapGrid) -> dict
+    # Write tile pyramid of map into output directory, and return its description.
+    # grid is map already loaded from map path, if any.
+    if grid is None:
+        grid = load_map(map_path)
+    if max_zoom is None:
+        max_zoom = default_max_zoom(grid)
+    if min_zoom is None:
+        min_zoom = default_min_zoom(grid, max_zoom)
+    os.makedirs(output, exist_ok=True)
+    # Workers memory-map the map. A text map is parsed once here and shared as a binary grid.
+    shared_path = None
+    if not is_grid_file(map_path) and not is_tiff_file(map_path):
+        shared_path = os.path.join(output, SHARED_GRID_FILE)
+        write_grid(shared_path, grid)
+    flooded_path = None
+    if flood_threshold is not None:
+        flooded_path = os.path.join(output, FLOODED_MASK_FILE)
+        np.save(flooded_path, select_flooded(grid.altitudes, flood_threshold, water))
+    try:
+        with multiprocessing.Pool(processes=nb_processes, initializer=_init_worker,
+                                  initargs=(shared_path or map_path, output,
+                                            flooded_path)) as pool:
+            for zoom in range(max_zoom, min_zoom - 1, -1):
+                tasks = ((tile, zoom < max_zoom) for tile in iter_level_tiles(grid, zoom))
+                nb_written = sum(pool.imap_unordered(_render_tile, tasks, chunksize=16))
+                print('Zoom', zoom, ':', nb_written, 'tile(s).')
+    finally:
+        for path in (shared_path, flooded_path):
+            if path is not None:
+                os.remove(path)
+    description = {
+        'bounds': grid.to_json(),
+        'min_zoom': min_zoom,
+        'max_zoom': max_zoom,
+        'tile_size': TILE_SIZE,
+        'elevation': 'elevation/%s.png' % TILE_PATH,
+        'encoding': 'terrarium',
+    }
+    if flood_threshold is not None:
+        description['flood_threshold'] = flood_threshold
+        description['flood'] = 'flood/%s.png' % TILE_PATH
+    if rectangles is not None:
+        description['flood_rectangles'] = 'flood/%s.json' % TILE_PATH
+        for zoom in range(min_zoom, max_zoom + 1):
+            for (x, y), indices in assign_rectangles(rectangles, zoom).items():
+                path = os.path.join(output, 'flood', str(zoom), str(x), '%d.json' % y)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w') as file:
+                    file.write(json.dumps(rectangles[indices].tolist()))
+    with open(os.path.join(output, 'tiles.json'), 'w') as file:
+        file.write(json.dumps(description, indent=2, escape_forward_slashes=False))
+    return description
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Export a map (and optionally its flood) as a pyramid of XYZ web map tiles.')
+    parser.add_argument('map_file_name', type=str,
+                        help='Map file (binary grid, GeoTIFF or text map).')
+    parser.add_argument('output', type=str, help='Output directory')
+    parser.add_argument('--min-zoom', type=int, default=None,
+                        help='Least detailed zoom level (default: level where map fits in '
+                             '2 x 2 tiles).')
+    parser.add_argument('--max-zoom', type=int, default=None,
+                        help='Most detailed zoom level (default: level where tile pixels are '
+                             'not larger than map cells).')
+    parser.add_argument('--flood-threshold', type=float, default=None,
+                        help='Also export flooded cells (altitude <= threshold). If a PNG image '
+                             'with same base name as map exists in working directory, it is '
+                             'used to skip water, as in flood.')
+    parser.add_argument('--flood-rectangles', type=str, default=None,
+                        help='Flood output file (<name>.js) whose rectangles are split into '
+                             'tiles.')
+    parser.add_argument('--processes', '-p', type=int, default=None,
+                        help='Number of processes (default: number of CPUs).')
+    args = parser.parse_args()
+    grid = load_map(args.map_file_name)
+    water = None
+    if args.flood_threshold is not None:
+        map_title = os.path.splitext(os.path.basename(args.map_file_name))[0]
+        map_image_path = '%s.png' % map_title
+        if os.path.isfile(map_image_path):
+            water = MapImage(map_image_path).water_mask(grid)
+    rectangles = None
+    if args.flood_rectangles:
+        rectangles = read_flood_rectangles(args.flood_rectangles)
+    description = export_tiles(args.map_file_name, args.output, args.min_zoom, args.max_zoom,
+                               args.flood_threshold, water, rectangles, args.processes, grid)
+    print('Tiles written in', args.output, 'for zoom levels', description['min_zoom'], 'to',
+          description['max_zoom'])
+
+
+if __name__ == '__main__':
+    main()
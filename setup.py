@@ -8,6 +8,7 @@ setuptools.setup(
         'ujson',
         'Pillow',
         'geopy',
+        'numpy',
     ],
     url='',
     license='GPL',